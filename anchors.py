@@ -0,0 +1,439 @@
+"""Open payment channels, by building and signing their anchors.
+
+Interface:
+create(url, mymoney, theirmoney)
+- Open a channel with the node identified by url,
+  where you can send mymoney satoshis, and recieve theirmoney satoshis.
+create_many(channels, fees, batch)
+- Open channels with many nodes at once, concurrently. channels is a list
+  of (url, mymoney, theirmoney). With batch, every anchor is an output of
+  one funding transaction.
+
+The counterparty's half is served through the channel API (see
+channel.REMOTE): open_channel, or prepare_anchor, sign_anchor and
+cancel_channel for a batch; then update_anchor, once the anchor is signed.
+Each side funds its half from coins reserved for it (see coins.py).
+CHANNEL_OPENED is sent when a channel has been opened.
+"""
+
+from flask import g, current_app
+from bitcoin.core import COutPoint, CMutableTxOut, CMutableTransaction, b2lx
+from bitcoin.core.script import CScript
+from bitcoin.wallet import CBitcoinAddress
+import jsonrpcproxy
+from serverutil import database
+from channelstore import REMOTE, Channel
+from channelstore import cache, cached, channel_lock, load, record
+from channel import CHANNEL_OPENED, async_peer, find
+from coins import Coin, coins_lock, select_coins, spend_coins, release_coins
+from transactions import anchor_script, hash_signatures
+
+def create(url, mymoney, theirmoney, fees=10000):
+    """Open a payment channel.
+
+    After this method returns, a payment channel will have been established
+    with the node identified by url, in which you can send mymoney satoshis
+    and recieve theirmoney satoshis. Any blockchain fees involved in the
+    setup and teardown of the channel should be collected at this time.
+    """
+    (_, error), = open_channels([(url, mymoney, theirmoney)], fees)
+    if error is not None:
+        raise error
+
+def create_many(channels, fees=10000, batch=False):
+    """Open payment channels with many nodes at once.
+
+    channels is a list of (url, mymoney, theirmoney), each as for create.
+    The nodes are negotiated with concurrently. If batch is set, every
+    anchor is an output of one funding transaction, and the channels open
+    or fail together. Otherwise a channel failing to open doesn't stop the
+    others. Return a receipt for each channel, in order: a dict of the
+    address, the anchor's txid (or None), and the error (or None).
+    """
+    receipts = []
+    for (url, _, _), (channel, error) in zip(
+            channels, open_channels(channels, fees, batch)):
+        if error is not None:
+            current_app.logger.warning("Failed to open channel with %s: %r",
+                                       url, error)
+        receipts.append({
+            'address': url,
+            'anchor': None if channel is None else
+                      b2lx(channel.anchor_point.hash),
+            'error': None if error is None else str(error)})
+    return receipts
+
+def open_channels(channels, fees, batch=False):
+    """Open (url, mymoney, theirmoney) channels, as create_many.
+
+    Return (Channel, None) for each channel opened, and (None, exception)
+    for each which failed.
+    """
+    if batch:
+        anchored = _anchor_together(channels, fees)
+    else:
+        anchored = _anchor_separately(channels, fees)
+    # Exchange signatures for the inital commitment transactions
+    # The node knows the channel by its anchor before it was fully signed
+    ready = [(channel, provisional) for channel, provisional, _ in anchored
+             if channel is not None]
+    sigs = hash_signatures(channel.commitment_sighash()
+                           for channel, _ in ready)
+    replies = iter(jsonrpcproxy.run(
+        *[async_peer(channel.address).update_anchor(
+            g.addr, provisional.serialize(), channel.anchor_point.hash, sig)
+          for (channel, provisional), sig in zip(ready, sigs)],
+        return_exceptions=True))
+    outcomes = []
+    for channel, _, error in anchored:
+        if channel is not None:
+            try:
+                channel.their_sig = next(replies)
+                if isinstance(channel.their_sig, Exception):
+                    raise channel.their_sig
+                channel.check_commitment_sig(channel.their_sig)
+                # The channel is new, so no one else can hold its lock
+                database.session.add(channel)
+                cache().commit(channel)
+                record(channel)
+            except Exception as err: # pylint: disable=broad-except
+                channel, error = None, err
+            else:
+                # Event: channel opened
+                CHANNEL_OPENED.send('channel', address=channel.address)
+        outcomes.append((channel, error))
+    return outcomes
+
+def _new_channel(url, mymoney, theirmoney, anchor_point, redeem, # pylint: disable=too-many-arguments
+                 my_out_addr, their_out_addr):
+    """Return our row for a channel we opened, once its anchor is sent."""
+    return Channel(address=url,
+                   anchor_point=anchor_point,
+                   anchor_index=1,
+                   their_sig=b'',
+                   anchor_redeem=redeem,
+                   our_balance=mymoney,
+                   our_script=my_out_addr.to_scriptPubKey(),
+                   their_balance=theirmoney,
+                   their_script=their_out_addr.to_scriptPubKey(),
+                   commitment_number=0,
+                  )
+
+def _anchor_separately(channels, fees):
+    """Send an anchor for each channel.
+
+    Return [(Channel, the anchor before we signed, error)].
+    """
+    # Choose every channel's inputs and change output up front
+    selected = [_select_or_fail(mymoney + 2 * fees)
+                for _, mymoney, _ in channels]
+    addresses = [g.bit.getnewaddress() for _ in channels]
+    replies = _propose_channels(channels, fees, selected, addresses)
+    anchored = []
+    for index, (url, mymoney, theirmoney) in enumerate(channels):
+        if isinstance(selected[index], Exception):
+            anchored.append((None, None, selected[index]))
+            continue
+        try:
+            transaction, provisional = _send_anchor(replies[index])
+        except Exception as err: # pylint: disable=broad-except
+            release_coins(selected[index][0])
+            anchored.append((None, None, err))
+            continue
+        spend_coins(selected[index][0], transaction)
+        _, redeem, their_out_addr = replies[index]
+        anchored.append((_new_channel(
+            url, mymoney, theirmoney, COutPoint(transaction.GetHash(), 0),
+            redeem, addresses[index], their_out_addr), provisional, None))
+    return anchored
+
+def _select_or_fail(amount):
+    """Return select_coins(amount), or the exception it raised."""
+    try:
+        return select_coins(amount)
+    except Exception as err: # pylint: disable=broad-except
+        return err
+
+def _propose_channels(channels, fees, selected, addresses):
+    """Ask each node to open a channel, with the coins selected for it.
+
+    Return {index: open_channel's reply, or its error} for each channel
+    which has coins.
+    """
+    pubkey = get_pubkey()
+    proposals = {}
+    for index, (url, mymoney, theirmoney) in enumerate(channels):
+        if not isinstance(selected[index], Exception):
+            coins, change = selected[index]
+            proposals[index] = async_peer(url).open_channel(
+                g.addr, theirmoney, mymoney, fees, coins, change,
+                pubkey, addresses[index])
+    return dict(zip(proposals, jsonrpcproxy.run(*proposals.values(),
+                                                return_exceptions=True)))
+
+def _send_anchor(reply):
+    """Sign and send the anchor in open_channel's reply.
+
+    Return the anchor transaction, and the anchor before we signed.
+    """
+    if isinstance(reply, Exception):
+        raise reply
+    transaction = reply[0]
+    provisional = COutPoint(transaction.GetHash(), 0)
+    transaction = g.bit.signrawtransaction(transaction)
+    assert transaction['complete']
+    transaction = transaction['tx']
+    g.bit.sendrawtransaction(transaction)
+    return transaction, provisional
+
+def _anchor_together(channels, fees):
+    """Send every anchor in one transaction, as _anchor_separately."""
+    coins, change = select_coins(sum(mymoney + 2 * fees
+                                     for _, mymoney, _ in channels))
+    addresses = [g.bit.getnewaddress() for _ in channels]
+    replies = []
+    try:
+        # Each node chooses its inputs and change, and makes the anchor script
+        replies = jsonrpcproxy.run(*[
+            async_peer(url).prepare_anchor(g.addr, theirmoney, mymoney, fees,
+                                           get_pubkey(), address)
+            for (url, mymoney, theirmoney), address
+            in zip(channels, addresses)], return_exceptions=True)
+        errors = [reply for reply in replies if isinstance(reply, Exception)]
+        if errors:
+            raise errors[0]
+        transaction = _funding_transaction(channels, fees, coins, change,
+                                           replies)
+        unsigned = transaction.GetHash()
+        transaction = _sign_funding(channels, transaction, replies)
+    except Exception as err: # pylint: disable=broad-except
+        release_coins(coins)
+        _cancel_prepared(channels, replies)
+        return [(None, None, err) for _ in channels]
+    spend_coins(coins, transaction)
+    return [(_new_channel(url, mymoney, theirmoney,
+                          COutPoint(transaction.GetHash(), index),
+                          reply[2], address, reply[3]),
+             COutPoint(unsigned, index), None)
+            for index, ((url, mymoney, theirmoney), reply, address)
+            in enumerate(zip(channels, replies, addresses))]
+
+def _funding_transaction(channels, fees, coins, change, replies):
+    """Return the unsigned funding transaction of _anchor_together.
+
+    It spends our coins and every node's, and has one anchor output for
+    each channel, in order, then the change outputs.
+    """
+    inputs = list(coins)
+    outputs = []
+    changes = [change]
+    for (_, mymoney, theirmoney), reply in zip(channels, replies):
+        their_coins, their_change, redeem, _ = reply
+        inputs.extend(their_coins)
+        changes.append(their_change)
+        anchor = CScript(redeem).to_p2sh_scriptPubKey()
+        outputs.append(CMutableTxOut(mymoney + theirmoney + 2 * fees, anchor))
+    outputs.extend(output for output in changes if output is not None)
+    return CMutableTransaction(inputs, outputs)
+
+def _sign_funding(channels, transaction, replies):
+    """Sign and send the funding transaction, returning it signed.
+
+    Each node signs its inputs, once for all its channels; then we sign
+    ours.
+    """
+    anchors = {}
+    for index, ((url, _, _), reply) in enumerate(zip(channels, replies)):
+        anchors.setdefault(url, []).append((index, reply[3]))
+    signed = jsonrpcproxy.run(*[
+        async_peer(url).sign_anchor(g.addr, transaction, node_anchors)
+        for url, node_anchors in anchors.items()])
+    for their_transaction in signed:
+        for txin, their_txin in zip(transaction.vin, their_transaction.vin):
+            if their_txin.scriptSig:
+                txin.scriptSig = their_txin.scriptSig
+    transaction = g.bit.signrawtransaction(transaction)
+    assert transaction['complete']
+    transaction = transaction['tx']
+    g.bit.sendrawtransaction(transaction)
+    return transaction
+
+def _cancel_prepared(channels, replies):
+    """Have each node forget the channels it prepared, releasing its coins.
+
+    replies are prepare_anchor's, for the channels which got so far.
+    """
+    prepared = {}
+    for (url, _, _), reply in zip(channels, replies):
+        if not isinstance(reply, Exception):
+            coins, _, _, our_addr = reply
+            prepared.setdefault(url, []).append((our_addr, coins))
+    jsonrpcproxy.run(*[async_peer(url).cancel_channel(g.addr, node_prepared)
+                       for url, node_prepared in prepared.items()],
+                     return_exceptions=True)
+
+def get_pubkey():
+    """Get a new pubkey."""
+    return g.identity.pubkey
+
+@REMOTE
+def open_channel(address, mymoney, theirmoney, fees, their_coins, their_change, their_pubkey, their_out_addr): # pylint: disable=too-many-arguments, line-too-long
+    """Open a payment channel."""
+    # Get inputs and change output
+    coins, change = select_coins(mymoney + 2 * fees)
+    # Make the anchor script
+    anchor_output_script = anchor_script(get_pubkey(), their_pubkey)
+    # Construct the anchor utxo
+    payment = CMutableTxOut(mymoney + theirmoney + 2 * fees,
+                            anchor_output_script.to_p2sh_scriptPubKey())
+    # Anchor tx. Either side may have no change.
+    transaction = CMutableTransaction(
+        their_coins + coins,
+        [output for output in [payment, change, their_change]
+         if output is not None])
+    # Half-sign
+    transaction = g.bit.signrawtransaction(transaction)['tx']
+    # Create channel in DB
+    our_addr = g.bit.getnewaddress()
+    channel = Channel(address=address,
+                      anchor_point=COutPoint(transaction.GetHash(), 0),
+                      anchor_index=0,
+                      their_sig=b'',
+                      anchor_redeem=anchor_output_script,
+                      our_balance=mymoney,
+                      our_script=our_addr.to_scriptPubKey(),
+                      their_balance=theirmoney,
+                      their_script=their_out_addr.to_scriptPubKey(),
+                      commitment_number=0,
+                     )
+    database.session.add(channel)
+    cache().commit(channel)
+    # Event: channel opened
+    CHANNEL_OPENED.send('channel', address=address)
+    return (transaction, anchor_output_script, our_addr)
+
+@REMOTE
+def prepare_anchor(address, mymoney, theirmoney, fees, their_pubkey, their_out_addr): # pylint: disable=too-many-arguments, line-too-long
+    """Join a funding transaction which will anchor a payment channel.
+
+    Return our inputs, change output (or None), the anchor script, and our
+    payout address. The channel has no anchor until sign_anchor, and is
+    known by our payout address until then.
+    """
+    coins, change = select_coins(mymoney + 2 * fees)
+    try:
+        anchor_output_script = anchor_script(get_pubkey(), their_pubkey)
+        our_addr = g.bit.getnewaddress()
+        channel = Channel(address=address,
+                          anchor_point=None,
+                          anchor_index=0,
+                          their_sig=b'',
+                          anchor_redeem=anchor_output_script,
+                          our_balance=mymoney,
+                          our_script=our_addr.to_scriptPubKey(),
+                          their_balance=theirmoney,
+                          their_script=their_out_addr.to_scriptPubKey(),
+                          commitment_number=0,
+                         )
+        database.session.add(channel)
+        cache().commit(channel)
+    except Exception:
+        database.session.rollback()
+        release_coins(coins)
+        raise
+    return (coins, change, anchor_output_script, our_addr)
+
+def prepared_channel(address, our_addr):
+    """Return the id of a channel prepare_anchor made, or None.
+
+    The channel is with address, and pays us at our_addr. None is returned
+    once it has been anchored, or forgotten.
+    """
+    row = database.session.query(Channel.id).filter(
+        Channel.address == address,
+        Channel.anchor_point == None, # pylint: disable=singleton-comparison
+        Channel.our_script == bytes(our_addr.to_scriptPubKey())).first()
+    return None if row is None else row[0]
+
+@REMOTE
+def sign_anchor(address, transaction, anchors):
+    """Sign our inputs to a funding transaction, after prepare_anchor.
+
+    anchors is an (index, our_addr) pair for each of our channels the
+    transaction funds: output index must pay the anchor script of the
+    channel prepare_anchor returned our_addr for. Whatever of our inputs
+    doesn't go to the channels or fees must come back to our wallet.
+    """
+    prepared = []
+    for index, our_addr in anchors:
+        channel_id = prepared_channel(address, our_addr)
+        if channel_id is None:
+            raise Exception("Unknown channel", address, str(our_addr))
+        prepared.append((index, channel_id))
+    funded = 0
+    for index, channel_id in prepared:
+        channel = cached(channel_id)
+        anchor = transaction.vout[index]
+        assert anchor.scriptPubKey == \
+            CScript(channel.anchor_redeem).to_p2sh_scriptPubKey()
+        fees = anchor.nValue - channel.our_balance - channel.their_balance
+        assert fees >= 0
+        funded += channel.our_balance + fees
+    with coins_lock():
+        spent = sum(coin.amount for coin in
+                    (Coin.query.get(txin.prevout.serialize())
+                     for txin in transaction.vin)
+                    if coin is not None)
+    indexes = {index for index, _ in prepared}
+    returned = sum(
+        output.nValue for output_index, output
+        in enumerate(transaction.vout)
+        if output_index not in indexes and g.bit.validateaddress(
+            CBitcoinAddress.from_scriptPubKey(output.scriptPubKey)
+        )['ismine'])
+    assert returned >= spent - funded - int(g.config['changecost'])
+    for index, channel_id in prepared:
+        with channel_lock(channel_id):
+            channel = load(channel_id)
+            assert channel.anchor_point is None
+            channel.anchor_point = COutPoint(transaction.GetHash(), index)
+            cache().commit(channel)
+    transaction = g.bit.signrawtransaction(transaction)['tx']
+    # Event: channel opened
+    CHANNEL_OPENED.send('channel', address=address)
+    return transaction
+
+@REMOTE
+def cancel_channel(address, prepared):
+    """Forget channels from prepare_anchor which will not be anchored.
+
+    prepared is an (our_addr, coins) pair for each, as prepare_anchor
+    returned them. The coins reserved for each channel are released.
+    """
+    for our_addr, coins in prepared:
+        channel_id = prepared_channel(address, our_addr)
+        if channel_id is None:
+            continue
+        with channel_lock(channel_id):
+            channel = load(channel_id)
+            if channel is None or channel.anchor_point is not None:
+                continue
+            database.session.delete(channel)
+            cache().delete(channel)
+        release_coins(coins)
+
+@REMOTE
+def update_anchor(address, anchor, new_anchor, their_sig):
+    """Update the anchor txid after both have signed.
+
+    anchor is the channel's anchor before, serialized.
+    """
+    channel_id = find(address, anchor)
+    with channel_lock(channel_id):
+        channel = load(channel_id)
+        channel.anchor_point = COutPoint(new_anchor, channel.anchor_point.n)
+        channel.check_commitment_sig(their_sig)
+        channel.their_sig = their_sig
+        cache().commit(channel)
+        record(channel)
+        return channel.commitment_signature()
@@ -0,0 +1,191 @@
+#! /usr/bin/env python3
+
+"""A pooled, shared client for bitcoind.
+
+BitcoinPool -- a thread-safe stand-in for bitcoin.rpc.Proxy. Calls check out
+               one of a bounded pool of connections. Identical read-only
+               calls which are in flight at the same time share one request,
+               and chain-tip reads are cached for a short time.
+get_pool -- return the shared BitcoinPool for a service url, size and ttl
+invalidate -- drop every pool's cache
+
+READ_ONLY: calls which may be coalesced.
+CHAIN_TIP: read-only calls which depend only on the chain tip, and may be
+           cached until the next block (or ttl seconds, whichever is first).
+
+Any call not in READ_ONLY is assumed to change bitcoind's state; it is never
+coalesced and drops the cache when it returns. lightningd also calls
+invalidate on BLOCK_NOTIFY and WALLET_NOTIFY. listunspent is coalesced but never cached,
+since coins must not be selected from a stale list.
+
+Every caller gets its own copy of a shared result's lists and dicts, so
+callers may modify them. The objects in them are shared: python-bitcoinlib's
+types can't be copied, and are immutable anyway.
+"""
+
+import time
+import threading
+import bitcoin.rpc
+from serverutil import after_fork
+
+READ_ONLY = frozenset([
+    'getinfo', 'getblockcount', 'getbestblockhash', 'getblockhash',
+    'getblock', 'getblockheader', 'getrawtransaction', 'gettransaction',
+    'gettxout', 'getrawmempool', 'getbalance', 'listunspent',
+    'validateaddress',
+])
+CHAIN_TIP = frozenset([
+    'getinfo', 'getblockcount', 'getbestblockhash',
+])
+
+def _copy(result):
+    """Return a copy of result's lists and dicts, sharing everything else."""
+    if isinstance(result, list):
+        return [_copy(item) for item in result]
+    if isinstance(result, dict):
+        return {key: _copy(value) for key, value in result.items()}
+    return result
+
+class _Flight(object):
+    """A call in progress, which later identical calls wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        """Wait for the call to finish, and return its result."""
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return _copy(self.result)
+
+class BitcoinPool(object):
+    """A pool of bitcoin.rpc.Proxy connections to one bitcoind.
+
+    service_url -- passed to factory to make each connection
+    size -- the most connections open at a time
+    ttl -- seconds to cache CHAIN_TIP calls (0 to disable caching)
+    factory -- builds a connection (default bitcoin.rpc.Proxy)
+
+    Call bitcoind methods on the pool as on a bitcoin.rpc.Proxy.
+    """
+
+    def __init__(self, service_url, size=4, ttl=1.0,
+                 factory=bitcoin.rpc.Proxy):
+        self.service_url = service_url
+        self.size = size
+        self.ttl = ttl
+        self.factory = factory
+        self._lock = self._slots = None
+        self._idle, self._flights, self._cache = [], {}, {}
+        self._generation = 0
+        self._check_fork = after_fork(self._reset)
+        self._check_fork()
+
+    def _reset(self):
+        """Drop connections and locks inherited from a parent process."""
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._idle = []
+        self._flights = {}
+        self._cache = {}
+        self._generation = 0
+
+    def _request(self, name, args, kwargs):
+        """Make a call on a pooled connection."""
+        with self._slots:
+            with self._lock:
+                proxy = self._idle.pop() if self._idle else None
+            if proxy is None:
+                proxy = self.factory(self.service_url)
+            try:
+                result = getattr(proxy, name)(*args, **kwargs)
+            except bitcoin.rpc.JSONRPCError:
+                raise
+            except:
+                # The connection may be half-used, so don't reuse it
+                proxy = None
+                raise
+            finally:
+                if proxy is not None:
+                    with self._lock:
+                        self._idle.append(proxy)
+        return result
+
+    def _call(self, name, *args, **kwargs):
+        """Call name, sharing the result with identical calls if possible."""
+        self._check_fork()
+        if name not in READ_ONLY:
+            try:
+                return self._request(name, args, kwargs)
+            finally:
+                self.invalidate()
+        key = (name, repr(args), repr(sorted(kwargs.items())))
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                return _copy(cached[1])
+            flight = self._flights.get(key)
+            generation = self._generation
+            if flight is not None:
+                leader = False
+            else:
+                leader = True
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            return flight.wait()
+        try:
+            flight.result = self._request(name, args, kwargs)
+        except Exception as err: # pylint: disable=broad-except
+            flight.error = err
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            if (flight.error is None and name in CHAIN_TIP and self.ttl > 0
+                    and generation == self._generation):
+                self._cache[key] = (time.monotonic() + self.ttl, flight.result)
+        flight.done.set()
+        if flight.error is not None:
+            raise flight.error
+        return _copy(flight.result)
+
+    def invalidate(self):
+        """Drop cached results, and stop sharing calls already in flight."""
+        with self._lock:
+            self._generation += 1
+            self._cache.clear()
+            self._flights.clear()
+
+    def __getattr__(self, name):
+        """Generate a stub for a bitcoind call."""
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def function(*args, **kwargs):
+            """Call name on bitcoind."""
+            return self._call(name, *args, **kwargs)
+        function.__name__ = name
+        return function
+
+POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+def get_pool(service_url, size=4, ttl=1.0):
+    """Return the shared pool for service_url, making it if necessary.
+
+    Callers asking for a different size or ttl get a pool of their own.
+    """
+    key = (service_url, size, ttl)
+    with _POOLS_LOCK:
+        pool = POOLS.get(key)
+        if pool is None:
+            pool = POOLS[key] = BitcoinPool(service_url, size, ttl)
+        return pool
+
+def invalidate():
+    """Drop every pool's cache."""
+    with _POOLS_LOCK:
+        pools = list(POOLS.values())
+    for pool in pools:
+        pool.invalidate()
@@ -1,269 +1,546 @@
 """Micropayment channel API for a lightning node.
 
 Interface:
-API -- the Blueprint returned by serverutil.api_factory
-
 CHANNEL_OPENED -- a blinker signal sent when a channel is opened.
 Arguments:
 - address -- the url of the counterparty
 
 init(conf) - Set up the database
-create(url, mymoney, theirmoney)
-- Open a channel with the node identified by url,
-  where you can send mymoney satoshis, and recieve theirmoney satoshis.
 send(url, amount)
-- Update a channel by sending amount satoshis to the node at url.
+- Update the channels with the node at url, paying that node amount
+  satoshis more than before.
+send_many(url, amounts)
+- Send a batch of payments to the node at url, each in a single update,
+  returning a receipt for each.
 getbalance(url)
-- Return the number of satoshis you can send in the channel with url.
+- Return the number of satoshis you can send in the channels with url.
 close(url)
-- Close the channel with url.
+- Close the channels with url.
 getcommitmenttransactions(url)
-- Return a list of the commitment transactions in a payment channel
+- Return a list of the commitment transactions in the payment channels
+  with url
 
 HTLC operation has not yet been defined.
 
 Error conditions have not yet been defined.
 
-Database:
-The schema is currently one row for each channel in table CHANNELS.
-address: url for the counterpary
-commitment: your commitment transaction
+A node may have many channels with the same counterparty. Payments to it
+are steered to the channel which can afford them, or split between
+channels when none can (see send), so busy pairs of nodes can add
+capacity by opening more channels. Nodes name a channel to each other by
+its serialized anchor_point, since ids are only meaningful to one node.
+Channels are opened by anchors.py, kept by channelstore.py, and watched
+for spends of their anchors by watcher.py; a spent channel (one with
+spent_by set) is no longer paid in.
+
+The row's balances and their_sig are for commitment number
+commitment_number. Each update to a channel takes the next number, and is
+held in table PENDING_UPDATES until both signatures for it are known and
+every lower number has been applied.
+
+An update which fails before it is applied is voided by both nodes (see
+void and abort_update): its number stays taken, but pays nothing and needs
+no signature, so the updates numbered after it are not held up.
+
+Concurrency:
+Every change to a channel's row is made holding that channel's lock (see
+channelstore.channel_lock). Locks are only held while the database is
+read and written, never across an RPC to the counterparty, so two nodes
+paying each other at once cannot deadlock.
 """
 
-from sqlalchemy import Column, Integer, String, LargeBinary
-from flask import g
+import time
+import threading
+from sqlalchemy import func
+from flask import g, current_app
 from blinker import Namespace
-from bitcoin.core import COutPoint, CMutableTxOut, CMutableTxIn
-from bitcoin.core import CMutableTransaction
-from bitcoin.core.scripteval import VerifyScript, SCRIPT_VERIFY_P2SH
-from bitcoin.core.script import CScript, SignatureHash, SIGHASH_ALL
-from bitcoin.core.script import OP_CHECKMULTISIG, OP_PUBKEY
-from bitcoin.wallet import CBitcoinAddress
+from bitcoin.core import COutPoint, b2lx
 import jsonrpcproxy
-from serverutil import api_factory
-from serverutil import database
-from serverutil import ImmutableSerializableType, Base58DataType
-
-API, REMOTE, Model = api_factory('channel')
+import history
+from serverutil import database, after_fork
+from channelstore import REMOTE, PendingUpdate
+from channelstore import load, cache, cached, channel_lock, record
+from channelstore import history_path
+from transactions import hash_signatures
 
 SIGNALS = Namespace()
 CHANNEL_OPENED = SIGNALS.signal('CHANNEL_OPENED')
+def peer(url):
+    """Return a proxy to the channel API of the node at url."""
+    return jsonrpcproxy.Proxy(url+'channel/', binary=True)
+
+def async_peer(url):
+    """Return an asyncio proxy to the channel API of the node at url."""
+    return jsonrpcproxy.AsyncProxy(url+'channel/', binary=True,
+                                   timeout=float(g.config['peertimeout']))
+
+def channels(url):
+    """Return copies of the anchored channels with the node at url."""
+    return [cached(channel_id)
+            for channel_id in sorted(cache().anchors(url).values())]
 
-class AnchorScriptSig(object):
-    """Class representing a scriptSig satisfying the anchor output.
+def find(address, anchor):
+    """Return the id of the channel with address anchored at anchor.
 
-    Uses OP_PUBKEY to hold the place of your signature.
+    anchor is the serialized COutPoint the counterparty knows it by.
     """
+    channel_id = cache().anchors(address).get(anchor)
+    if channel_id is None:
+        raise Exception("Unknown channel", address,
+                        b2lx(COutPoint.deserialize(anchor).hash))
+    return channel_id
+
+def wait_for(condition, description):
+    """Poll condition until it returns something other than None."""
+    deadline = time.monotonic() + float(g.config['updatetimeout'])
+    while True:
+        result = condition()
+        if result is not None:
+            return result
+        if time.monotonic() > deadline:
+            raise Exception("Timed out waiting for", description)
+        time.sleep(0.005)
+
+def is_sequencer(address):
+    """Return True if we number the updates in the channel with address.
+
+    The node with the lesser url numbers every update, so the two nodes
+    never give different updates the same number.
+    """
+    return g.addr < address
+
+def next_number(channel):
+    """Return the next unused commitment number in channel."""
+    highest = database.session.query(func.max(PendingUpdate.number)).filter(
+        PendingUpdate.channel_id == channel.id).scalar()
+    return max(channel.commitment_number, highest or 0) + 1
+
+def pending(channel_id):
+    """Return the pending updates in channel channel_id, by number."""
+    return {update.number: update for update in
+            PendingUpdate.query.populate_existing().filter(
+                PendingUpdate.channel_id == channel_id,
+                PendingUpdate.number != None)} # pylint: disable=singleton-comparison
+
+def state_at(channel_id, number):
+    """Return a copy of channel channel_id as it is after update number.
+
+    Return None if an update up to number has not been numbered yet. Must
+    be called holding the channel's lock.
+    """
+    channel = cached(channel_id)
+    # Applied updates are forgotten, so only later states can be known
+    assert number > channel.commitment_number
+    updates = pending(channel_id)
+    amount = 0
+    for earlier in range(channel.commitment_number + 1, number + 1):
+        if earlier not in updates:
+            return None
+        amount += updates[earlier].amount
+    # channel is a copy, so this isn't persisted
+    channel.our_balance += amount
+    channel.their_balance -= amount
+    return channel
 
-    def __init__(self, my_index=0, sig=b'', redeem=b''):
-        if my_index == b'':
-            my_index = 0
-        if my_index not in [0, 1]:
-            raise Exception("Unknown index", my_index)
-        self.my_index = my_index
-        self.sig = sig
-        self.redeem = CScript(redeem)
-
-    @classmethod
-    def from_script(cls, script):
-        """Construct an AnchorScriptSig from a CScript."""
-        script = list(script)
-        assert len(script) == 4
-        if script[1] == OP_PUBKEY:
-            return cls(0, script[2], script[3])
-        elif script[2] == OP_PUBKEY:
-            return cls(1, script[1], script[3])
-        else:
-            raise Exception("Could not find OP_PUBKEY")
-
-    def to_script(self, sig=OP_PUBKEY):
-        """Construct a CScript from an AnchorScriptSig."""
-        if self.my_index == 0:
-            sig1, sig2 = sig, self.sig
-        elif self.my_index == 1:
-            sig1, sig2 = self.sig, sig
+def sign_at(channel_id, number):
+    """Sign their commitment after update number, if every update is known.
+
+    Return None if an update up to number has not been numbered yet.
+    """
+    with channel_lock(channel_id):
+        channel = state_at(channel_id, number)
+    return None if channel is None else channel.commitment_signature()
+
+def numbered(channel_id, number):
+    """Return True if every update up to number is numbered, otherwise None."""
+    with channel_lock(channel_id):
+        if number <= cached(channel_id).commitment_number or \
+           state_at(channel_id, number) is not None:
+            return True
+        return None
+
+def apply_ready(channel_id):
+    """Apply pending updates, in order, until one is missing a signature."""
+    channel = load(channel_id)
+    updates = pending(channel_id)
+    while True:
+        pending_update = updates.get(channel.commitment_number + 1)
+        if pending_update is None:
+            break
+        # A voided update leaves the commitment, and so the signature, alone
+        if pending_update.amount != 0:
+            if pending_update.their_sig is None:
+                break
+            channel.our_balance += pending_update.amount
+            channel.their_balance -= pending_update.amount
+            channel.check_commitment_sig(pending_update.their_sig)
+            channel.their_sig = pending_update.their_sig
+        channel.commitment_number = pending_update.number
+        database.session.delete(pending_update)
+        record(channel)
+    cache().commit(channel)
+    return channel.commitment_number
+
+def void(channel_id, number):
+    """Make update number in channel channel_id pay nothing.
+
+    Return False if it has already been applied. Must be called holding
+    the channel's lock.
+    """
+    if number <= cached(channel_id).commitment_number:
+        return False
+    pending_update = pending(channel_id).get(number)
+    if pending_update is None:
+        database.session.add(PendingUpdate(channel_id=channel_id,
+                                           number=number, amount=0,
+                                           ours=False, their_sig=None))
+    else:
+        pending_update.amount = 0
+        pending_update.ours, pending_update.their_sig = False, None
+    database.session.commit()
+    apply_ready(channel_id)
+    return True
+
+def abandon(channel_id, update_id, amount):
+    """Give up on our update update_id of amount, which failed unapplied.
+
+    The update is voided here and by the counterparty, so neither node's
+    later updates wait for it. If the counterparty numbers our updates and
+    we never learned its number, it finds the update by amount.
+    """
+    channel = cached(channel_id)
+    bob = peer(channel.address)
+    anchor = channel.anchor_point.serialize()
+    with channel_lock(channel_id):
+        pending_update = PendingUpdate.query.populate_existing().get(update_id)
+        if pending_update is None or pending_update.amount == 0:
+            # Voided already, by the counterparty
+            return
+        number = pending_update.number
+        if number is None:
+            database.session.delete(pending_update)
+            database.session.commit()
+            known = [other.number for other in pending(channel_id).values()
+                     if other.ours]
         else:
-            raise Exception("Unknown index", self.my_index)
-        return CScript([0, sig1, sig2, self.redeem])
-
-class Channel(Model):
-    """Model of a payment channel."""
-
-    __tablename__ = 'channels'
-
-    address = Column(String, primary_key=True)
-    anchor_point = Column(ImmutableSerializableType(COutPoint),
-                          unique=True, index=True)
-    anchor_index = Column(Integer)
-    their_sig = Column(LargeBinary)
-    anchor_redeem = Column(LargeBinary)
-    our_balance = Column(Integer)
-    our_addr = Column(Base58DataType(CBitcoinAddress))
-    their_balance = Column(Integer)
-    their_addr = Column(Base58DataType(CBitcoinAddress))
-
-    def signature(self, transaction):
-        """Signature for a transaction."""
-        sighash = SignatureHash(CScript(self.anchor_redeem),
-                                transaction, 0, SIGHASH_ALL)
-        sig = g.seckey.sign(sighash) + bytes([SIGHASH_ALL])
-        return sig
-
-    def sign(self, transaction):
-        """Sign a transaction."""
-        sig = self.signature(transaction)
-        anchor_sig = AnchorScriptSig(self.anchor_index,
-                                     self.their_sig,
-                                     self.anchor_redeem)
-        transaction.vin[0].scriptSig = anchor_sig.to_script(sig)
-        # verify signing worked
-        VerifyScript(transaction.vin[0].scriptSig,
-                     CScript(self.anchor_redeem).to_p2sh_scriptPubKey(),
-                     transaction, 0, (SCRIPT_VERIFY_P2SH,))
-        return transaction
-
-    def commitment(self, ours=False):
-        """Return an unsigned commitment transaction."""
-        first = CMutableTxOut(self.our_balance, self.our_addr.to_scriptPubKey())
-        second = CMutableTxOut(self.their_balance, self.their_addr.to_scriptPubKey())
-        if not ours:
-            first, second = second, first
-        return CMutableTransaction([CMutableTxIn(self.anchor_point)],
-                                   [first, second])
-
-    def settlement(self):
-        """Generate the settlement transaction."""
-        # Put outputs in the order of the inputs, so that both versions are the same
-        first = CMutableTxOut(self.our_balance,
-                              self.our_addr.to_scriptPubKey())
-        second = CMutableTxOut(self.their_balance,
-                               self.their_addr.to_scriptPubKey())
-        if self.anchor_index == 0:
-            pass
-        elif self.anchor_index == 1:
-            first, second = second, first
+            void(channel_id, number)
+    try:
+        if number is None:
+            number = bob.abort_update(g.addr, anchor, None, amount, known)
+            if number is not None:
+                with channel_lock(channel_id):
+                    void(channel_id, number)
         else:
-            raise Exception("Unknown index", self.anchor_index)
-        return CMutableTransaction([CMutableTxIn(self.anchor_point)],
-                                   [first, second])
-
-def select_coins(amount):
-    """Get a txin set and change to spend amount."""
-    coins = g.bit.listunspent()
-    out = []
-    for coin in coins:
-        if not coin['spendable']:
-            continue
-        out.append(CMutableTxIn(coin['outpoint']))
-        amount -= coin['amount']
+            bob.abort_update(g.addr, anchor, number, amount, [])
+    except Exception: # pylint: disable=broad-except
+        current_app.logger.exception("Failed to abort update in channel %d",
+                                     channel_id)
+
+def applied(channel_id, number):
+    """Return True if update number has been applied, otherwise None."""
+    with channel_lock(channel_id):
+        return True if cached(channel_id).commitment_number >= number else None
+
+def window_open(channel_id):
+    """Return True if we may start another update, otherwise None."""
+    with channel_lock(channel_id):
+        ours = PendingUpdate.query.filter(
+            PendingUpdate.channel_id == channel_id,
+            PendingUpdate.ours == True).count() # pylint: disable=singleton-comparison
+    return True if ours < int(g.config['updatewindow']) else None
+
+def in_flight(channel_id, ours):
+    """Return the sum of the pending updates in channel channel_id.
+
+    With ours, those we are paying in (which are negative), otherwise
+    those the counterparty is paying in.
+    """
+    return database.session.query(func.sum(PendingUpdate.amount)).filter(
+        PendingUpdate.channel_id == channel_id,
+        PendingUpdate.ours == ours).scalar() or 0
+
+def available(url):
+    """Return [satoshis, id] for each channel with url, most first.
+
+    A channel's available balance is what it will have left once the
+    payments we have in flight in it are applied.
+    """
+    ids = list(cache().anchors(url).values())
+    if not ids:
+        raise Exception("No channel with", url)
+    # Our payments are pending updates with negative amounts
+    paying = dict(database.session.query(
+        PendingUpdate.channel_id, func.sum(PendingUpdate.amount)).filter(
+            PendingUpdate.channel_id.in_(ids),
+            PendingUpdate.ours == True # pylint: disable=singleton-comparison
+        ).group_by(PendingUpdate.channel_id))
+    balances = [[cached(channel_id).our_balance +
+                 paying.get(channel_id, 0), channel_id]
+                for channel_id in ids]
+    balances.sort(reverse=True)
+    return balances
+
+def split(url, amount):
+    """Choose the channels with url to pay amount in.
+
+    The channel with the most available is used if it can pay amount alone.
+    Otherwise amount is split between channels, most available first.
+    Return [(id, amount)].
+    """
+    parts = []
+    for balance, channel_id in available(url):
         if amount <= 0:
             break
+        part = min(balance, amount)
+        if part > 0:
+            parts.append((channel_id, part))
+            amount -= part
     if amount > 0:
-        raise Exception("Not enough money")
-    change = CMutableTxOut(
-        -amount, g.bit.getrawchangeaddress().to_scriptPubKey())
-    return out, change
-
-def anchor_script(my_pubkey, their_pubkey):
-    """Generate the output script for the anchor transaction."""
-    script = CScript([2, my_pubkey, their_pubkey, 2, OP_CHECKMULTISIG])
-    return script
-
-def get_pubkey():
-    """Get a new pubkey."""
-    return g.seckey.pub
-
-def update_db(address, amount, sig):
-    """Update the db for a payment."""
-    channel = Channel.query.get(address)
-    channel.our_balance += amount
-    channel.their_balance -= amount
-    channel.their_sig = sig
-    database.session.commit()
-    return channel.signature(channel.commitment())
+        raise Exception("Not enough money in channels with", url)
+    return parts
 
-def create(url, mymoney, theirmoney, fees=10000):
-    """Open a payment channel.
+def update(channel_id, amount):
+    """Pay amount in channel channel_id in a new update, and return its number.
 
-    After this method returns, a payment channel will have been established
-    with the node identified by url, in which you can send mymoney satoshis
-    and recieve theirmoney satoshis. Any blockchain fees involved in the
-    setup and teardown of the channel should be collected at this time.
+    Several updates may be in flight in a channel at once, up to the
+    updatewindow config option. Each returns once it, and every update
+    numbered before it, has been applied. The channel must afford amount
+    with the payments already in flight in it.
     """
-    bob = jsonrpcproxy.Proxy(url+'channel/')
-    # Choose inputs and change output
-    coins, change = select_coins(mymoney + 2 * fees)
-    pubkey = get_pubkey()
-    my_out_addr = g.bit.getnewaddress()
-    # Tell Bob we want to open a channel
-    transaction, redeem, their_out_addr = bob.open_channel(
-        g.addr, theirmoney, mymoney, fees,
-        coins, change,
-        pubkey, my_out_addr)
-    # Sign and send the anchor
-    transaction = g.bit.signrawtransaction(transaction)
-    assert transaction['complete']
-    transaction = transaction['tx']
-    g.bit.sendrawtransaction(transaction)
-    # Set up the channel in the DB
-    channel = Channel(address=url,
-                      anchor_point=COutPoint(transaction.GetHash(), 0),
-                      anchor_index=1,
-                      their_sig=b'',
-                      anchor_redeem=redeem,
-                      our_balance=mymoney,
-                      our_addr=my_out_addr,
-                      their_balance=theirmoney,
-                      their_addr=their_out_addr,
-                     )
-    # Exchange signatures for the inital commitment transaction
-    channel.their_sig = \
-        bob.update_anchor(g.addr, transaction.GetHash(),
-                          channel.signature(channel.commitment()))
-    database.session.add(channel)
-    database.session.commit()
-    # Event: channel opened
-    CHANNEL_OPENED.send('channel', address=url)
+    assert amount > 0
+    channel = cached(channel_id)
+    url = channel.address
+    anchor = channel.anchor_point.serialize()
+    bob = peer(url)
+    wait_for(lambda: window_open(channel_id), "update window")
+    with channel_lock(channel_id):
+        # Other payments may have started since this channel was chosen
+        if cached(channel_id).our_balance + in_flight(channel_id, True) < \
+           amount:
+            raise Exception("Not enough money in channel", channel_id)
+        number = next_number(cached(channel_id)) if is_sequencer(url) else None
+        pending_update = PendingUpdate(channel_id=channel_id, number=number,
+                                       amount=-amount, ours=True,
+                                       their_sig=None)
+        database.session.add(pending_update)
+        database.session.commit()
+        update_id = pending_update.id
+    try:
+        # ask Bob to sign our new commitment transaction
+        number, their_sig = bob.propose_update(g.addr, anchor, amount, number)
+        with channel_lock(channel_id):
+            pending_update = _unvoided(update_id, number)
+            pending_update.number = number
+            database.session.commit()
+        # sign Bob's new commitment transaction. The update can't be applied
+        # until we store Bob's signature, so we sign the state at number.
+        sig = wait_for(lambda: sign_at(channel_id, number),
+                       "update %d" % number)
+        with channel_lock(channel_id):
+            pending_update = _unvoided(update_id, number)
+            # A bad signature would stop every later update being applied
+            state_at(channel_id, number).check_commitment_sig(their_sig)
+            pending_update.their_sig = their_sig
+            database.session.commit()
+            apply_ready(channel_id)
+    except Exception:
+        abandon(channel_id, update_id, amount)
+        raise
+    # and tell Bob
+    deliver(bob, anchor, amount, sig, number)
+    wait_for(lambda: applied(channel_id, number), "update %d" % number)
+    return number
+
+def deliver(bob, anchor, amount, sig, number):
+    """Send Bob our signature for update number.
+
+    We have applied the update, so it can't be voided: Bob can't apply
+    any update after it until he has the signature. A call which fails on
+    the way is sent again, for up to updatetimeout seconds (recieve ignores
+    one sent again after it was applied); an error raised by Bob, or the
+    last failure, is raised.
+    """
+    deadline = time.monotonic() + float(g.config['updatetimeout'])
+    delay = 0.01
+    while True:
+        try:
+            bob.recieve(g.addr, anchor, amount, sig, number)
+            return
+        except jsonrpcproxy.TRANSPORT_ERRORS:
+            if time.monotonic() + delay > deadline:
+                raise
+            current_app.logger.warning(
+                "Failed to send update %d, retrying", number, exc_info=True)
+            time.sleep(delay)
+            delay = min(2 * delay, 1.0)
+
+def _unvoided(update_id, number):
+    """Return our pending update update_id, unless it has been voided."""
+    pending_update = PendingUpdate.query.populate_existing().get(update_id)
+    if pending_update is None or pending_update.amount == 0:
+        raise Exception("Update voided", number)
+    return pending_update
+
+class _Batch(object):
+    """Payments to one node waiting to be sent together."""
+
+    def __init__(self):
+        self.amounts = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.receipts = None
+        self.error = None
+
+class Coalescer(object):
+    """Merge sends to the same node which arrive within a short window.
+
+    The first send to arrive waits up to window seconds, or until size
+    payments have joined it, then sends them all with send_many. Only
+    sends made by threads of the same process can be merged.
+    """
+
+    def __init__(self):
+        self._lock, self._batches = None, {}
+        self._check_fork = after_fork(self._reset)
+        self._check_fork()
+
+    def _reset(self):
+        """Forget batches gathered by a parent process."""
+        self._lock = threading.Lock()
+        self._batches = {}
+
+    def send(self, url, amount, window, size):
+        """Send amount to url as part of a batch, and return its receipt."""
+        self._check_fork()
+        with self._lock:
+            batch = self._batches.get(url)
+            leader = batch is None
+            if leader:
+                batch = self._batches[url] = _Batch()
+            index = len(batch.amounts)
+            batch.amounts.append(amount)
+            if len(batch.amounts) >= size:
+                del self._batches[url]
+                batch.full.set()
+        if leader:
+            batch.full.wait(window)
+            with self._lock:
+                if self._batches.get(url) is batch:
+                    del self._batches[url]
+            try:
+                batch.receipts = send_many(url, batch.amounts)
+            except Exception as err: # pylint: disable=broad-except
+                batch.error = err
+            batch.done.set()
+        else:
+            batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+        return batch.receipts[index]
+
+COALESCER = Coalescer()
 
 def send(url, amount):
     """Send coin in the channel.
 
-    Negotiate the update of the channel opened with node url paying that node
-    amount more satoshis than before. No fees should be collected by this
-    method.
+    Negotiate the update of the channels opened with node url paying that
+    node amount more satoshis than before. No fees should be collected by
+    this method.
+
+    The payment is made in the channel with the most available, if it can
+    afford it. Otherwise it is split between channels (see split), and
+    parts already paid are not undone if a later part fails.
+
+    If the coalescems config option is set, sends to url arriving within
+    that many milliseconds (up to coalescesize of them) share one update.
+    """
+    parts = split(url, amount)
+    window = int(g.config['coalescems'])
+    if window > 0 and len(parts) == 1:
+        COALESCER.send(url, amount, window / 1000,
+                       int(g.config['coalescesize']))
+    else:
+        for channel_id, part in parts:
+            update(channel_id, part)
+
+def send_many(url, amounts):
+    """Send a batch of payments to the node at url.
+
+    The payments are netted into one commitment update, with one exchange of
+    signatures, in the channel with the most available. If it can't afford
+    them all, each payment is given to the channel with the most left, and
+    each channel used makes one update. Return a receipt for each payment,
+    in order: a dict of the address, the anchor of the channel which paid
+    it (as txid:n), the amount, and the number of the update which paid it.
     """
-    bob = jsonrpcproxy.Proxy(url+'channel/')
-    # ask Bob to sign the new commitment transactions, and update.
-    sig = update_db(url, -amount, bob.propose_update(g.addr, amount))
-    # tell Bob our signature
-    bob.recieve(g.addr, amount, sig)
+    if not amounts:
+        return []
+    assert all(amount > 0 for amount in amounts)
+    balances = available(url)
+    if balances[0][0] >= sum(amounts):
+        assigned = {balances[0][1]: list(range(len(amounts)))}
+    else:
+        assigned = {}
+        for index in sorted(range(len(amounts)),
+                            key=lambda index: -amounts[index]):
+            balance = max(balances)
+            if balance[0] < amounts[index]:
+                raise Exception("Not enough money in any channel with", url)
+            balance[0] -= amounts[index]
+            assigned.setdefault(balance[1], []).append(index)
+    receipts = [None] * len(amounts)
+    for channel_id, indexes in assigned.items():
+        anchor = cached(channel_id).anchor_point
+        number = update(channel_id, sum(amounts[index] for index in indexes))
+        for index in indexes:
+            receipts[index] = {
+                'address': url, 'amount': amounts[index],
+                'anchor': '%s:%d' % (b2lx(anchor.hash), anchor.n),
+                'commitment': number}
+    return receipts
 
 def getbalance(url):
-    """Get the balance of funds in a payment channel.
+    """Get the balance of funds in the payment channels with url.
 
-    This returns the number of satoshis you can spend in the channel
+    This returns the number of satoshis you can spend in all the channels
     with the node at url. This should have no side effects.
     """
-    return Channel.query.get(url).our_balance
+    return sum(channel.our_balance for channel in channels(url))
 
 def getcommitmenttransactions(url):
-    """Get the current commitment transactions in a payment channel."""
-    channel = Channel.query.get(url)
-    commitment = channel.sign(channel.commitment(ours=True))
-    return [commitment,]
+    """Get the current commitment transactions in the payment channels.
+
+    They are signed to be broadcast, so they are verified whatever the
+    verifysigs policy.
+    """
+    selected = channels(url)
+    transactions = [channel.commitment(ours=True) for channel in selected]
+    sigs = hash_signatures(channel.signature_hash(transaction)
+                           for channel, transaction
+                           in zip(selected, transactions))
+    return [channel.sign(transaction, broadcast=True, sig=sig)
+            for channel, transaction, sig
+            in zip(selected, transactions, sigs)]
 
 def close(url):
-    """Close a channel.
-
-    Close the currently open channel with node url. Any funds in the channel
-    are paid to the wallet, along with any fees collected by create which
-    were unnecessary."""
-    bob = jsonrpcproxy.Proxy(url+'channel/')
-    channel = Channel.query.get(url)
-    # Tell Bob we are closing the channel, and sign the settlement tx
-    bob.close_channel(g.addr, channel.signature(channel.settlement()))
-    database.session.delete(channel)
-    database.session.commit()
+    """Close the channels with url.
+
+    Close every currently open channel with node url. Any funds in the
+    channels are paid to the wallet, along with any fees collected by create
+    which were unnecessary."""
+    bob = peer(url)
+    selected = channels(url)
+    sigs = hash_signatures(channel.settlement_sighash()
+                           for channel in selected)
+    for channel, sig in zip(selected, sigs):
+        # Tell Bob we are closing the channel, and sign the settlement tx
+        bob.close_channel(g.addr, channel.anchor_point.serialize(), sig)
+        with channel_lock(channel.id):
+            database.session.delete(load(channel.id))
+            PendingUpdate.query.filter(
+                PendingUpdate.channel_id == channel.id).delete()
+            cache().delete(channel)
+            history.remove_log(history_path(channel.id))
 
 @REMOTE
 def info():
@@ -276,75 +553,88 @@ def get_address():
     return str(g.bit.getnewaddress())
 
 @REMOTE
-def open_channel(address, mymoney, theirmoney, fees, their_coins, their_change, their_pubkey, their_out_addr): # pylint: disable=too-many-arguments, line-too-long
-    """Open a payment channel."""
-    # Get inputs and change output
-    coins, change = select_coins(mymoney + 2 * fees)
-    # Make the anchor script
-    anchor_output_script = anchor_script(get_pubkey(), their_pubkey)
-    # Construct the anchor utxo
-    payment = CMutableTxOut(mymoney + theirmoney + 2 * fees,
-                            anchor_output_script.to_p2sh_scriptPubKey())
-    # Anchor tx
-    transaction = CMutableTransaction(
-        their_coins + coins,
-        [payment, change, their_change])
-    # Half-sign
-    transaction = g.bit.signrawtransaction(transaction)['tx']
-    # Create channel in DB
-    our_addr = g.bit.getnewaddress()
-    channel = Channel(address=address,
-                      anchor_point=COutPoint(transaction.GetHash(), 0),
-                      anchor_index=0,
-                      their_sig=b'',
-                      anchor_redeem=anchor_output_script,
-                      our_balance=mymoney,
-                      our_addr=our_addr,
-                      their_balance=theirmoney,
-                      their_addr=their_out_addr,
-                     )
-    database.session.add(channel)
-    database.session.commit()
-    # Event: channel opened
-    CHANNEL_OPENED.send('channel', address=address)
-    return (transaction, anchor_output_script, our_addr)
+def propose_update(address, anchor, amount, number=None):
+    """Sign their commitment transaction after they pay us amount.
 
-@REMOTE
-def update_anchor(address, new_anchor, their_sig):
-    """Update the anchor txid after both have signed."""
-    channel = Channel.query.get(address)
-    channel.anchor_point = COutPoint(new_anchor, channel.anchor_point.n)
-    channel.their_sig = their_sig
-    database.session.commit()
-    return channel.signature(channel.commitment())
+    anchor is the channel's serialized anchor. number is the update's
+    commitment number, or None if we are the sequencer and should number
+    it. Return the number and the signature. An update they can't afford,
+    with the payments they already have in flight, is refused.
+    """
+    assert amount > 0
+    channel_id = find(address, anchor)
+    with channel_lock(channel_id):
+        channel = cached(channel_id)
+        if channel.their_balance - in_flight(channel_id, False) < amount:
+            raise Exception("Not enough money in channel", address)
+        if is_sequencer(address):
+            assert number is None
+            number = next_number(channel)
+        else:
+            assert number > channel.commitment_number
+            assert number not in pending(channel_id)
+        database.session.add(PendingUpdate(channel_id=channel_id,
+                                           number=number, amount=amount,
+                                           ours=False, their_sig=None))
+        database.session.commit()
+    return number, wait_for(lambda: sign_at(channel_id, number),
+                            "update %d" % number)
 
 @REMOTE
-def propose_update(address, amount):
-    """Sign commitment transactions."""
-    channel = Channel.query.get(address)
-    assert amount > 0
-    channel.our_balance += amount
-    channel.their_balance -= amount
-    # don't persist yet
-    sig = channel.signature(channel.commitment())
-    channel.our_balance -= amount
-    channel.their_balance += amount
-    return sig
+def recieve(address, anchor, amount, sig, number):
+    """Recieve money, given their signature for our commitment."""
+    channel_id = find(address, anchor)
+    # Our own updates before it may not have learned their numbers yet
+    wait_for(lambda: numbered(channel_id, number), "update %d" % number)
+    with channel_lock(channel_id):
+        if number <= cached(channel_id).commitment_number:
+            # Sent again, after it was applied
+            return
+        pending_update = pending(channel_id)[number]
+        assert pending_update.amount == amount
+        # Refuse a bad signature, which kept would stop every later update
+        state_at(channel_id, number).check_commitment_sig(sig)
+        pending_update.their_sig = sig
+        database.session.commit()
+        apply_ready(channel_id)
 
 @REMOTE
-def recieve(address, amount, sig):
-    """Recieve money."""
-    update_db(address, amount, sig)
+def abort_update(address, anchor, number, amount, known):
+    """Void an update from address which failed, and return its number.
+
+    If number is None, they never learned the number we gave it: void the
+    lowest update of amount from them which they have not signed for and
+    whose number is not in known. Return None if there is none, or it has
+    been applied.
+    """
+    channel_id = find(address, anchor)
+    with channel_lock(channel_id):
+        if number is None:
+            candidates = sorted(
+                update.number for update in pending(channel_id).values()
+                if not update.ours and update.their_sig is None and
+                update.amount == amount and update.number not in known)
+            if not candidates:
+                return None
+            number = candidates[0]
+        return number if void(channel_id, number) else None
 
 @REMOTE
-def close_channel(address, their_sig):
-    """Close a channel."""
-    channel = Channel.query.get(address)
-    # Sign and send settlement tx
-    my_sig = channel.signature(channel.settlement())
-    channel.their_sig = their_sig
-    transaction = channel.sign(channel.settlement())
-    g.bit.sendrawtransaction(transaction)
-    database.session.delete(channel)
-    database.session.commit()
-    return my_sig
+def close_channel(address, anchor, their_sig):
+    """Close the channel with address anchored at anchor (serialized)."""
+    channel_id = find(address, anchor)
+    with channel_lock(channel_id):
+        channel = load(channel_id)
+        # Sign and send settlement tx
+        my_sig = channel.settlement_signature()
+        channel.check_settlement_sig(their_sig)
+        channel.their_sig = their_sig
+        transaction = channel.sign(channel.settlement(), broadcast=True,
+                                   sig=my_sig)
+        g.bit.sendrawtransaction(transaction)
+        database.session.delete(channel)
+        PendingUpdate.query.filter(
+            PendingUpdate.channel_id == channel_id).delete()
+        cache().delete(channel)
+        history.remove_log(history_path(channel_id))
+        return my_sig
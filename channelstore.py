@@ -0,0 +1,630 @@
+"""The channel API's tables, and the channel rows kept in them.
+
+API, REMOTE, Model -- the channel API (see serverutil.api_factory), whose
+                      tables are defined here and in coins.py and watcher.py
+Channel -- a channel's row in table CHANNELS
+PendingUpdate -- an update in table PENDING_UPDATES (see channel.py)
+load(channel_id) -- load a row to change it, holding channel_lock
+cache(), cached(channel_id) -- copies of the rows, current in every process
+record(channel) -- log a channel's state in its history
+recover() -- replay journaled changes which the database lost
+
+Database:
+The schema is currently one row for each channel in table CHANNELS
+(channel_channels in the node's database, see serverutil.api_factory).
+id: our number for the channel
+address: url for the counterpary
+anchor_point: the anchor output, by which both nodes know the channel
+our_script, their_script: scriptPubKeys paying out our and their balances
+
+Payout addresses are stored as their scriptPubKeys (our_script,
+their_script), so building a commitment decodes no Base58.
+migrate_database brings a channel.dat from earlier versions up to date,
+before its tables are imported into the node's database.
+
+Every change to a channel's row is made holding that channel's lock (see
+channel_lock), which excludes other threads and server processes, and the
+row is reloaded once the lock is held.
+
+Channels are only read from the database when they have changed: each
+process keeps copies of channels (see ChannelCache), written through on
+every change, and shared generation counters tell other processes their
+copies are stale.
+
+Every state a channel has been in is kept in its history log (see
+history.py), so a revoked commitment can be recognised; the log is
+compacted once it holds twice historykeep states.
+
+Changes to channels are written ahead to a journal (see channel_journal),
+which concurrent writers sync together, rather than syncing the database on
+every commit. Each process replays the journal before serving (see
+recover), restoring any change the database lost, and records are dropped
+once a database checkpoint has made them durable (see checkpoint). The
+durability config option chooses between this (group), syncing the
+database as before (full), and never syncing (os).
+"""
+
+import os
+import os.path
+import functools
+import threading
+from contextlib import ExitStack
+from sqlalchemy import Column, Integer, String, LargeBinary, Boolean
+from sqlalchemy import MetaData
+from flask import g, current_app
+from bitcoin.core import COutPoint
+from bitcoin.core.script import CScript, SignatureHash, SIGHASH_ALL
+from bitcoin.wallet import CBitcoinAddress
+import history
+import journal
+from serverutil import api_factory, after_fork
+from serverutil import database, LOCKS, GenerationCounters
+from serverutil import ImmutableSerializableType, upgrades_legacy
+from transactions import AnchorScriptSig, commitment_template, VERIFIER
+from transactions import signature_valid, hash_signatures
+
+API, REMOTE, Model = api_factory('channel')
+
+class Channel(Model):
+    """Model of a payment channel."""
+
+    __tablename__ = 'channels'
+
+    id = Column(Integer, primary_key=True)
+    address = Column(String, index=True)
+    anchor_point = Column(ImmutableSerializableType(COutPoint),
+                          unique=True, index=True)
+    anchor_index = Column(Integer)
+    their_sig = Column(LargeBinary)
+    anchor_redeem = Column(LargeBinary)
+    our_balance = Column(Integer)
+    our_script = Column(LargeBinary)
+    their_balance = Column(Integer)
+    their_script = Column(LargeBinary)
+    commitment_number = Column(Integer, default=0)
+    # The txid which spent the anchor, and the hash of its block
+    spent_by = Column(String)
+    spent_in = Column(String, index=True)
+
+    @property
+    def our_addr(self):
+        """Our payout address."""
+        return CBitcoinAddress.from_scriptPubKey(CScript(self.our_script))
+
+    @property
+    def their_addr(self):
+        """Their payout address."""
+        return CBitcoinAddress.from_scriptPubKey(CScript(self.their_script))
+
+    def signature_hash(self, transaction):
+        """Return the SIGHASH_ALL sighash of a transaction."""
+        return SignatureHash(CScript(self.anchor_redeem),
+                             transaction, 0, SIGHASH_ALL)
+
+    def signature(self, transaction):
+        """Signature for a transaction."""
+        return self.hash_signature(self.signature_hash(transaction))
+
+    def sign(self, transaction, broadcast=False, sig=None):
+        """Sign a transaction.
+
+        The signed transaction's scripts are verified according to the
+        verifysigs policy (see Verifier); pass broadcast if it will be sent.
+        Pass sig if our signature of transaction is already known.
+        """
+        if sig is None:
+            sig = self.signature(transaction)
+        anchor_sig = AnchorScriptSig(self.anchor_index,
+                                     self.their_sig,
+                                     self.anchor_redeem)
+        transaction.vin[0].scriptSig = anchor_sig.to_script(sig)
+        # verify signing worked
+        if VERIFIER.wanted(broadcast):
+            VERIFIER.run('script', lambda: g.signer.verify_script(
+                transaction.vin[0].scriptSig,
+                CScript(self.anchor_redeem).to_p2sh_scriptPubKey(),
+                transaction).result())
+        else:
+            VERIFIER.skip()
+        return transaction
+
+    @property
+    def their_pubkey(self):
+        """Their pubkey in the anchor's 2 of 2 multisig."""
+        return list(CScript(self.anchor_redeem))[2 - self.anchor_index]
+
+    def check_their_sig(self, sighash, sig):
+        """Raise an exception unless sig is their signature of sighash."""
+        if not signature_valid(self.their_pubkey, sighash, sig):
+            raise Exception("Bad signature from", self.address)
+
+    def check_commitment_sig(self, sig):
+        """Check their signature of our current commitment."""
+        self.check_their_sig(self.commitment_sighash(ours=True), sig)
+
+    def check_settlement_sig(self, sig):
+        """Check their signature of the settlement."""
+        self.check_their_sig(self.settlement_sighash(), sig)
+
+    @staticmethod
+    def hash_signature(sighash):
+        """Signature for a transaction, given its SIGHASH_ALL sighash."""
+        return hash_signatures([sighash])[0]
+
+    def commitment_outputs(self, ours=False):
+        """Return the (value, scriptPubKey) outputs of a commitment."""
+        outputs = [(self.our_balance, self.our_script),
+                   (self.their_balance, self.their_script)]
+        if not ours:
+            outputs.reverse()
+        return outputs
+
+    def settlement_outputs(self):
+        """Return the (value, scriptPubKey) outputs of the settlement."""
+        # Put outputs in the order of the inputs, so that both versions are the same
+        outputs = [(self.our_balance, self.our_script),
+                   (self.their_balance, self.their_script)]
+        if self.anchor_index == 0:
+            pass
+        elif self.anchor_index == 1:
+            outputs.reverse()
+        else:
+            raise Exception("Unknown index", self.anchor_index)
+        return outputs
+
+    def template(self, outputs):
+        """Return the template for a transaction paying outputs."""
+        (_, first), (_, second) = outputs
+        return commitment_template(self.anchor_point,
+                                   bytes(self.anchor_redeem),
+                                   bytes(first), bytes(second))
+
+    def commitment(self, ours=False):
+        """Return an unsigned commitment transaction."""
+        outputs = self.commitment_outputs(ours)
+        return self.template(outputs).transaction(outputs[0][0],
+                                                  outputs[1][0])
+
+    def commitment_sighash(self, ours=False):
+        """Sighash of a commitment transaction, without building it."""
+        outputs = self.commitment_outputs(ours)
+        return self.template(outputs).sighash(outputs[0][0], outputs[1][0])
+
+    def commitment_signature(self, ours=False):
+        """Signature for a commitment transaction, without building it."""
+        return self.hash_signature(self.commitment_sighash(ours))
+
+    def settlement(self):
+        """Generate the settlement transaction."""
+        outputs = self.settlement_outputs()
+        return self.template(outputs).transaction(outputs[0][0],
+                                                  outputs[1][0])
+
+    def settlement_sighash(self):
+        """Sighash of the settlement transaction, without building it."""
+        outputs = self.settlement_outputs()
+        return self.template(outputs).sighash(outputs[0][0], outputs[1][0])
+
+    def settlement_signature(self):
+        """Signature for the settlement transaction, without building it."""
+        return self.hash_signature(self.settlement_sighash())
+
+class PendingUpdate(Model):
+    """Model of a channel update which has not yet been applied."""
+
+    __tablename__ = 'pending_updates'
+
+    id = Column(Integer, primary_key=True)
+    channel_id = Column(Integer, index=True)
+    # None until the sequencer has numbered it
+    number = Column(Integer)
+    # Satoshis paid to us (negative when we pay)
+    amount = Column(Integer)
+    ours = Column(Boolean)
+    # Their signature for our commitment after this update
+    their_sig = Column(LargeBinary)
+
+@upgrades_legacy('channel')
+def migrate_database(engine):
+    """Bring the tables in an old channel.dat up to date.
+
+    engine is for the file, whose tables are named without the channel
+    prefix, and which is then imported (see serverutil.import_legacy).
+    """
+    columns = [row[1] for row in engine.execute('PRAGMA table_info(channels)')]
+    pending_columns = [row[1] for row in
+                       engine.execute('PRAGMA table_info(pending_updates)')]
+    with engine.begin() as connection:
+        if 'commitment_number' not in columns:
+            connection.execute('ALTER TABLE channels ADD COLUMN '
+                               'commitment_number INTEGER DEFAULT 0')
+        if 'our_script' not in columns:
+            # Addresses were stored in Base58
+            connection.execute('ALTER TABLE channels ADD COLUMN our_script BLOB')
+            connection.execute(
+                'ALTER TABLE channels ADD COLUMN their_script BLOB')
+            rows = connection.execute(
+                'SELECT address, our_addr, their_addr FROM channels').fetchall()
+            for address, our_addr, their_addr in rows:
+                connection.execute(
+                    'UPDATE channels SET our_script = ?, their_script = ? '
+                    'WHERE address = ?',
+                    bytes(CBitcoinAddress(our_addr).to_scriptPubKey()),
+                    bytes(CBitcoinAddress(their_addr).to_scriptPubKey()),
+                    address)
+        if 'id' not in columns:
+            # Channels were keyed by address, one for each counterparty.
+            # SQLite can't change a primary key, so rebuild the table.
+            existing = [row[1] for row in
+                        connection.execute('PRAGMA table_info(channels)')]
+            copied = ', '.join(column for column in ChannelCache.COLUMNS
+                               if column in existing)
+            connection.execute('DROP INDEX IF EXISTS ix_channels_anchor_point')
+            connection.execute('ALTER TABLE channels RENAME TO channels_old')
+            Channel.__table__.tometadata(
+                MetaData(), name='channels').create(connection)
+            connection.execute('INSERT INTO channels (%s) SELECT %s '
+                               'FROM channels_old' % (copied, copied))
+            connection.execute('DROP TABLE channels_old')
+        elif 'spent_by' not in columns:
+            connection.execute('ALTER TABLE channels ADD COLUMN spent_by TEXT')
+            connection.execute('ALTER TABLE channels ADD COLUMN spent_in TEXT')
+            connection.execute(
+                'CREATE INDEX ix_channels_spent_in ON channels (spent_in)')
+        if pending_columns and 'channel_id' not in pending_columns:
+            connection.execute(
+                'ALTER TABLE pending_updates ADD COLUMN channel_id INTEGER')
+            connection.execute(
+                'UPDATE pending_updates SET channel_id = (SELECT id FROM '
+                'channels WHERE channels.address = pending_updates.address)')
+            connection.execute('CREATE INDEX ix_pending_updates_channel_id '
+                               'ON pending_updates (channel_id)')
+
+# datadirs whose journal this process, or its parent, has replayed
+RECOVERED = set()
+
+@API.before_app_request
+def recover_before_serving():
+    """Replay the channel journal before the first request (see recover).
+
+    Processes forked afterwards inherit RECOVERED, so a server replays it
+    once, before it forks to serve (see lightningd.serve).
+    """
+    if g.config['datadir'] not in RECOVERED:
+        recover()
+        RECOVERED.add(g.config['datadir'])
+
+def channel_lock(channel_id):
+    """Return a context manager holding the lock on channel channel_id."""
+    return LOCKS.hold(os.path.join(g.config['datadir'], 'locks'),
+                      'channel-%d' % channel_id)
+
+def new_channel_lock():
+    """Return a context manager holding the lock on adding channels.
+
+    A new channel's row is flushed, journaled and committed holding it, and
+    recover restores missing rows holding it, so neither sees the other's
+    row half written.
+    """
+    return LOCKS.hold(os.path.join(g.config['datadir'], 'locks'),
+                      'new channels')
+
+def load(channel_id):
+    """Load channel channel_id, discarding any stale copy."""
+    return Channel.query.populate_existing().get(channel_id)
+
+class ChannelCache(object):
+    """Copies of the channels in a datadir, shared by a process's threads.
+
+    get returns a new transient Channel for each call, so callers may modify
+    it freely. Changes must be made to the row (see load) and committed with
+    commit, or followed by forget if the row was deleted.
+
+    The anchors of the channels with each counterparty are kept too, as is
+    an index of every anchor (see anchor_index). They are reloaded when a
+    channel is added, anchored, spent or deleted.
+    """
+
+    COLUMNS = [column.name for column in Channel.__table__.columns]
+
+    def __init__(self, datadir):
+        self.generations = GenerationCounters(
+            os.path.join(datadir, 'channels.gen'))
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._peers = {}
+        self._index = None
+
+    def get(self, channel_id):
+        """Return a copy of channel channel_id, or None."""
+        # Read the generation first, so a change made while we load is seen
+        generation = self.generations.get('channel-%d' % channel_id)
+        with self._lock:
+            entry = self._entries.get(channel_id)
+        if entry is None or entry[0] != generation:
+            channel = load(channel_id)
+            if channel is None:
+                return None
+            entry = (generation, self._snapshot(channel))
+            with self._lock:
+                self._entries[channel_id] = entry
+        return Channel(**entry[1])
+
+    def anchors(self, address):
+        """Return {serialized anchor: id} for the channels with address.
+
+        Channels which are not yet anchored, or whose anchors have been
+        spent, are left out.
+        """
+        generation = self.generations.get('peer ' + address)
+        with self._lock:
+            entry = self._peers.get(address)
+        if entry is None or entry[0] != generation:
+            rows = database.session.query(
+                Channel.id, Channel.anchor_point).filter(
+                    Channel.address == address,
+                    Channel.anchor_point != None, # pylint: disable=singleton-comparison
+                    Channel.spent_by == None) # pylint: disable=singleton-comparison
+            entry = (generation, {anchor_point.serialize(): channel_id
+                                  for channel_id, anchor_point in rows})
+            with self._lock:
+                self._peers[address] = entry
+        return dict(entry[1])
+
+    def anchor_index(self):
+        """Return {serialized anchor: id} for every anchored channel.
+
+        The dict is shared, and must not be modified.
+        """
+        generation = self.generations.get('anchors')
+        with self._lock:
+            entry = self._index
+        if entry is None or entry[0] != generation:
+            rows = database.session.query(
+                Channel.id, Channel.anchor_point).filter(
+                    Channel.anchor_point != None) # pylint: disable=singleton-comparison
+            entry = (generation, {anchor_point.serialize(): channel_id
+                                  for channel_id, anchor_point in rows})
+            with self._lock:
+                self._index = entry
+        return entry[1]
+
+    def commit(self, channel):
+        """Commit the database session, including changes to channel.
+
+        The channel's new state is journaled first (see channel_journal).
+        If the commit fails, the session is rolled back and the row as the
+        database has it is journaled after it, so recover won't restore a
+        state which was never committed.
+        """
+        log = channel_journal()
+        if channel.id is None:
+            # Flush first, so a new channel has its id. Otherwise nothing
+            # is written until the journal is synced, so other channels'
+            # writers aren't kept waiting on the database while we are.
+            with new_channel_lock():
+                database.session.flush()
+                snapshot = self._write(log, channel)
+        else:
+            snapshot = self._write(log, channel)
+        generation = self.generations.bump('channel-%d' % channel.id)
+        with self._lock:
+            previous = self._entries.get(channel.id)
+            self._entries[channel.id] = (generation, snapshot)
+        if previous is None or \
+           previous[1]['anchor_point'] != snapshot['anchor_point'] or \
+           previous[1]['spent_by'] != snapshot['spent_by']:
+            self.generations.bump('peer ' + channel.address)
+            self.generations.bump('anchors')
+        if log is not None:
+            maybe_checkpoint(log)
+
+    def _write(self, log, channel):
+        """Journal and commit channel's state, returning its snapshot."""
+        snapshot = self._snapshot(channel)
+        if log is not None:
+            log.commit(log.append(journal_record(channel.id, snapshot)))
+        self._commit_or_abort(log, channel.id)
+        return snapshot
+
+    def delete(self, channel):
+        """Commit the database session, which deletes channel."""
+        log = channel_journal()
+        if log is not None:
+            log.commit(log.append(journal_record(channel.id, None)))
+        self._commit_or_abort(log, channel.id)
+        self.forget(channel)
+
+    @staticmethod
+    def _commit_or_abort(log, channel_id):
+        """Commit the session, or journal channel_id's row if that fails."""
+        try:
+            database.session.commit()
+        except:
+            database.session.rollback()
+            if log is not None:
+                log.commit(log.append(journal_record(
+                    channel_id, _stored_row(channel_id))))
+            raise
+
+    def forget(self, channel):
+        """Record that channel has been deleted."""
+        self.generations.bump('channel-%d' % channel.id)
+        with self._lock:
+            self._entries.pop(channel.id, None)
+        self.generations.bump('peer ' + channel.address)
+        self.generations.bump('anchors')
+
+    @classmethod
+    def _snapshot(cls, channel):
+        """Return the column values of channel."""
+        return {name: getattr(channel, name) for name in cls.COLUMNS}
+
+CACHES = {}
+_CACHES_LOCK = threading.Lock()
+# A parent process's caches may hold locks its threads had
+_check_fork = after_fork(CACHES.clear)
+
+def cache():
+    """Return the ChannelCache for this node's datadir."""
+    datadir = g.config['datadir']
+    with _CACHES_LOCK:
+        _check_fork()
+        if datadir not in CACHES:
+            CACHES[datadir] = ChannelCache(datadir)
+        return CACHES[datadir]
+
+def cached(channel_id):
+    """Return a copy of channel channel_id, from memory if current."""
+    return cache().get(channel_id)
+
+def history_path(channel_id):
+    """Return the path of channel channel_id's history log."""
+    return os.path.join(g.config['datadir'], 'history',
+                        'channel-%d.log' % channel_id)
+
+def channel_history(channel_id):
+    """Return channel channel_id's history log (see history.HistoryLog)."""
+    path = history_path(channel_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return history.open_log(path)
+
+def record(channel):
+    """Log channel's current state, and compact the log if it has doubled.
+
+    Must be called holding the channel's lock.
+    """
+    log = channel_history(channel.id)
+    log.append(channel.commitment_number, channel.our_balance,
+               channel.their_balance, channel.their_sig)
+    keep = int(g.config['historykeep'])
+    if len(log) >= 2 * keep:
+        log.compact(keep)
+
+def channel_journal():
+    """Return this node's channel journal, or None if durability is full.
+
+    Each change to a channel's row is journaled before it is committed,
+    as the row's new column values (see journal_record), and the database
+    commits without syncing. Writers in every channel then share fsyncs of
+    the journal (see journal.py) instead of each syncing the database.
+    """
+    durability = g.config['durability']
+    if durability == 'full':
+        return None
+    return journal.open_journal(
+        os.path.join(g.config['datadir'], 'channel.journal'),
+        sync=durability == 'group')
+
+def journal_record(channel_id, snapshot):
+    """Return the journal record of a channel's columns, or its deletion."""
+    return journal.record(channel_id, _journal_values(snapshot))
+
+def _journal_values(snapshot):
+    """Return a snapshot's values as journaled, or None for no row."""
+    if snapshot is None:
+        return None
+    values = dict(snapshot)
+    if values['anchor_point'] is not None:
+        values['anchor_point'] = values['anchor_point'].serialize()
+    return [values[name] for name in ChannelCache.COLUMNS]
+
+def _stored():
+    """Return {id: values} for every channel in the database."""
+    engine = database.get_engine(current_app)
+    return {row['id']: _journal_values(row)
+            for row in engine.execute(Channel.__table__.select())}
+
+def _stored_row(channel_id):
+    """Return channel channel_id's row in the database, or None."""
+    engine = database.get_engine(current_app)
+    return engine.execute(Channel.__table__.select().where(
+        Channel.__table__.c.id == channel_id)).first()
+
+def _restore(channel_id, values):
+    """Make channel channel_id's row match values from the journal."""
+    row = load(channel_id)
+    if values is None:
+        if row is None:
+            return
+        database.session.delete(row)
+        PendingUpdate.query.filter(
+            PendingUpdate.channel_id == channel_id).delete()
+    else:
+        columns = dict(zip(ChannelCache.COLUMNS, values))
+        if columns['anchor_point'] is not None:
+            columns['anchor_point'] = COutPoint.deserialize(
+                columns['anchor_point'])
+        if row is None:
+            row = Channel(**columns)
+            database.session.add(row)
+        else:
+            for name, value in columns.items():
+                setattr(row, name, value)
+        # Updates up to the journaled state have been applied
+        PendingUpdate.query.filter(
+            PendingUpdate.channel_id == channel_id,
+            PendingUpdate.number <= row.commitment_number).delete()
+    database.session.commit()
+    cache().forget(row)
+
+def _replay(log, channel_id, values, present):
+    """Restore channel channel_id from log, if its row still differs.
+
+    The channel is checked again holding its lock, since another process
+    may have journaled a newer change since, which it commits before
+    releasing the lock. A channel without a row (present is False) may be
+    one another process is adding, so new_channel_lock is held too.
+    """
+    with ExitStack() as locks:
+        if not present:
+            locks.enter_context(new_channel_lock())
+        locks.enter_context(channel_lock(channel_id))
+        values = journal.latest(log.records()).get(channel_id, values)
+        row = load(channel_id)
+        if row is not None:
+            row = {name: getattr(row, name) for name in ChannelCache.COLUMNS}
+        if _journal_values(row) == values:
+            return False
+        _restore(channel_id, values)
+        return True
+
+def recover():
+    """Replay journaled changes which the database lost in a crash.
+
+    Every process does this before serving (see journal.recover and
+    _replay). Return the ids of the channels restored.
+
+    Only channels are journaled. Pending updates are not, and one lost
+    with the database is not renegotiated: like an update interrupted by
+    a crash, it stays pending until it is voided (see abort_update).
+    """
+    log = channel_journal()
+    if log is None:
+        return []
+    restored = journal.recover(log, _stored, functools.partial(_replay, log))
+    if restored:
+        checkpoint(log)
+    else:
+        maybe_checkpoint(log)
+    return restored
+
+def _wal_checkpoint():
+    """Copy the database's write-ahead log into it, and sync it."""
+    engine = database.get_engine(current_app)
+    busy, frames, copied = engine.execute(
+        'PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+    return not busy and copied == frames
+
+def checkpoint(log):
+    """Drop the records of changes which the database has made durable.
+
+    The database is read first, then checkpointed, so every change read
+    is on disk once the checkpoint completes (see journal.checkpoint).
+    """
+    return journal.checkpoint(log, _stored, _wal_checkpoint)
+
+def maybe_checkpoint(log):
+    """Checkpoint the journal if it has grown by journalsize bytes."""
+    journal.maybe_checkpoint(log, int(g.config['journalsize']),
+                             lambda: checkpoint(log))
@@ -0,0 +1,155 @@
+"""The wallet's coins, as channels are funded from them.
+
+select_coins -- reserve coins to spend an amount, and make change
+spend_coins -- record that reserved coins were spent
+release_coins -- release reserved coins
+coins_lock -- hold the lock on the coins table
+
+COINS caches the wallet's spendable coins (see CoinCache), so opening a
+channel does not scan the wallet. Coins are chosen with coinselect, and
+reserved while a channel is opened, so concurrent opens don't pick the
+same coins. The table is one of the channel blueprint's.
+"""
+
+import os
+import time
+import threading
+from sqlalchemy import Column, Integer, String, LargeBinary, Float, or_
+from flask import g
+from bitcoin.core import COutPoint, CMutableTxOut, CMutableTxIn, b2lx
+import coinselect
+from serverutil import database, LOCKS, GenerationCounters, BUS
+from serverutil import after_fork
+from serverutil import WALLET_NOTIFY, BLOCK_NOTIFY
+from channelstore import Model
+
+class Coin(Model):
+    """Model of a coin in the wallet which we may spend (see CoinCache)."""
+
+    __tablename__ = 'coins'
+
+    # Serialized, since primary keys must be sortable
+    outpoint = Column(LargeBinary, primary_key=True)
+    amount = Column(Integer)
+    reserved_until = Column(Float)
+    spent_by = Column(String, index=True)
+
+    @property
+    def prevout(self):
+        """The coin's COutPoint."""
+        return COutPoint.deserialize(self.outpoint)
+
+def coins_lock():
+    """Return a context manager holding the lock on the coins table."""
+    return LOCKS.hold(os.path.join(g.config['datadir'], 'locks'), 'coins')
+
+class CoinCache(object):
+    """The wallet's spendable coins, kept in table COINS.
+
+    The table is refreshed from listunspent only when bitcoind has told us
+    something may have changed since it was last refreshed by this process:
+    any block, or a wallet transaction we didn't broadcast ourselves. The
+    notifications bump a generation counter shared by every process.
+    """
+
+    def __init__(self, datadir):
+        self.generations = GenerationCounters(
+            os.path.join(datadir, 'coins.gen'), slots=16)
+        self._seen = None
+
+    def stale(self):
+        """Record that the wallet's coins may have changed."""
+        self.generations.bump('coins')
+
+    def refresh(self):
+        """Bring the table up to date with bitcoind, if it may be stale.
+
+        Must be called holding coins_lock. Reservations are kept.
+        """
+        # Read the generation first, so a change made while we scan is seen
+        generation = self.generations.get('coins')
+        if generation == self._seen:
+            return
+        unspent = {coin['outpoint'].serialize(): coin['amount']
+                   for coin in g.bit.listunspent() if coin['spendable']}
+        for coin in Coin.query.all():
+            if unspent.pop(coin.outpoint, None) is None:
+                database.session.delete(coin)
+            else:
+                # bitcoind knows of no spend
+                coin.spent_by = None
+        for outpoint, amount in unspent.items():
+            database.session.add(Coin(outpoint=outpoint, amount=amount))
+        database.session.commit()
+        self._seen = generation
+
+COIN_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+_check_fork = after_fork(COIN_CACHES.clear)
+
+def coin_cache():
+    """Return the CoinCache for this node's datadir."""
+    datadir = g.config['datadir']
+    with _CACHES_LOCK:
+        _check_fork()
+        if datadir not in COIN_CACHES:
+            COIN_CACHES[datadir] = CoinCache(datadir)
+        return COIN_CACHES[datadir]
+
+@BUS.connect(BLOCK_NOTIFY, sender='server')
+def on_block(dummy_sender, **dummy_kwargs):
+    """Coins may have confirmed, or been spent."""
+    coin_cache().stale()
+
+@BUS.connect(WALLET_NOTIFY, sender='server')
+def on_wallet_transaction(dummy_sender, tx, **dummy_kwargs):
+    """Coins may have changed, unless the transaction is our own spend."""
+    if Coin.query.filter(Coin.spent_by == tx).first() is None:
+        coin_cache().stale()
+
+def select_coins(amount):
+    """Reserve coins to spend amount, and make change.
+
+    Return a txin set, and a change output, or None if the excess is no
+    more than the changecost config option, and should be left as fees.
+    Coins are reserved for coinreserve seconds, or until they are spent
+    (see spend_coins) or released (see release_coins).
+    """
+    with coins_lock():
+        coin_cache().refresh()
+        now = time.time()
+        available = Coin.query.filter(
+            Coin.spent_by == None, # pylint: disable=singleton-comparison
+            or_(Coin.reserved_until == None, # pylint: disable=singleton-comparison
+                Coin.reserved_until < now)).all()
+        chosen, change = coinselect.select(
+            [(coin.amount, coin) for coin in available], amount,
+            int(g.config['changecost']))
+        if chosen is None:
+            raise Exception("Not enough money")
+        for coin in chosen:
+            coin.reserved_until = now + float(g.config['coinreserve'])
+        out = [CMutableTxIn(coin.prevout) for coin in chosen]
+        database.session.commit()
+    if change is not None:
+        change = CMutableTxOut(
+            change, g.bit.getrawchangeaddress().to_scriptPubKey())
+    return out, change
+
+def spend_coins(coins, transaction):
+    """Record that the txins coins were spent by transaction."""
+    with coins_lock():
+        for txin in coins:
+            coin = Coin.query.get(txin.prevout.serialize())
+            if coin is not None:
+                coin.spent_by = b2lx(transaction.GetHash())
+        database.session.commit()
+
+def release_coins(coins):
+    """Release the reservations on the txins coins."""
+    with coins_lock():
+        for txin in coins:
+            coin = Coin.query.get(txin.prevout.serialize())
+            if coin is not None:
+                coin.reserved_until = None
+        database.session.commit()
@@ -0,0 +1,91 @@
+"""Choose which coins to spend.
+
+select(coins, target, cost_of_change)
+- Choose from coins, a list of (value, key), enough to pay target satoshis.
+  Return the keys chosen and the value of the change output, or None if the
+  excess is at most cost_of_change, in which case it is left as fees.
+  Return (None, None) if the coins are not enough.
+branch_and_bound(values, target, cost_of_change)
+- Search for a set of values summing to between target and
+  target + cost_of_change, so no change output is needed.
+fewest_inputs(values, target)
+- Choose as few values as possible summing to at least target.
+
+Values are in satoshis. Fees are fixed by the caller (see anchors.create),
+so a coin's value is also its effective value.
+"""
+
+TRIES = 100000
+
+def branch_and_bound(values, target, cost_of_change, tries=TRIES):
+    """Return the indexes of values best matching target, or None.
+
+    The search is depth first over values in decreasing order, including
+    each before excluding it, abandoning branches which overshoot the window
+    or can no longer reach target. The match wasting least is kept, and
+    the search stops at an exact match or after tries steps.
+    """
+    order = sorted(range(len(values)), key=lambda index: -values[index])
+    remaining = sum(values)
+    if remaining < target:
+        return None
+    best, best_excess = None, None
+    included = []
+    total = 0
+    for _ in range(tries):
+        if total + remaining < target or total > target + cost_of_change:
+            backtrack = True
+        elif total >= target:
+            excess = total - target
+            if best is None or excess < best_excess:
+                best, best_excess = [order[depth] for depth, chosen
+                                     in enumerate(included) if chosen], excess
+                if excess == 0:
+                    break
+            backtrack = True
+        else:
+            # Include the next value
+            value = values[order[len(included)]]
+            included.append(True)
+            total += value
+            remaining -= value
+            backtrack = False
+        if backtrack:
+            # Undecide trailing exclusions, then exclude the last inclusion
+            while included and not included[-1]:
+                included.pop()
+                remaining += values[order[len(included)]]
+            if not included:
+                break
+            included[-1] = False
+            total -= values[order[len(included) - 1]]
+    return best
+
+def fewest_inputs(values, target):
+    """Return the indexes of as few values as reach target, or None.
+
+    One value is enough if any is at least target, and the smallest such
+    is chosen. Otherwise the largest values are taken until target is met.
+    """
+    enough = [index for index, value in enumerate(values) if value >= target]
+    if enough:
+        return [min(enough, key=lambda index: values[index])]
+    chosen, total = [], 0
+    for index in sorted(range(len(values)), key=lambda index: -values[index]):
+        chosen.append(index)
+        total += values[index]
+        if total >= target:
+            return chosen
+    return None
+
+def select(coins, target, cost_of_change):
+    """Choose coins for target. Return (keys, change value or None)."""
+    values = [value for value, _ in coins]
+    chosen = branch_and_bound(values, target, cost_of_change)
+    if chosen is None:
+        chosen = fewest_inputs(values, target)
+    if chosen is None:
+        return None, None
+    change = sum(values[index] for index in chosen) - target
+    return ([coins[index][1] for index in chosen],
+            change if change > cost_of_change else None)
@@ -7,7 +7,8 @@ including default values (currently not specified).
 lightning_config does the same for a lightning configuration file.
 
 bitcoin_proxy and lightning_proxy return RPC proxies to bitcoind and
-lightningd respectively.
+lightningd respectively. Bitcoin proxies are pooled and shared between
+callers with the same configuration (see bitcoinproxy.py).
 
 collect_proxies returns a ProxySet with proxies to bitcoin and lightning nodes,
 a url to the lightning node, and the pid_file of the lightning node.
@@ -15,8 +16,8 @@ a url to the lightning node, and the pid_file of the lightning node.
 
 import os.path
 from configparser import ConfigParser
-import bitcoin.rpc
 import jsonrpcproxy
+import bitcoinproxy
 from collections import namedtuple
 
 DEFAULT_DATADIR = os.path.expanduser("~/.bitcoin")
@@ -48,17 +49,47 @@ def bitcoin_config(args=None, datadir=DEFAULT_DATADIR, conf="bitcoin.conf"):
     return get_config(args=args, path=conf_path, defaults=BITCOIN_DEFAULTS)
 
 def bitcoin_proxy(args=None, datadir=DEFAULT_DATADIR, conf="bitcoin.conf"):
-    """Return a bitcoin proxy pointing to the config."""
+    """Return a bitcoin proxy pointing to the config.
+
+    The proxy is shared, and does not cache results (see bitcoinproxy.py).
+    """
     bitcoin_conf = bitcoin_config(args, datadir, conf)
-    return bitcoin.rpc.Proxy('http://%s:%s@localhost:%d' %
-                             (bitcoin_conf.get('rpcuser'),
-                              bitcoin_conf.get('rpcpassword'),
-                              bitcoin_conf.getint('rpcport')))
+    return bitcoinproxy.get_pool('http://%s:%s@localhost:%d' %
+                                 (bitcoin_conf.get('rpcuser'),
+                                  bitcoin_conf.get('rpcpassword'),
+                                  bitcoin_conf.getint('rpcport')),
+                                 ttl=0)
 
 LIGHTNING_DEFAULTS = {
     'daemon':False,
     'port':9333,
     'pidfile':'lightning.pid',
+    'peerconnections':4,
+    'peertimeout':30,
+    'bitconnections':4,
+    'bitcache':1.0,
+    'notifywindow':0.05,
+    'eventworkers':2,
+    'eventqueue':256,
+    'updatewindow':4,
+    'updatetimeout':10,
+    'coalescems':0,
+    'coalescesize':32,
+    'verifysigs':'always',
+    'verifysample':100,
+    'signers':0,
+    'changecost':5460,
+    'coinreserve':600,
+    'watchdepth':100,
+    'historykeep':100000,
+    'durability':'group',
+    'journalsize':1048576,
+    'dbconnections':8,
+    'server':'dev',
+    'workers':3,
+    'threads':4,
+    'connections':64,
+    'backlog':64,
 }
 def lightning_config(args=None,
                      datadir=DEFAULT_DATADIR,
@@ -0,0 +1,213 @@
+"""Append-only logs of a channel's past commitment states.
+
+HistoryLog -- one channel's log: a file of fixed-width records, each a
+              commitment number, both balances and the counterparty's
+              signature, in increasing order of number. The file is read
+              through mmap, and a sparse index of every INDEX_EVERY'th
+              record finds a number without reading the rest. An index of
+              the newest record with each pair of balances finds a
+              revoked state by what it pays.
+open_log -- return this process's HistoryLog for a path
+remove_log -- close and delete a log
+
+Logs only grow until compact is called, which keeps the newest state for
+each pair of balances (a revoked commitment is recognised by what it
+pays), and at most a given number of states. Compacting whenever a log
+has doubled keeps its size flat, at a constant cost per append.
+
+A log is appended to by one thread or process at a time (the caller holds
+the channel's lock), but may be read by any number at once. Readers notice
+appends by the file's size, and compaction by its inode changing.
+"""
+
+import os
+import mmap
+import bisect
+import struct
+import threading
+from collections import OrderedDict, namedtuple
+from serverutil import after_fork
+
+# number, our balance, their balance, signature length, signature
+RECORD = struct.Struct('<QqqB73s')
+BALANCES = struct.Struct('<8xqq')
+INDEX_EVERY = 1024
+
+State = namedtuple('State', ['number', 'our_balance', 'their_balance', 'sig'])
+
+class HistoryLog(object):
+    """The log of a channel's past states, in the file at path."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._fd = None
+        self._inode = None
+        self._map = None
+        self._count = 0
+        # (number, position) of every INDEX_EVERY'th record
+        self._index = []
+        # position of the newest record with each (our, their) balances
+        self._balances = {}
+
+    def _open(self):
+        """Open the file, forgetting anything read from another."""
+        self._close()
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND,
+                           0o600)
+        self._inode = os.fstat(self._fd).st_ino
+
+    def _close(self):
+        """Close the file and its map."""
+        if self._map is not None:
+            self._map.close()
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = self._inode = self._map = None
+        self._count = 0
+        self._index = []
+        self._balances = {}
+
+    def _refresh(self):
+        """Map any records appended, or reopen the log if it was compacted."""
+        try:
+            replaced = os.stat(self.path).st_ino != self._inode
+        except FileNotFoundError:
+            replaced = True
+        if self._fd is None or replaced:
+            self._open()
+        count = os.fstat(self._fd).st_size // RECORD.size
+        if count == self._count:
+            return
+        if self._map is not None:
+            self._map.close()
+        self._map = mmap.mmap(self._fd, count * RECORD.size,
+                              access=mmap.ACCESS_READ)
+        for position in range(len(self._index) * INDEX_EVERY, count,
+                              INDEX_EVERY):
+            self._index.append((self._number(position), position))
+        for position in range(self._count, count):
+            self._balances[BALANCES.unpack_from(
+                self._map, position * RECORD.size)] = position
+        self._count = count
+
+    def _number(self, position):
+        """Return the number of the record at position."""
+        return struct.unpack_from('<Q', self._map, position * RECORD.size)[0]
+
+    def _state(self, position):
+        """Return the State at position."""
+        number, ours, theirs, length, sig = RECORD.unpack_from(
+            self._map, position * RECORD.size)
+        return State(number, ours, theirs, sig[:length])
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return self._count
+
+    def append(self, number, our_balance, their_balance, sig):
+        """Add the state after commitment number.
+
+        States no newer than the last logged are already logged, and are
+        ignored.
+        """
+        with self._lock:
+            self._refresh()
+            if self._count and number <= self._number(self._count - 1):
+                return
+            os.write(self._fd, RECORD.pack(number, our_balance, their_balance,
+                                           len(sig), sig))
+
+    def get(self, number):
+        """Return the State after commitment number, or None."""
+        with self._lock:
+            self._refresh()
+            block = bisect.bisect_right(self._index, (number, self._count)) - 1
+            if block < 0:
+                return None
+            first, low = self._index[block]
+            high = min(low + INDEX_EVERY, self._count)
+            # Numbers are consecutive unless compaction dropped some
+            guess = low + number - first
+            if guess < high and self._number(guess) == number:
+                return self._state(guess)
+            while low < high:
+                middle = (low + high) // 2
+                if self._number(middle) < number:
+                    low = middle + 1
+                else:
+                    high = middle
+            if low < self._count and self._number(low) == number:
+                return self._state(low)
+            return None
+
+    def find(self, our_balance, their_balance):
+        """Return the newest State with these balances, or None."""
+        with self._lock:
+            self._refresh()
+            position = self._balances.get((our_balance, their_balance))
+            if position is None:
+                return None
+            return self._state(position)
+
+    def compact(self, keep):
+        """Keep the newest state for each pair of balances, at most keep."""
+        with self._lock:
+            self._refresh()
+            seen = set()
+            kept = []
+            for position in range(self._count - 1, -1, -1):
+                if len(kept) >= keep:
+                    break
+                state = self._state(position)
+                if (state.our_balance, state.their_balance) not in seen:
+                    seen.add((state.our_balance, state.their_balance))
+                    kept.append(state)
+            temporary = self.path + '.tmp'
+            with open(temporary, 'wb') as log_file:
+                for state in reversed(kept):
+                    log_file.write(RECORD.pack(
+                        state.number, state.our_balance, state.their_balance,
+                        len(state.sig), state.sig))
+                log_file.flush()
+                os.fsync(log_file.fileno())
+            os.replace(temporary, self.path)
+            self._open()
+
+    def close(self):
+        """Close the log. It is reopened if used again."""
+        with self._lock:
+            self._close()
+
+_OPEN = OrderedDict()
+_OPEN_LOCK = threading.Lock()
+# Forget logs opened by a parent process, whose files it shares
+_check_fork = after_fork(_OPEN.clear)
+
+def open_log(path, size=64):
+    """Return this process's HistoryLog for path.
+
+    At most size logs are kept open; the least recently used is closed.
+    """
+    with _OPEN_LOCK:
+        _check_fork()
+        log = _OPEN.pop(path, None)
+        if log is None:
+            log = HistoryLog(path)
+        _OPEN[path] = log
+        while len(_OPEN) > size:
+            _OPEN.popitem(last=False)[1].close()
+        return log
+
+def remove_log(path):
+    """Close and delete the log at path, if there is one."""
+    with _OPEN_LOCK:
+        _check_fork()
+        log = _OPEN.pop(path, None)
+    if log is not None:
+        log.close()
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
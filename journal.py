@@ -0,0 +1,296 @@
+"""A write-ahead journal whose writers share fsyncs.
+
+Journal -- an append-only file of records. Each record is framed with its
+           length and CRC32, so one torn by a crash is recognised, and it
+           and anything after it ignored.
+open_journal -- return this process's Journal for a path
+
+A writer appends its record, then waits in commit until the record is on
+disk. Writers which commit while another is syncing wait for that fsync to
+finish, and the first of them then syncs everything appended in the
+meantime with one more; so the disk sees one fsync for each batch of
+writers, however many threads and channels they come from.
+
+Records are appended by any number of threads and processes at once.
+Processes hold a shared flock on path + '.lock' while they write, and
+rewrite, which replaces the journal with some of its records, is called
+holding it exclusively (see exclusive).
+
+A journal written ahead of a database records the values of its rows:
+record -- the record of a row's values, by key (None once it is deleted)
+latest -- {key: values} for the last record of each key
+recover -- replay the changes the database lost
+checkpoint -- drop the records of changes the database has made durable
+maybe_checkpoint -- checkpoint once the journal has grown enough
+"""
+
+import os
+import os.path
+import zlib
+import fcntl
+import struct
+import threading
+from contextlib import contextmanager
+import jsonrpcproxy
+from serverutil import after_fork
+
+# length, CRC32 of the payload
+FRAME = struct.Struct('<II')
+
+class Journal(object):
+    """The journal in the file at path.
+
+    With sync False records are written but never fsynced, so they survive
+    the process crashing but not the machine.
+    """
+
+    def __init__(self, path, sync=True):
+        self.path = path
+        self.sync = sync
+        self._lock = threading.RLock()
+        self._flock = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        self._exclusive = False
+        self._fd = None
+        self._inode = None
+        # Records appended and known to be on disk, counted by this process
+        self._appended = 0
+        self._synced = 0
+        self._syncing = False
+        self._done = threading.Condition()
+
+    def _open(self):
+        """Open the file, closing any other."""
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                           0o600)
+        self._inode = os.fstat(self._fd).st_ino
+
+    def _refresh(self):
+        """Reopen the journal if it has been rewritten."""
+        try:
+            replaced = os.stat(self.path).st_ino != self._inode
+        except FileNotFoundError:
+            replaced = True
+        if self._fd is None or replaced:
+            self._open()
+
+    @contextmanager
+    def _shared(self):
+        """Exclude rewrites for the duration of the with block."""
+        with self._lock:
+            if self._exclusive:
+                yield
+                return
+            fcntl.flock(self._flock, fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._flock, fcntl.LOCK_UN)
+
+    @contextmanager
+    def exclusive(self):
+        """Exclude every other writer for the duration of the with block."""
+        with self._lock:
+            fcntl.flock(self._flock, fcntl.LOCK_EX)
+            self._exclusive = True
+            try:
+                yield
+            finally:
+                self._exclusive = False
+                fcntl.flock(self._flock, fcntl.LOCK_UN)
+
+    def append(self, payload):
+        """Write a record, returning its sequence number for commit."""
+        frame = FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._shared():
+            self._refresh()
+            os.write(self._fd, frame)
+            self._appended += 1
+            return self._appended
+
+    def commit(self, sequence):
+        """Return once the record appended as sequence is on disk."""
+        if not self.sync:
+            return
+        with self._done:
+            while self._synced < sequence:
+                if not self._syncing:
+                    self._syncing = True
+                    break
+                self._done.wait()
+            else:
+                return
+        synced = None
+        try:
+            with self._lock:
+                target = self._appended
+                # The journal may be rewritten, and reopened, while we sync
+                descriptor = os.dup(self._fd)
+            try:
+                os.fdatasync(descriptor)
+            finally:
+                os.close(descriptor)
+            synced = target
+        finally:
+            # On failure a waiting writer takes over, and tries again
+            with self._done:
+                self._syncing = False
+                if synced is not None:
+                    self._synced = max(self._synced, synced)
+                self._done.notify_all()
+
+    def _read(self):
+        """Return the intact records, and the length of the file they fill."""
+        try:
+            with open(self.path, 'rb') as journal_file:
+                data = journal_file.read()
+        except FileNotFoundError:
+            return [], 0
+        records = []
+        offset = 0
+        while offset + FRAME.size <= len(data):
+            length, checksum = FRAME.unpack_from(data, offset)
+            end = offset + FRAME.size + length
+            payload = data[offset + FRAME.size:end]
+            if end > len(data) or zlib.crc32(payload) != checksum:
+                break
+            records.append(payload)
+            offset = end
+        return records, offset
+
+    def records(self):
+        """Return the payloads of the intact records, oldest first."""
+        with self._shared():
+            return self._read()[0]
+
+    def repair(self):
+        """Drop a record torn by a crash from the end of the journal.
+
+        Anything appended after a torn record could not be read back.
+        """
+        with self.exclusive():
+            records, length = self._read()
+            if os.path.exists(self.path) and \
+               os.path.getsize(self.path) != length:
+                self.rewrite(records)
+
+    def rewrite(self, payloads):
+        """Replace the journal with payloads. Call holding exclusive."""
+        assert self._exclusive
+        temporary = self.path + '.tmp'
+        with open(temporary, 'wb') as journal_file:
+            for payload in payloads:
+                journal_file.write(FRAME.pack(len(payload),
+                                              zlib.crc32(payload)))
+                journal_file.write(payload)
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.replace(temporary, self.path)
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)),
+                            os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self._open()
+
+    def size(self):
+        """Return the size of the journal in bytes."""
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def close(self):
+        """Close the journal's files."""
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+            os.close(self._flock)
+            self._fd = self._inode = self._flock = None
+
+_OPEN = {}
+_OPEN_LOCK = threading.Lock()
+_check_fork = after_fork(_OPEN.clear)
+
+def open_journal(path, sync=True):
+    """Return this process's Journal for path.
+
+    Journals opened by a parent process are not shared with its children,
+    which sync their own appends.
+    """
+    with _OPEN_LOCK:
+        _check_fork()
+        journal = _OPEN.get(path)
+        if journal is None or journal.sync != sync:
+            journal = _OPEN[path] = Journal(path, sync)
+        return journal
+
+def record(key, values):
+    """Return the record of a row's values, or of its deletion (None)."""
+    return jsonrpcproxy.to_binary([key, values])
+
+def latest(records):
+    """Return {key: values} for the last record of each key."""
+    out = {}
+    for record_bytes in records:
+        key, values = jsonrpcproxy.from_binary(record_bytes)
+        out[key] = values
+    return out
+
+def recover(log, stored, restore):
+    """Replay the changes in log which the database lost in a crash.
+
+    stored() returns {key: values} for every row in the database. For each
+    key whose last record differs, restore(key, values, present) is called
+    with the record's values, and whether the database has the row; it
+    checks again holding whatever locks the row needs, and returns True if
+    it restored the row. Return the keys restored.
+    """
+    log.repair()
+    current = stored()
+    return [key for key, values in sorted(latest(log.records()).items())
+            if current.get(key) != values and
+            restore(key, values, key in current)]
+
+def checkpoint(log, stored, flush):
+    """Drop the records of changes which the database has made durable.
+
+    stored() returns {key: values} for every row in the database, and
+    flush() makes everything it read durable, returning False if it could
+    not. Return False if the checkpoint did not complete, or another
+    process rewrote the journal meanwhile.
+    """
+    with log.exclusive():
+        before = log.records()
+    current = stored()
+    if not flush():
+        return False
+    with log.exclusive():
+        after = log.records()
+        if after[:len(before)] != before:
+            return False
+        added = after[len(before):]
+        fresh = latest(added)
+        log.rewrite([record(key, values) for key, values
+                     in sorted(latest(before).items())
+                     if key not in fresh and current.get(key) != values] +
+                    added)
+    return True
+
+# Journal size at which each process next checkpoints, by path
+CHECKPOINT_AT = {}
+
+def maybe_checkpoint(log, limit, checkpoint_log):
+    """Call checkpoint_log() if log has grown by limit bytes since the last.
+
+    checkpoint_log returns False if it did not complete.
+    """
+    size = log.size()
+    if size < CHECKPOINT_AT.get(log.path, limit):
+        return
+    # Whether or not it succeeds, don't try again until the journal grows
+    CHECKPOINT_AT[log.path] = size + limit
+    if checkpoint_log():
+        CHECKPOINT_AT[log.path] = log.size() + limit
@@ -5,9 +5,30 @@
 Proxy is a simple RPC client with automatic method generation. It supports
 transparent translation of objects specified below.
 AuthProxy is the same as proxy but can authenticate itself with basic auth.
+Proxy.batch returns a Batch, which queues calls and sends them together as
+one JSON-RPC 2.0 batch request.
+AsyncProxy is the asyncio counterpart of Proxy, with per-call timeouts.
+A Proxy call raises JSONResponseException for an exception raised by the
+remote method, and one of TRANSPORT_ERRORS if it failed on the way.
+gather and run fan calls out to many peers at once, from coroutines and
+from synchronous code respectively.
+
+SESSIONS is the process-wide SessionRegistry used by every proxy. It keeps one
+pooled keep-alive session per host, so repeated calls to the same peer reuse
+their TCP connections. SESSIONS.maxsize is how many idle connections to each
+host are kept.
 
 SmartDispatcher is a server component which handles transparent translation
-of the objects specified below.
+of the objects specified below. Batch requests are translated call by call.
+
+Binary framing:
+to_binary and from_binary are a compact alternative to to_json/from_json for
+the same objects. Values are tagged and length-prefixed, and bytes, addresses
+and serialized bitcoin objects are carried raw rather than as base64 text.
+Requests framed this way are sent with content-type BINARY_CONTENT_TYPE, and
+handle_binary answers them on the server. Proxy(url, binary=True) tries
+binary framing first, and remembers hosts which refuse it as unparseable
+(older peers) so that it talks JSON to them from then on.
 
 Objects supported by transparent (automatic) translation:
 * int (standard JSON)
@@ -24,10 +45,18 @@ Objects supported by transparent (automatic) translation:
 * dict (keys int or str) (not containing the key '__class__') (recursive)
 """
 
+import os
+import struct
+import logging
+import threading
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 import json
 from base64 import b64encode, b64decode
+from urllib.parse import urlsplit
 import requests
+from requests.adapters import HTTPAdapter
 from jsonrpc.dispatcher import Dispatcher
 import bitcoin.core
 from bitcoin.core.serialize import Serializable
@@ -46,15 +75,26 @@ def deserialize_bytes(b64data):
     return b64decode(b64data.encode())
 
 def subclass_hook(encode, decode, allowed):
-    """Generate encode/decode functions for one interface."""
+    """Generate encode/decode functions for one interface.
+
+    The allowed class matching each concrete type is looked up once.
+    """
     lookup = {cls.__name__:cls for cls in allowed}
+    names = {}
     def encode_subclass(message):
         """Convert message to JSON."""
-        for cls in allowed:
-            if isinstance(message, cls):
-                return {'subclass':cls.__name__,
-                        'value':encode(message)}
-        raise ConversionError("Unknown message type", type(message).__name__)
+        try:
+            name = names[type(message)]
+        except KeyError:
+            for cls in allowed:
+                if isinstance(message, cls):
+                    name = names[type(message)] = cls.__name__
+                    break
+            else:
+                raise ConversionError("Unknown message type",
+                                      type(message).__name__)
+        return {'subclass':name,
+                'value':encode(message)}
     def decode_subclass(message):
         """Recover message from JSON."""
         cls = lookup[message['subclass']]
@@ -86,42 +126,115 @@ HOOKS = [
         ])),
 ]
 
-def to_json(message):
-    """Prepare message for JSON serialization."""
-    if isinstance(message, list) or isinstance(message, tuple):
-        return [to_json(sub) for sub in message]
-    elif isinstance(message, dict):
-        assert '__class__' not in message
-        return {to_json(key):to_json(message[key]) for key in message}
-    elif isinstance(message, int) or isinstance(message, str):
-        return message
-    elif message is None:
-        return {'__class__':'None'}
+def _list_to_json(message):
+    """Convert a list or tuple to JSON."""
+    return [to_json(sub) for sub in message]
+
+def _dict_to_json(message):
+    """Convert a dict to JSON."""
+    assert '__class__' not in message
+    return {to_json(key):to_json(message[key]) for key in message}
+
+def _plain_json(message):
+    """Pass standard JSON through."""
+    return message
+
+def _none_to_json(dummy_message):
+    """Hide None from the JSON-RPC library."""
+    return {'__class__':'None'}
+
+def _hook_to_json(name, encode):
+    """Convert with a hook from HOOKS, marking the output with name."""
+    def encode_hook(message):
+        """Convert message to JSON."""
+        out = encode(message)
+        assert '__class__' not in out
+        out['__class__'] = name
+        return out
+    return encode_hook
+
+# to_json encoder for each concrete type, filled in as types are seen
+JSON_ENCODERS = {}
+
+def _json_encoder(message_type):
+    """Find and cache the to_json encoder for a type, or return None."""
+    if issubclass(message_type, (list, tuple)):
+        encoder = _list_to_json
+    elif issubclass(message_type, dict):
+        encoder = _dict_to_json
+    elif issubclass(message_type, (int, str)):
+        encoder = _plain_json
+    elif message_type is type(None):
+        encoder = _none_to_json
     else:
         for cls, codes in HOOKS:
-            if isinstance(message, cls):
-                out = codes[0](message)
-                assert '__class__' not in out
-                out['__class__'] = cls.__name__
-                return out
+            if issubclass(message_type, cls):
+                encoder = _hook_to_json(cls.__name__, codes[0])
+                break
+        else:
+            return None
+    JSON_ENCODERS[message_type] = encoder
+    return encoder
+
+def to_json(message):
+    """Prepare message for JSON serialization."""
+    try:
+        encoder = JSON_ENCODERS[type(message)]
+    except KeyError:
+        encoder = _json_encoder(type(message))
+        if encoder is None:
+            raise ConversionError("Unable to convert", message)
+    return encoder(message)
+
+# from_json decoder for each '__class__' marker
+JSON_DECODERS = {'None': lambda message: None}
+JSON_DECODERS.update((cls.__name__, codes[1]) for cls, codes in HOOKS)
+
+def _list_from_json(message):
+    """Recover a list from JSON."""
+    return [from_json(sub) for sub in message]
+
+def _dict_from_json(message):
+    """Recover a dict, or an object marked with '__class__', from JSON."""
+    if '__class__' not in message:
+        return {from_json(key):from_json(message[key]) for key in message}
+    try:
+        decoder = JSON_DECODERS[message['__class__']]
+    except (KeyError, TypeError):
         raise ConversionError("Unable to convert", message)
+    return decoder(message)
+
+# from_json decoder for each concrete type, filled in as types are seen
+FROM_JSON_DECODERS = {
+    list: _list_from_json,
+    dict: _dict_from_json,
+    int: _plain_json,
+    str: _plain_json,
+    bool: _plain_json,
+}
+
+def _from_json_decoder(message_type):
+    """Find and cache the from_json decoder for a type, or return None."""
+    if issubclass(message_type, (list, tuple)):
+        decoder = _list_from_json
+    elif issubclass(message_type, dict):
+        decoder = _dict_from_json
+    elif issubclass(message_type, (int, str)):
+        decoder = _plain_json
+    else:
+        return None
+    FROM_JSON_DECODERS[message_type] = decoder
+    return decoder
 
 def from_json(message):
     """Retrieve an object from JSON message (undo to_json)."""
-    if isinstance(message, list) or isinstance(message, tuple):
-        return [from_json(sub) for sub in message]
-    elif isinstance(message, int) or isinstance(message, str):
-        return message
-    elif isinstance(message, dict):
-        if '__class__' not in message:
-            return {from_json(key):from_json(message[key]) for key in message}
-        elif message['__class__'] == 'None':
-            return None
-        else:
-            for cls, codes in HOOKS:
-                if message['__class__'] == cls.__name__:
-                    return codes[1](message)
-    raise ConversionError("Unable to convert", message)
+    try:
+        decoder = FROM_JSON_DECODERS[type(message)]
+    except KeyError:
+        decoder = _from_json_decoder(type(message))
+        if decoder is None:
+            raise ConversionError("Unable to convert", message)
+    return decoder(message)
 
 def convert_exception(exception):
     """Convert an exception's arguments to jsonizable form."""
@@ -134,6 +247,217 @@ def convert_exception(exception):
     exception.args = [force_convert(arg) for arg in exception.args]
     return exception
 
+BINARY_CONTENT_TYPE = 'application/x-lightning-rpc'
+
+# Concrete classes carried by the binary framing, identified by index.
+BINARY_BASE58 = [
+    bitcoin.wallet.P2SHBitcoinAddress,
+    bitcoin.wallet.P2PKHBitcoinAddress,
+    bitcoin.base58.CBase58Data,
+]
+BINARY_SERIALIZABLE = [
+    bitcoin.core.CMutableTransaction,
+    bitcoin.core.CTransaction,
+    bitcoin.core.CMutableTxIn,
+    bitcoin.core.CMutableTxOut,
+]
+
+LONG_LENGTH = struct.Struct('>BI')
+
+def _length(length):
+    """Frame a length: one byte if short, otherwise 0xFF and four bytes."""
+    if length < 0xFF:
+        return bytes([length])
+    return LONG_LENGTH.pack(0xFF, length)
+
+def _list_to_binary(message, write):
+    """Write a list or tuple."""
+    write(b'L' + _length(len(message)))
+    for sub in message:
+        _encode_binary(sub, write)
+
+def _dict_to_binary(message, write):
+    """Write a dict."""
+    write(b'D' + _length(len(message)))
+    for key in message:
+        _encode_binary(key, write)
+        _encode_binary(message[key], write)
+
+def _int_to_binary(message, write):
+    """Write an int."""
+    value = message.to_bytes((message.bit_length() + 8) // 8,
+                             'big', signed=True)
+    write(b'I' + _length(len(value)) + value)
+
+def _str_to_binary(message, write):
+    """Write a str."""
+    value = message.encode('utf8')
+    write(b'S' + _length(len(value)) + value)
+
+def _bytes_to_binary(message, write):
+    """Write bytes."""
+    write(b'B' + _length(len(message)) + message)
+
+def _indexed_to_binary(classes, message_type):
+    """Find the index of the class in classes which message_type matches."""
+    for index, cls in enumerate(classes):
+        if issubclass(message_type, cls):
+            return index
+    raise ConversionError("Unknown message type", message_type.__name__)
+
+def _base58_to_binary(prefix):
+    """Make a writer for CBase58Data, with tag and class index prefix."""
+    def encode(message, write):
+        """Write a CBase58Data."""
+        write(prefix + bytes([message.nVersion]) +
+              _length(len(message)) + bytes(message))
+    return encode
+
+def _serializable_to_binary(prefix):
+    """Make a writer for Serializable, with tag and class index prefix."""
+    def encode(message, write):
+        """Write a Serializable."""
+        value = message.serialize()
+        write(prefix + _length(len(value)) + value)
+    return encode
+
+# to_binary writer for each concrete type, filled in as types are seen
+BINARY_ENCODERS = {
+    type(None): lambda message, write: write(b'N'),
+    bool: lambda message, write: write(b'T' if message else b'F'),
+}
+
+def _binary_encoder(message_type):
+    """Find and cache the to_binary writer for a type, or return None."""
+    if issubclass(message_type, (list, tuple)):
+        encoder = _list_to_binary
+    elif issubclass(message_type, dict):
+        encoder = _dict_to_binary
+    elif issubclass(message_type, bool):
+        encoder = BINARY_ENCODERS[bool]
+    elif issubclass(message_type, int):
+        encoder = _int_to_binary
+    elif issubclass(message_type, str):
+        encoder = _str_to_binary
+    elif issubclass(message_type, bitcoin.base58.CBase58Data):
+        index = _indexed_to_binary(BINARY_BASE58, message_type)
+        encoder = _base58_to_binary(b'A' + bytes([index]))
+    elif issubclass(message_type, bytes):
+        encoder = _bytes_to_binary
+    elif issubclass(message_type, Serializable):
+        index = _indexed_to_binary(BINARY_SERIALIZABLE, message_type)
+        encoder = _serializable_to_binary(b'X' + bytes([index]))
+    else:
+        return None
+    BINARY_ENCODERS[message_type] = encoder
+    return encoder
+
+def _encode_binary(message, write):
+    """Write the binary framing of message in pieces."""
+    try:
+        encoder = BINARY_ENCODERS[type(message)]
+    except KeyError:
+        encoder = _binary_encoder(type(message))
+        if encoder is None:
+            raise ConversionError("Unable to convert", message)
+    encoder(message, write)
+
+def to_binary(message):
+    """Serialize message in the binary framing."""
+    out = []
+    _encode_binary(message, out.append)
+    return b''.join(out)
+
+def _read_length(data, offset):
+    """Read a framed length, returning it and the following offset."""
+    length = data[offset]
+    if length < 0xFF:
+        return length, offset + 1
+    return LONG_LENGTH.unpack_from(data, offset)[1], offset + LONG_LENGTH.size
+
+def _read_chunk(data, offset):
+    """Read length-prefixed bytes, returning them and the following offset."""
+    length, offset = _read_length(data, offset)
+    end = offset + length
+    if end > len(data):
+        raise ConversionError("Truncated message", end)
+    return data[offset:end], end
+
+def _decode_list(data, offset):
+    """Decode the body of a list."""
+    count, offset = _read_length(data, offset)
+    out = []
+    for dummy in range(count):
+        value, offset = _decode_binary(data, offset)
+        out.append(value)
+    return out, offset
+
+def _decode_dict(data, offset):
+    """Decode the body of a dict."""
+    count, offset = _read_length(data, offset)
+    out = {}
+    for dummy in range(count):
+        key, offset = _decode_binary(data, offset)
+        out[key], offset = _decode_binary(data, offset)
+    return out, offset
+
+def _decode_int(data, offset):
+    """Decode the body of an int."""
+    value, offset = _read_chunk(data, offset)
+    return int.from_bytes(value, 'big', signed=True), offset
+
+def _decode_str(data, offset):
+    """Decode the body of a str."""
+    value, offset = _read_chunk(data, offset)
+    return value.decode('utf8'), offset
+
+def _decode_base58(data, offset):
+    """Decode the body of a CBase58Data."""
+    cls, version = BINARY_BASE58[data[offset]], data[offset+1]
+    value, offset = _read_chunk(data, offset + 2)
+    return cls.from_bytes(value, version), offset
+
+def _decode_serializable(data, offset):
+    """Decode the body of a Serializable."""
+    cls = BINARY_SERIALIZABLE[data[offset]]
+    value, offset = _read_chunk(data, offset + 1)
+    return cls.deserialize(value), offset
+
+BINARY_DECODERS = {
+    ord('L'): _decode_list,
+    ord('D'): _decode_dict,
+    ord('N'): lambda data, offset: (None, offset),
+    ord('T'): lambda data, offset: (True, offset),
+    ord('F'): lambda data, offset: (False, offset),
+    ord('I'): _decode_int,
+    ord('S'): _decode_str,
+    ord('B'): _read_chunk,
+    ord('A'): _decode_base58,
+    ord('X'): _decode_serializable,
+}
+
+def _decode_binary(data, offset):
+    """Decode one value at offset, returning it and the following offset."""
+    try:
+        decode = BINARY_DECODERS[data[offset]]
+    except KeyError:
+        raise ConversionError("Unknown tag", data[offset], offset)
+    return decode(data, offset + 1)
+
+def from_binary(data):
+    """Recover an object from the binary framing (undo to_binary)."""
+    data = bytes(data)
+    try:
+        message, offset = _decode_binary(data, 0)
+    # KeyError for an unknown class tag, the rest for a corrupt object
+    except (IndexError, KeyError, ValueError, struct.error,
+            bitcoin.core.serialize.SerializationError,
+            bitcoin.base58.Base58Error) as error:
+        raise ConversionError("Truncated or corrupt message", error)
+    if offset != len(data):
+        raise ConversionError("Trailing data", len(data) - offset)
+    return message
+
 class SmartDispatcher(Dispatcher):
     """Wrap methods to allow complex objects in JSON RPC calls."""
 
@@ -154,48 +478,307 @@ class SmartDispatcher(Dispatcher):
                 raise
         return wrapped
 
+def _binary_response(dispatcher, request):
+    """Dispatch one decoded request object, returning its response object."""
+    response = {'jsonrpc': '2.0', 'id': request.get('id')}
+    try:
+        method = Dispatcher.__getitem__(dispatcher, request['method'])
+    except KeyError:
+        response['error'] = {'code': -32601, 'message': 'Method not found'}
+        return response
+    params = request.get('params', [])
+    try:
+        if isinstance(params, dict):
+            response['result'] = method(**params)
+        else:
+            response['result'] = method(*params)
+    except Exception as exception: # pylint: disable=broad-except
+        logging.getLogger(__name__).exception("API Exception")
+        args = []
+        for arg in exception.args:
+            try:
+                to_binary(arg)
+            except ConversionError:
+                arg = repr(arg)
+            args.append(arg)
+        response['error'] = {
+            'code': -32000,
+            'message': 'Server error',
+            'data': {
+                'type': type(exception).__name__,
+                'args': args,
+                'message': str(exception),
+            },
+        }
+    return response
+
+def handle_binary(dispatcher, data):
+    """Answer a binary framed request (or batch) using dispatcher.
+
+    Methods are looked up without SmartDispatcher's JSON translation, since
+    the binary framing already carries the objects themselves.
+    """
+    try:
+        request = from_binary(data)
+    except ConversionError:
+        return to_binary({'jsonrpc': '2.0', 'id': None, 'error': {
+            'code': -32700, 'message': 'Parse error'}})
+    if isinstance(request, list):
+        return to_binary([_binary_response(dispatcher, sub)
+                          for sub in request])
+    return to_binary(_binary_response(dispatcher, request))
+
+class SessionRegistry(object):
+    """Process-wide registry of pooled HTTP sessions, one per host.
+
+    Each session keeps at most maxsize idle connections to its host. Callers
+    never wait for one: a call made while all of them are busy, such as an
+    RPC nested in another to the same peer, opens a connection of its own,
+    which is closed afterwards.
+    The registry also remembers which hosts only speak JSON, and owns the
+    thread pool (of at most workers threads) on which AsyncProxy requests run.
+    """
+
+    def __init__(self, maxsize=4, workers=16):
+        self.maxsize = maxsize
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._executor = None
+        self._json_only = set()
+        self._pid = os.getpid()
+
+    def _check_fork(self):
+        """Forget sessions and threads inherited from a parent process."""
+        if self._pid != os.getpid():
+            self._sessions, self._executor = {}, None
+            self._pid = os.getpid()
+
+    def speaks_binary(self, url):
+        """Return False if the host of url is known to only speak JSON."""
+        return urlsplit(url)[:2] not in self._json_only
+
+    def set_json_only(self, url):
+        """Remember that the host of url only speaks JSON."""
+        with self._lock:
+            self._json_only.add(urlsplit(url)[:2])
+
+    def get(self, url):
+        """Return the session for the host of url, creating it as needed."""
+        scheme, netloc = urlsplit(url)[:2]
+        with self._lock:
+            self._check_fork()
+            session = self._sessions.get((scheme, netloc))
+            if session is None:
+                session = requests.Session()
+                session.mount(scheme + '://', HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.maxsize,
+                    pool_block=False))
+                self._sessions[(scheme, netloc)] = session
+            return session
+
+    def executor(self):
+        """Return the thread pool for asynchronous requests."""
+        with self._lock:
+            self._check_fork()
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.workers)
+            return self._executor
+
+    def clear(self):
+        """Close and forget all sessions and threads."""
+        with self._lock:
+            self._check_fork()
+            for session in self._sessions.values():
+                session.close()
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            self._sessions, self._executor = {}, None
+
+SESSIONS = SessionRegistry()
+
 class JSONResponseException(Exception):
     """Exception returned from RPC call"""
 
 class JSONRPCError(Exception):
     """Error making RPC call"""
 
+# Errors from a Proxy call which may not have reached the other node, or
+# whose answer was lost, rather than an exception raised by the call
+TRANSPORT_ERRORS = (requests.exceptions.RequestException, JSONRPCError)
+
+def _json_payload(payload):
+    """Translate the params of a request object (or batch) for JSON."""
+    if isinstance(payload, list):
+        return [_json_payload(sub) for sub in payload]
+    return dict(payload, params=to_json(payload['params']))
+
+def _json_response(response):
+    """Translate the result or error of a JSON response object (or batch)."""
+    if isinstance(response, list):
+        return [_json_response(sub) for sub in response]
+    response = dict(response)
+    if 'result' in response:
+        response['result'] = from_json(response['result'])
+    if 'error' in response:
+        try:
+            response['error'] = from_json(response['error'])
+        except ConversionError:
+            pass
+    return response
+
+def _parse_rejected(status, content_type, body):
+    """Return True if a response refuses a request it could not parse.
+
+    Only such a response (HTTP 415, or a JSON-RPC parse error) shows that
+    the request was never dispatched.
+    """
+    if status == 415:
+        return True
+    if content_type != 'application/json':
+        return False
+    try:
+        response = json.loads(body.decode('utf8'))
+    except ValueError:
+        return False
+    return isinstance(response, dict) and \
+        isinstance(response.get('error'), dict) and \
+        response['error'].get('code') == -32700
+
 class Proxy(object):
-    """Remote method call proxy."""
+    """Remote method call proxy.
 
-    def __init__(self, url):
+    With binary=True, requests are sent in the binary framing unless the
+    host is known to only speak JSON. timeout (in seconds) bounds each
+    request, and None waits forever.
+    """
+
+    def __init__(self, url, binary=False, timeout=None):
         self.url = url
-        self.headers = {'content-type': 'application/json'}
+        self.binary = binary
+        self.timeout = timeout
+        self.auth = None
         self._id = 0
 
-    def _call(self, name, *args, **kwargs):
-        """Call a method."""
-        args, kwargs = to_json(args), to_json(kwargs)
+    def _payload(self, name, args, kwargs):
+        """Build the request object for one call."""
         assert not (args and kwargs)
         payload = {
             'method': name,
-            'params': kwargs or args,
+            'params': kwargs or list(args),
             'id': self._id,
             'jsonrpc': '2.0'
         }
-
-        response = self._request(json.dumps(payload))
-
-        assert response["jsonrpc"] == "2.0"
-        assert response["id"] == self._id
-
         self._id += 1
+        return payload
 
+    @staticmethod
+    def _result(response):
+        """Extract the result of one call from its response object."""
+        assert response["jsonrpc"] == "2.0"
         if 'error' in response:
-            raise JSONResponseException(from_json(response['error']))
+            raise JSONResponseException(response['error'])
         elif 'result' not in response:
             raise JSONRPCError('missing JSON RPC result')
         else:
-            return from_json(response['result'])
+            return response['result']
+
+    def _call(self, name, *args, **kwargs):
+        """Call a method."""
+        payload = self._payload(name, args, kwargs)
+        response = self._request(payload)
+        assert response["id"] == payload['id']
+        return self._result(response)
+
+    def batch(self):
+        """Return a Batch which sends queued calls in one request."""
+        return Batch(self)
+
+    def _request(self, payload):
+        """Send a request object (or batch), returning the response."""
+        if self.binary and SESSIONS.speaks_binary(self.url):
+            status, content_type, body = self._post(to_binary(payload),
+                                                    BINARY_CONTENT_TYPE)
+            if content_type == BINARY_CONTENT_TYPE:
+                return from_binary(body)
+            if not _parse_rejected(status, content_type, body):
+                # The request may have been dispatched, so don't resend it
+                raise JSONRPCError('Unexpected response', self.url, status,
+                                   content_type)
+            # An older peer failed to parse the request before dispatching
+            # it, so it is safe to send again. Talk JSON from now on.
+            SESSIONS.set_json_only(self.url)
+        _, content_type, body = self._post(
+            json.dumps(_json_payload(payload)), 'application/json')
+        return _json_response(json.loads(body.decode('utf8')))
+
+    def _post(self, data, content_type):
+        """Perform the request over the pooled session for our host.
+
+        Return the status, content type and body of the response.
+        """
+        response = SESSIONS.get(self.url).post(
+            self.url, data=data, headers={'content-type': content_type},
+            auth=self.auth, timeout=self.timeout)
+        return response.status_code, \
+            response.headers.get('content-type', '').split(';')[0], \
+            response.content
+
+    def __getattr__(self, name):
+        """Generate method stubs as needed."""
+        func = lambda *args, **kwargs: self._call(name, *args, **kwargs)
+        func.__name__ = name
+        return func
+
+class BatchCall(object):
+    """Handle for the eventual result of a call queued in a Batch."""
+
+    def __init__(self, name):
+        self.name = name
+        self.response = None
+
+    def result(self):
+        """Return the result of the call, or raise its error."""
+        if self.response is None:
+            raise JSONRPCError('batch not sent', self.name)
+        return Proxy._result(self.response)
+
+class Batch(object):
+    """Calls queued on a Proxy and sent as one JSON-RPC 2.0 batch.
 
-    def _request(self, data):
-        """Perform the request."""
-        return requests.post(self.url, data=data, headers=self.headers).json()
+    Calls return BatchCall handles. The batch is sent when send is called,
+    or on leaving the with block:
+
+    with proxy.batch() as batch:
+        first, second = batch.update(1), batch.update(2)
+    first.result(), second.result()
+    """
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.queued = []
+
+    def _call(self, name, *args, **kwargs):
+        """Queue a method call."""
+        call = BatchCall(name)
+        self.queued.append((self.proxy._payload(name, args, kwargs), call))
+        return call
+
+    def send(self):
+        """Send all queued calls, returning their handles in order."""
+        queued, self.queued = self.queued, []
+        if not queued:
+            return []
+        response = self.proxy._request(
+            [payload for payload, dummy_call in queued])
+        if not isinstance(response, list):
+            # The server rejected the batch as a whole.
+            raise JSONResponseException(response.get('error'))
+        responses = {sub['id']:sub for sub in response}
+        for payload, call in queued:
+            call.response = responses.get(
+                payload['id'], {'jsonrpc':'2.0', 'id':payload['id']})
+        return [call for dummy_payload, call in queued]
 
     def __getattr__(self, name):
         """Generate method stubs as needed."""
@@ -203,13 +786,91 @@ class Proxy(object):
         func.__name__ = name
         return func
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, dummy_value, dummy_traceback):
+        if exc_type is None:
+            self.send()
+
 class AuthProxy(Proxy):
     """Proxy with basic authentication."""
     def __init__(self, url, auth):
         Proxy.__init__(self, url)
         self.auth = auth
 
-    def _request(self, data):
-        """Perform the request."""
-        return requests.post(
-            self.url, data=data, headers=self.headers, auth=self.auth).json()
+# get_event_loop is deprecated in coroutines from Python 3.7, which adds
+# get_running_loop; before then, it returns the running loop
+_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+class AsyncProxy(object):
+    """Remote method call proxy for asyncio.
+
+    Method stubs return coroutines, with the same translation as Proxy.
+    Each call runs a Proxy request on the SESSIONS thread pool, so calls to
+    several peers proceed at once over pooled connections. timeout (in
+    seconds) bounds each call; call accepts a different timeout per call.
+    """
+
+    def __init__(self, url, binary=False, timeout=None, auth=None):
+        self.url = url
+        self.binary = binary
+        self.timeout = timeout
+        self.auth = auth
+
+    def _make_proxy(self, timeout):
+        """Make the synchronous proxy for one call."""
+        proxy = Proxy(self.url, binary=self.binary, timeout=timeout)
+        proxy.auth = self.auth
+        return proxy
+
+    async def _run(self, function, timeout):
+        """Run function on the thread pool, waiting at most timeout."""
+        loop = _running_loop()
+        return await asyncio.wait_for(
+            loop.run_in_executor(SESSIONS.executor(), function), timeout)
+
+    async def call(self, name, *args, timeout=None, **kwargs):
+        """Call a method, waiting at most timeout (default self.timeout)."""
+        if timeout is None:
+            timeout = self.timeout
+        proxy = self._make_proxy(timeout)
+        return await self._run(
+            lambda: proxy._call(name, *args, **kwargs), timeout)
+
+    async def batch(self, calls, timeout=None):
+        """Send (name, args) calls in one batch, returning BatchCall handles."""
+        if timeout is None:
+            timeout = self.timeout
+        batch = self._make_proxy(timeout).batch()
+        for name, args in calls:
+            getattr(batch, name)(*args)
+        return await self._run(batch.send, timeout)
+
+    def __getattr__(self, name):
+        """Generate method stubs as needed."""
+        func = lambda *args, **kwargs: self.call(name, *args, **kwargs)
+        func.__name__ = name
+        return func
+
+async def gather(*calls, return_exceptions=False):
+    """Wait for all of calls, returning their results in order.
+
+    All calls run to completion. Unless return_exceptions is set, the first
+    exception (in order of calls) is then raised.
+    """
+    results = await asyncio.gather(*calls, return_exceptions=True)
+    if not return_exceptions:
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+    return results
+
+def run(*calls, return_exceptions=False):
+    """Run calls concurrently from synchronous code, as gather."""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(
+            gather(*calls, return_exceptions=return_exceptions))
+    finally:
+        loop.close()
@@ -23,7 +23,7 @@ nexthop: where should payment go next on the path to that node
 
 from flask import g
 import jsonrpcproxy
-from serverutil import api_factory, database
+from serverutil import api_factory, database, BUS
 import channel
 from sqlalchemy import Column, Integer, String
 
@@ -46,43 +46,81 @@ class Route(Model):
     cost = Column(Integer)
     next_hop = Column(String)
 
-@channel.CHANNEL_OPENED.connect_via('channel')
+@BUS.connect(channel.CHANNEL_OPENED, sender='channel', key='address')
 def on_open(dummy_sender, address, **dummy_args):
-    """Routing update on open."""
+    """Routing update on open.
+
+    Runs on the event bus, so opening a channel doesn't wait for the
+    routing table to be rebroadcast.
+    """
     fees = 10000
+    # Another channel with a peer doesn't change any routes
+    if Peer.query.get(address) is not None:
+        return
     # Add the new peer
     peer = Peer(address=address, fees=fees)
     database.session.add(peer)
-    # Broadcast a routing update
-    update(address, address, 0)
     # The new peer doesn't know all our routes.
-    # As a hack, rebuild/rebroadcast the whole routing table.
+    # As a hack, rebuild/rebroadcast the whole routing table,
+    # along with a route to the new peer.
     routes = Route.query.all()
     Route.query.delete()
+    updates = [(address, address, 0)]
+    updates.extend((route.next_hop, route.address, route.cost)
+                   for route in routes)
+    broadcast(improve(updates))
+
+def improve(updates):
+    """Apply (next_hop, address, cost) routing updates.
+
+    Only improvements are kept. Return (address, cost) for each route
+    which was improved.
+    """
+    improved = []
+    for next_hop, address, cost in updates:
+        if address == g.addr:
+            continue
+        route = Route.query.get(address)
+        if route is None:
+            route = Route(address=address, cost=cost, next_hop=next_hop)
+            database.session.add(route)
+        elif route.cost <= cost:
+            continue
+        else:
+            route.cost = cost
+            route.next_hop = next_hop
+        improved.append((address, cost))
     database.session.commit()
-    for route in routes:
-        update(route.next_hop, route.address, route.cost)
+    return improved
+
+def broadcast(routes):
+    """Tell all our peers about (address, cost) routes.
+
+    Each peer is sent all the routes in a single batch request,
+    and all peers are contacted at once.
+    """
+    if not routes:
+        return
+    batches = []
+    for peer in Peer.query.all():
+        bob = jsonrpcproxy.AsyncProxy(peer.address + 'lightning/', binary=True,
+                                      timeout=float(g.config['peertimeout']))
+        batches.append(bob.batch([
+            ('update', (g.addr, address, cost + peer.fees))
+            for address, cost in routes]))
+    for calls in jsonrpcproxy.run(*batches):
+        for call in calls:
+            call.result()
 
 @REMOTE
 def update(next_hop, address, cost):
     """Routing update."""
-    # Check previous route, and only update if this is an improvement
-    if address == g.addr:
-        return
-    route = Route.query.get(address)
-    if route is None:
-        route = Route(address=address, cost=cost, next_hop=next_hop)
-        database.session.add(route)
-    elif route.cost <= cost:
+    # Only update if this is an improvement
+    routes = improve([(next_hop, address, cost)])
+    if not routes:
         return
-    else:
-        route.cost = cost
-        route.next_hop = next_hop
     # Tell all our peers
-    database.session.commit()
-    for peer in Peer.query.all():
-        bob = jsonrpcproxy.Proxy(peer.address + 'lightning/')
-        bob.update(g.addr, address, cost + peer.fees)
+    broadcast(routes)
     return True
 
 @REMOTE
@@ -105,5 +143,6 @@ def send(url, amount):
         # Send the next hop money over our payment channel
         channel.send(route.next_hop, amount + route.cost)
         # Ask the next hop to send money to the destination
-        bob = jsonrpcproxy.Proxy(route.next_hop+'lightning/')
+        bob = jsonrpcproxy.Proxy(route.next_hop+'lightning/',
+                                  binary=True)
         bob.send(url, amount)
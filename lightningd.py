@@ -10,6 +10,74 @@ Usage:
 -datadir=<path>: specify the directory to run in
 -conf=<file>: specify the configuration file (default lightning.conf)
 -port=<port>: specify the port to bind to
+-server=<dev|gunicorn>: the server to run (default dev)
+-workers=<n>: gunicorn worker processes (default 3)
+-threads=<n>: threads per gunicorn worker (default 4)
+-connections=<n>: connections each gunicorn worker holds (default 64)
+-backlog=<n>: connections which may wait to be accepted (default 64)
+-peerconnections=<n>: idle connections each process keeps to each other node
+                     (default 4)
+-peertimeout=<seconds>: how long to wait for another node to answer each
+                       call (default 30)
+-bitconnections=<n>: connections each process holds to bitcoind (default 4)
+-bitcache=<seconds>: how long to cache chain tip reads from bitcoind,
+                     at most until the next block (default 1.0, 0 disables)
+-notifywindow=<seconds>: how long to collect bitcoind notifications into one
+                         batch (default 0.05)
+-eventworkers=<n>: threads each gunicorn worker runs event handlers on
+                   (default 2)
+-eventqueue=<n>: event handlers which may wait before signals block
+                 (default 256)
+-updatewindow=<n>: payments we may have in flight in one channel (default 4)
+-updatetimeout=<seconds>: how long a channel update may wait for earlier
+                          updates (default 10)
+-coalescems=<ms>: merge sends to one node arriving within this many
+                  milliseconds into one update (default 0, disabled)
+-coalescesize=<n>: the most sends merged into one update (default 32)
+-verifysigs=<always|sampled|broadcast>: which transactions we sign have their
+                                        scripts verified (default always)
+-verifysample=<n>: with verifysigs=sampled, verify one in n (default 100)
+-signers=<n>: processes each gunicorn worker signs and verifies on
+              (default 0, on the request thread)
+-changecost=<satoshis>: excess when choosing coins which is left as fees
+                        rather than making change (default 5460)
+-coinreserve=<seconds>: how long coins chosen for a channel are reserved
+                        if it is never opened (default 600)
+-watchdepth=<blocks>: how many blocks the anchor watcher remembers, and so
+                      the deepest reorg or the longest outage it can
+                      follow (default 100)
+-historykeep=<n>: past states kept in each channel's history log
+                  (default 100000)
+-durability=<full|group|os>: how channel changes reach the disk. full syncs
+                             the database on every commit; group journals
+                             them, sharing one fsync between concurrent
+                             writers; os journals them without syncing, so
+                             they only survive a crash of the server
+                             (default group)
+-journalsize=<bytes>: how much the channel journal grows between
+                      checkpoints (default 1048576)
+-dbconnections=<n>: idle connections to the database each process keeps
+                   (default 8)
+
+The dev server is Flask's development server, forking a process for each
+request, at most 3 at a time. The gunicorn server pre-forks a pool of
+workers, each serving requests on a pool of threads. Each worker holds at
+most connections open (or queued for a thread) at a time, and further
+connections wait in the backlog. Send SIGHUP to the process in the pidfile
+to gracefully replace the workers.
+
+Under gunicorn, signal receivers connected to serverutil.BUS run on a pool
+of threads in each worker. Under the dev server they run inline, and so
+does signing (see signer.py), since each request is a new process.
+
+bitcoind's notifications are read from a FIFO per listening process under
+datadir/notify (see notify.py). Point bitcoind's blocknotify and
+walletnotify at notify.shell_command(datadir/notify). Each gunicorn worker
+listens for itself. The dev server's process forks for every request, so
+it must not be running handlers on other threads, holding locks a child
+would inherit held: a process of its own listens instead, and passes each
+notification on to the /block-notify or /wallet-notify url, which are also
+served for notify.py's command line.
 
 Options except for datadir and conf can be specified in the configuration file.
 Command line options take precedence over configuration file options.
@@ -20,15 +88,19 @@ import argparse
 import config
 import os
 import os.path
+import time
 import json
-import hashlib
 from flask import request, current_app, g
-import bitcoin.rpc
-from bitcoin.wallet import CBitcoinSecret
-from serverutil import app
+import bitcoin
+import jsonrpcproxy
+import bitcoinproxy
+import notify
+import signer
+from serverutil import app, NodeIdentity, BUS
 from serverutil import requires_auth
 from serverutil import WALLET_NOTIFY, BLOCK_NOTIFY
-import channel
+import channelstore
+import watcher # pylint: disable=unused-import
 import lightning
 import local
 
@@ -37,11 +109,18 @@ def before_request():
     """Setup g context"""
     g.config = current_app.config
     g.bit = g.config['bitcoind']
-    secret = hashlib.sha256(g.config['secret']).digest()
-    g.seckey = CBitcoinSecret.from_secret_bytes(secret)
-    g.addr = 'http://localhost:%d/' % int(g.config['port'])
+    g.identity = g.config['identity']
+    g.seckey = g.identity.seckey
+    g.signer = g.config['signer']
+    g.addr = g.identity.url
     g.logger = current_app.logger
 
+@WALLET_NOTIFY.connect_via('server')
+@BLOCK_NOTIFY.connect_via('server')
+def on_notify(dummy_sender, **dummy_kwargs):
+    """Drop cached bitcoind results, since bitcoind's state has changed."""
+    bitcoinproxy.invalidate()
+
 @app.route('/error')
 @requires_auth
 def error():
@@ -73,6 +152,173 @@ def block_notify():
     BLOCK_NOTIFY.send('server', block=request.args['block'])
     return "Done"
 
+def dispatch_notifications(notifications):
+    """Send the signals for a batch of notifications from bitcoind."""
+    with app.test_request_context('/'):
+        app.preprocess_request()
+        for kind, value in notifications:
+            if kind == 'block':
+                BLOCK_NOTIFY.send('server', block=value)
+            else:
+                WALLET_NOTIFY.send('server', tx=value)
+
+def listen(conf):
+    """Start delivering bitcoind's notifications to this process."""
+    listener = notify.NotificationListener(
+        os.path.join(conf['datadir'], 'notify'), dispatch_notifications,
+        window=conf.getfloat('notifywindow'))
+    listener.start()
+    return listener
+
+def forward_notifications(conf):
+    """Return a handler which passes notifications to the server over HTTP."""
+    # Only the dev server's listener process needs requests
+    import requests
+    url = 'http://localhost:%d/' % conf.getint('port')
+    auth = (conf['rpcuser'], conf['rpcpassword'])
+    def forward(notifications):
+        """Request the notification url for each notification.
+
+        A request which fails, or isn't answered in notify.HTTP_TIMEOUT
+        seconds, is logged, and the rest are still sent.
+        """
+        for kind, value in notifications:
+            if kind == 'block':
+                path, params = 'block-notify', {'block': value}
+            else:
+                path, params = 'wallet-notify', {'tx': value}
+            try:
+                requests.get(url + path, params=params, auth=auth,
+                             timeout=notify.HTTP_TIMEOUT)
+            except requests.exceptions.RequestException:
+                app.logger.exception("Failed to forward %s notification %s",
+                                     kind, value)
+    return forward
+
+def listen_apart(conf):
+    """Fork a process which forwards bitcoind's notifications to this one.
+
+    The process exits once this one has. Return its pid.
+    """
+    parent = os.getpid()
+    pid = os.fork()
+    if pid != 0:
+        return pid
+    status = 1
+    try:
+        listener = notify.NotificationListener(
+            os.path.join(conf['datadir'], 'notify'),
+            forward_notifications(conf), window=conf.getfloat('notifywindow'))
+        listener.start()
+        while os.getppid() == parent:
+            time.sleep(1)
+        listener.stop()
+        status = 0
+    except Exception: # pylint: disable=broad-except
+        app.logger.exception("Notification listener failed")
+    finally:
+        os._exit(status) # pylint: disable=protected-access
+
+def gunicorn_options(conf):
+    """Return the gunicorn settings for serving as conf asks."""
+    def post_fork(dummy_server, worker):
+        """Give each worker its own event bus and notification listener."""
+        BUS.maxsize = conf.getint('eventqueue')
+        BUS.start(conf.getint('eventworkers'))
+        worker.notify_listener = listen(conf)
+
+    def worker_exit(dummy_server, worker):
+        """Stop the worker's notification listener, and finish its events."""
+        listener = getattr(worker, 'notify_listener', None)
+        if listener is not None:
+            listener.stop()
+        BUS.stop()
+        app.config['signer'].shutdown()
+
+    def child_exit(dummy_server, worker):
+        """Remove the FIFO of a worker which exited without stopping."""
+        notify.remove(os.path.join(conf['datadir'], 'notify'), worker.pid)
+
+    threads = conf.getint('threads')
+    return {
+        'bind': 'localhost:%d' % conf.getint('port'),
+        'workers': conf.getint('workers'),
+        'threads': threads,
+        'worker_class': 'gthread' if threads > 1 else 'sync',
+        'worker_connections': conf.getint('connections'),
+        'backlog': conf.getint('backlog'),
+        'post_fork': post_fork,
+        'worker_exit': worker_exit,
+        'child_exit': child_exit,
+    }
+
+def serve_gunicorn(conf):
+    """Serve the app from a pre-forked pool of gunicorn workers."""
+    # gunicorn is only needed for this server
+    from gunicorn.app.base import BaseApplication
+    options = gunicorn_options(conf)
+
+    class Application(BaseApplication): # pylint: disable=abstract-method
+        """Gunicorn application serving the Flask app."""
+
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    Application().run()
+
+def configure(conf):
+    """Set up the app as the node conf describes."""
+    if conf.getboolean('regtest'):
+        bitcoin.SelectParams('regtest')
+    else:
+        raise Exception("Non-regnet use not supported")
+
+    port = conf.getint('port')
+    jsonrpcproxy.SESSIONS.maxsize = conf.getint('peerconnections')
+    app.config['secret'] = b'correct horse battery staple' + bytes(str(port), 'utf8')
+    app.config['identity'] = NodeIdentity(app.config['secret'], port)
+    app.config.update(conf)
+    app.config['signer'] = signer.Signer(app.config['identity'],
+                                         workers=conf.getint('signers'))
+    app.config['bitcoind'] = bitcoinproxy.get_pool(
+        'http://%s:%s@localhost:%d' % (conf['bituser'], conf['bitpass'],
+                                       int(conf['bitport'])),
+        size=conf.getint('bitconnections'),
+        ttl=conf.getfloat('bitcache'))
+    app.register_blueprint(channelstore.API)
+    app.register_blueprint(lightning.API)
+    app.register_blueprint(local.API)
+
+def prepare():
+    """Create the tables and replay the channel journal before forking.
+
+    Every process serving requests inherits both, instead of repeating
+    them. The tables (imported from old files, if there are any) must
+    exist before the journal is replayed into them.
+    """
+    with app.test_request_context('/'):
+        app.try_trigger_before_first_request_functions()
+        app.preprocess_request()
+
+def serve(conf):
+    """Run the server selected by conf."""
+    server = conf.get('server')
+    notify.prepare(os.path.join(conf['datadir'], 'notify'))
+    prepare()
+    if conf.getboolean('debug') or server == 'dev':
+        app.config['signer'].workers = 0
+        listen_apart(conf)
+        app.run(port=conf.getint('port'), debug=conf.getboolean('debug'),
+                use_reloader=False, processes=3)
+    elif server == 'gunicorn':
+        serve_gunicorn(conf)
+    else:
+        raise Exception("Unknown server", server)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(argument_default=argparse.SUPPRESS)
     def add_switch(name):
@@ -84,29 +330,39 @@ if __name__ == '__main__':
     parser.add_argument('-conf', default='lightning.conf')
     add_switch('debug')
     parser.add_argument('-port')
+    parser.add_argument('-server')
+    parser.add_argument('-workers')
+    parser.add_argument('-threads')
+    parser.add_argument('-connections')
+    parser.add_argument('-backlog')
+    parser.add_argument('-peerconnections')
+    parser.add_argument('-peertimeout')
+    parser.add_argument('-bitconnections')
+    parser.add_argument('-bitcache')
+    parser.add_argument('-notifywindow')
+    parser.add_argument('-eventworkers')
+    parser.add_argument('-eventqueue')
+    parser.add_argument('-updatewindow')
+    parser.add_argument('-updatetimeout')
+    parser.add_argument('-coalescems')
+    parser.add_argument('-coalescesize')
+    parser.add_argument('-verifysigs')
+    parser.add_argument('-verifysample')
+    parser.add_argument('-signers')
+    parser.add_argument('-changecost')
+    parser.add_argument('-coinreserve')
+    parser.add_argument('-watchdepth')
+    parser.add_argument('-historykeep')
+    parser.add_argument('-durability')
+    parser.add_argument('-journalsize')
+    parser.add_argument('-dbconnections')
     args = parser.parse_args()
-    conf = config.lightning_config(args=vars(args),
-                                   datadir=args.datadir,
-                                   conf=args.conf)
+    node_conf = config.lightning_config(args=vars(args),
+                                        datadir=args.datadir,
+                                        conf=args.conf)
 
-    with open(os.path.join(conf['datadir'], conf['pidfile']), 'w') as pid_file:
+    with open(os.path.join(node_conf['datadir'], node_conf['pidfile']), 'w') as pid_file:
         pid_file.write(str(os.getpid()))
 
-    if conf.getboolean('regtest'):
-        bitcoin.SelectParams('regtest')
-    else:
-        raise Exception("Non-regnet use not supported")
-
-    port = conf.getint('port')
-    app.config['secret'] = b'correct horse battery staple' + bytes(str(port), 'utf8')
-    app.config.update(conf)
-    app.config['bitcoind'] = bitcoin.rpc.Proxy('http://%s:%s@localhost:%d' %
-                                               (conf['bituser'], conf['bitpass'],
-                                                int(conf['bitport'])))
-    app.config['SQLALCHEMY_BINDS'] = {}
-    app.register_blueprint(channel.API)
-    app.register_blueprint(lightning.API)
-    app.register_blueprint(local.API)
-
-    app.run(port=port, debug=conf.getboolean('debug'), use_reloader=False,
-            processes=3)
+    configure(node_conf)
+    serve(node_conf)
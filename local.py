@@ -1,17 +1,20 @@
 """Local (private) API for a lightning node.
 
-Currently this just collects and exposes methods in channel and lightning.
+Currently this just collects and exposes methods in anchors, channel and
+lightning.
 A HTML GUI could also be provided here in the future.
 All requests require authentication.
 """
 
-from serverutil import api_factory, authenticate_before_request
-import channel, lightning
+from serverutil import api_factory, authenticate_before_request, BUS
+import anchors, channel, lightning, transactions
 
 API, REMOTE, Model = api_factory('local')
 
-REMOTE(channel.create)
+REMOTE(anchors.create)
+REMOTE(anchors.create_many)
 REMOTE(lightning.send)
+REMOTE(channel.send_many)
 REMOTE(channel.close)
 REMOTE(channel.getbalance)
 REMOTE(channel.getcommitmenttransactions)
@@ -21,4 +24,10 @@ def alive():
     """Test if the server is ready to handle requests."""
     return True
 
+@REMOTE
+def stats():
+    """Return event bus queue depth and handler latency, and signature
+    verification counts and latency (in microseconds)."""
+    return dict(BUS.get_stats(), verify=transactions.VERIFIER.get_stats())
+
 API.before_request(authenticate_before_request)
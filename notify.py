@@ -1,16 +1,193 @@
 #! /usr/bin/env python3
 
-"""A little curl-ish program."""
-
-import sys
-import requests
-
-PORT = int(sys.argv[3])
-URL = 'http://localhost:%d/' % PORT
-if sys.argv[1] == 'block':
-    URL += 'block-notify?block=%s' % sys.argv[2]
-elif sys.argv[1] == 'wallet':
-    URL += 'wallet-notify?tx=%s' % sys.argv[2]
-else:
-    raise Exception("Unknown notification", sys.argv[1])
-requests.get(URL, auth=('rt', 'rt'))
+"""Deliver bitcoind's block and wallet notifications to lightningd.
+
+bitcoind runs a shell command for every notification. Rather than start a
+Python interpreter and make an HTTP request for each one, every lightningd
+process which wants notifications reads them from its own FIFO in a
+directory, and bitcoind writes to all of them with a line of shell.
+
+A notification is a line "<kind> <value>\\n", where kind is block or wallet,
+and value is the block hash or txid. Lines are shorter than PIPE_BUF, so
+concurrent writers do not interleave.
+
+shell_command -- the line of shell bitcoind should run, given $1 and $2
+prepare -- create the directory, removing FIFOs left by dead processes
+remove -- remove the FIFO of a process which has exited
+NotificationListener -- read notifications from a FIFO in a thread, and hand
+                        them to a handler in deduplicated batches
+write -- write a notification as bitcoind would (a stand-in for tests)
+replay -- hand notifications to a handler in batches as a listener would,
+          without a FIFO (a stand-in for tests)
+
+Run as a script (notify.py <block|wallet> <value> <port>), make an HTTP
+request to lightningd's /block-notify or /wallet-notify instead. A request
+not answered within HTTP_TIMEOUT seconds is given up on and logged, so a
+stuck server doesn't hold up bitcoind's later notifications.
+"""
+
+import os
+import os.path
+import glob
+import time
+import select
+import logging
+import threading
+
+KINDS = ('block', 'wallet')
+LOGGER = logging.getLogger(__name__)
+# Seconds to wait for lightningd to answer a notification sent over HTTP
+HTTP_TIMEOUT = 10
+
+def shell_command(directory):
+    """Return a shell command which writes notification "$1 $2".
+
+    FIFOs of processes which are no longer running are skipped: nothing
+    reads them, and once one filled up the write would block.
+    """
+    return ('for fifo in %s/*.fifo; do '
+            'pid=${fifo##*/}; '
+            '[ ! -p "$fifo" ] || ! kill -0 "${pid%%.fifo}" 2>/dev/null || '
+            'echo "$1 $2" 1<>"$fifo"; done' %
+            os.path.abspath(directory))
+
+def fifo_path(directory, pid):
+    """Return the path of process pid's FIFO in directory."""
+    return os.path.join(directory, '%d.fifo' % pid)
+
+def prepare(directory):
+    """Create directory, and remove any FIFOs in it."""
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, '*.fifo')):
+        os.unlink(path)
+
+def remove(directory, pid):
+    """Remove process pid's FIFO from directory, if it has one."""
+    try:
+        os.unlink(fifo_path(directory, pid))
+    except FileNotFoundError:
+        pass
+
+def parse(data):
+    """Parse notification lines, returning a list of (kind, value)."""
+    notifications = []
+    for line in data.decode('utf8', 'replace').splitlines():
+        fields = line.split()
+        if len(fields) == 2 and fields[0] in KINDS:
+            notifications.append(tuple(fields))
+    return notifications
+
+def dedupe(notifications):
+    """Remove repeated notifications, keeping the first of each."""
+    seen = set()
+    out = []
+    for notification in notifications:
+        if notification not in seen:
+            seen.add(notification)
+            out.append(notification)
+    return out
+
+def write(directory, kind, value):
+    """Write a notification to every FIFO in directory, as bitcoind would."""
+    assert kind in KINDS
+    line = ('%s %s\n' % (kind, value)).encode('utf8')
+    for path in glob.glob(os.path.join(directory, '*.fifo')):
+        fifo = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+        try:
+            os.write(fifo, line)
+        finally:
+            os.close(fifo)
+
+def replay(batches, handler):
+    """Hand each batch of (kind, value) to handler as a listener would."""
+    for batch in batches:
+        batch = dedupe(batch)
+        if batch:
+            handler(batch)
+
+class NotificationListener(object):
+    """Read notifications from a FIFO owned by this process.
+
+    directory -- where to create the FIFO, named for this process's pid
+    handler -- called from the listener thread with a list of (kind, value)
+    window -- seconds after a notification to collect more to batch with it
+
+    Notifications which repeat within a batch are only handled once.
+    """
+
+    def __init__(self, directory, handler, window=0.05):
+        self.path = fifo_path(directory, os.getpid())
+        self.handler = handler
+        self.window = window
+        self._fifo = None
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        """Create the FIFO and start listening."""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        os.mkfifo(self.path, 0o600)
+        # Opening read-write means we never see end of file when writers go
+        self._fifo = os.open(self.path, os.O_RDWR)
+        self._thread = threading.Thread(target=self._listen, daemon=True,
+                                         name='notify')
+        self._thread.start()
+
+    def stop(self):
+        """Stop listening and remove the FIFO."""
+        if self._thread is None:
+            return
+        self._stopping = True
+        os.write(self._fifo, b'\n')
+        self._thread.join()
+        self._thread = None
+        os.close(self._fifo)
+        os.unlink(self.path)
+
+    def _read(self, timeout):
+        """Read whatever is available within timeout seconds."""
+        readable, _, _ = select.select([self._fifo], [], [], timeout)
+        if not readable:
+            return b''
+        return os.read(self._fifo, 4096)
+
+    def _listen(self):
+        """Read batches of notifications until stopped."""
+        buffer = b''
+        while not self._stopping:
+            buffer += self._read(None)
+            deadline = time.monotonic() + self.window
+            while not self._stopping:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                buffer += self._read(remaining)
+            complete, _, buffer = buffer.rpartition(b'\n')
+            batch = dedupe(parse(complete))
+            if batch and not self._stopping:
+                try:
+                    self.handler(batch)
+                except Exception: # pylint: disable=broad-except
+                    LOGGER.exception("Notification handler failed")
+
+def main(argv):
+    """Send a notification to lightningd over HTTP."""
+    # Only the command line needs requests
+    import requests
+    port = int(argv[3])
+    url = 'http://localhost:%d/' % port
+    if argv[1] == 'block':
+        url += 'block-notify?block=%s' % argv[2]
+    elif argv[1] == 'wallet':
+        url += 'wallet-notify?tx=%s' % argv[2]
+    else:
+        raise Exception("Unknown notification", argv[1])
+    try:
+        requests.get(url, auth=('rt', 'rt'), timeout=HTTP_TIMEOUT)
+    except requests.exceptions.RequestException:
+        LOGGER.exception("Failed to notify %s", url)
+
+if __name__ == '__main__':
+    import sys
+    main(sys.argv)
@@ -3,11 +3,28 @@
 This includes the interface from the server implementation to the
 payment channel and lightning network APIs.
 
+NodeIdentity -- the keys and url of this node, derived once at startup
 requires_auth -- decorator which makes a view function require authentication
 authenticate_before_request -- a before_request callback for auth
 api_factory -- returns a flask Blueprint or equivalent, along with a decorator
                making functions availiable as RPCs, and a base class for
-               SQLAlchemy Declarative database models.
+               SQLAlchemy Declarative database models. RPCs are answered in
+               JSON, or in jsonrpcproxy's binary framing when requested.
+database -- the node's database (see NodeDatabase), holding every
+            blueprint's tables
+upgrades_legacy -- decorator registering a function which upgrades a
+                   blueprint's database file from before they were merged
+
+EventBus -- runs signal receivers on a pool of worker threads, off the
+            request which sent the signal
+BUS -- the server's EventBus. Until it is started (in each gunicorn worker),
+       receivers run inline, as ordinary blinker receivers would.
+LockRegistry -- named locks which exclude other threads and other processes
+LOCKS -- the server's LockRegistry
+GenerationCounters -- counters in shared memory, bumped when a named thing
+                      changes, so processes can tell their copies are stale
+after_fork -- returns a check which resets per-process state, such as
+              threads and locks, in each process which runs it
 
 Signals:
 WALLET_NOTIFY: sent when bitcoind tells us it has a transaction.
@@ -16,24 +33,409 @@ BLOCK_NOTIFY: send when bitcoind tells us it has a block
 - block = block hash
 """
 
+import os
 import os.path
+import time
+import mmap
+import fcntl
+import struct
+import hashlib
+import threading
+from collections import deque
+from contextlib import contextmanager
 from functools import wraps
 from flask import Flask, current_app, Response, request, Blueprint
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import DisconnectionError
+from sqlalchemy.pool import QueuePool, NullPool
 from sqlalchemy.types import TypeDecorator
-from blinker import Namespace
+from blinker import Namespace, ANY
 from sqlalchemy import LargeBinary, Text
 from jsonrpc.backend.flask import JSONRPCAPI
+from jsonrpc import JSONRPCResponseManager
 import bitcoin.core.serialize
-from jsonrpcproxy import SmartDispatcher
+from bitcoin.wallet import CBitcoinSecret
+from jsonrpcproxy import SmartDispatcher, BINARY_CONTENT_TYPE, handle_binary
+
+# The file in datadir holding every blueprint's tables
+DATABASE_FILE = 'node.dat'
+
+# How often the database syncs, by durability (see channelstore.channel_journal)
+SYNCHRONOUS = {'full': 'FULL', 'group': 'NORMAL', 'os': 'OFF'}
+
+class NodeDatabase(SQLAlchemy):
+    """SQLAlchemy, set up for a node's database.
+
+    The database is in WAL mode, so readers don't wait for writers, and
+    syncs as often as the durability config option asks. Each process
+    keeps a pool of connections (dbconnections idle at most); a child
+    process discards any it inherits from its parent.
+    """
+
+    def apply_driver_hacks(self, app, sa_url, options): # pylint: disable=redefined-outer-name
+        sa_url, options = super(NodeDatabase, self).apply_driver_hacks(
+            app, sa_url, options)
+        if sa_url.drivername == 'sqlite' and \
+           sa_url.database not in (None, '', ':memory:'):
+            options['poolclass'] = QueuePool
+            options['pool_size'] = int(app.config['dbconnections'])
+            # Threads waiting on each other never wait for a connection
+            options['max_overflow'] = -1
+            options.setdefault('connect_args', {})['check_same_thread'] = False
+            options['synchronous'] = SYNCHRONOUS[app.config['durability']]
+        return sa_url, options
+
+    def create_engine(self, sa_url, engine_opts):
+        synchronous = engine_opts.pop('synchronous', None)
+        engine = super(NodeDatabase, self).create_engine(sa_url, engine_opts)
+        if synchronous is not None:
+            configure_engine(engine, synchronous)
+        return engine
+
+def configure_engine(engine, synchronous):
+    """Put each connection engine makes in WAL mode, syncing as given."""
+    def on_connect(dbapi_connection, connection_record):
+        """Set up a new connection."""
+        connection_record.info['pid'] = os.getpid()
+        dbapi_connection.execute('PRAGMA journal_mode=WAL')
+        dbapi_connection.execute('PRAGMA synchronous=' + synchronous)
+    def on_checkout(dummy_dbapi_connection, connection_record,
+                    connection_proxy):
+        """Refuse a connection made by a parent process."""
+        if connection_record.info['pid'] != os.getpid():
+            connection_record.connection = connection_proxy.connection = None
+            raise DisconnectionError("Connection made by another process")
+    event.listen(engine, 'connect', on_connect)
+    event.listen(engine, 'checkout', on_checkout)
 
 app = Flask(__name__)
-database = SQLAlchemy(app)
+database = NodeDatabase(app)
 
 SIGNALS = Namespace()
 WALLET_NOTIFY = SIGNALS.signal('WALLET_NOTIFY')
 BLOCK_NOTIFY = SIGNALS.signal('BLOCK_NOTIFY')
 
+class NodeIdentity(object):
+    """The keys and url of this node.
+
+    Built once at startup and shared by every request (and every worker).
+    seckey -- the node's CBitcoinSecret. Each thread gets its own copy, so
+              its signing context is reused across requests on that thread.
+    pubkey -- the node's public key, as bytes
+    url -- the url other nodes know this node by
+    """
+
+    def __init__(self, secret, port):
+        self.secret = hashlib.sha256(secret).digest()
+        self._local = threading.local()
+        self.pubkey = bytes(self.seckey.pub)
+        self.url = 'http://localhost:%d/' % port
+
+    @property
+    def seckey(self):
+        """This thread's CBitcoinSecret for the node key."""
+        try:
+            return self._local.seckey
+        except AttributeError:
+            self._local.seckey = CBitcoinSecret.from_secret_bytes(self.secret)
+            return self._local.seckey
+
+def after_fork(reset):
+    """Return a function which calls reset the first time it runs in a process.
+
+    Threads, pools, open files and locks held by other threads don't survive
+    fork. Objects holding them set them up in reset, and run the check
+    before using them, so a forked process sets up its own.
+    """
+    pid = [None]
+    def check():
+        """Call reset if this process has not."""
+        if pid[0] != os.getpid():
+            pid[0] = os.getpid()
+            reset()
+    return check
+
+class Stats(object):
+    """Running totals for a handler.
+
+    count -- times it has run
+    failures -- times it has raised an exception
+    total -- total time spent running it, in microseconds
+    max -- the longest it has taken, in microseconds
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.failures = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, elapsed, failed):
+        """Record a run which took elapsed seconds."""
+        elapsed = int(elapsed * 1000000)
+        self.count += 1
+        self.failures += int(failed)
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+
+    def as_dict(self):
+        """Return the totals as a dict."""
+        return {'count': self.count, 'failures': self.failures,
+                'total': self.total, 'max': self.max}
+
+class EventBus(object):
+    """Run signal receivers on a pool of worker threads.
+
+    Receivers connected with connect run in a fresh request context, after
+    the app's before_request hooks. Jobs with the same key run one at a time,
+    in the order their signals were sent. Jobs with no key are unordered.
+    At most maxsize jobs may be waiting at once; beyond that, sending a
+    signal blocks until a job finishes. Signals sent by jobs never block,
+    since the workers they would wait for may all be waiting too, and
+    queue past maxsize instead.
+
+    Until start is called, receivers run inline when the signal is sent.
+    The dev server forks a process per request, which exits when the request
+    is answered, so work must not be left for it to do later.
+    """
+
+    def __init__(self, flask_app, maxsize=256):
+        self.app = flask_app
+        self.maxsize = maxsize
+        self.stats = {}
+        self.depth = 0
+        self.max_depth = 0
+        self._receivers = []
+        self._cond, self._ready, self._keys, self._threads = None, None, {}, []
+        self._check_fork = after_fork(self._reset)
+        self._check_fork()
+
+    def _reset(self):
+        """Drop workers and queued jobs inherited from a parent process."""
+        self._cond = threading.Condition()
+        self._ready = deque()
+        self._keys = {}
+        self._threads = []
+        self.depth = 0
+
+    def connect(self, signal, sender=ANY, key=None):
+        """Decorator which connects an asynchronous receiver to signal.
+
+        key -- the name of the signal argument which orders jobs
+        """
+        def decorator(receiver):
+            """Connect receiver."""
+            name = '%s.%s' % (receiver.__module__, receiver.__name__)
+            self.stats[name] = Stats()
+            def enqueue(sent_by, **kwargs):
+                """Queue a job for receiver."""
+                job = (name, receiver, sent_by, kwargs)
+                self.submit(job, None if key is None else kwargs.get(key))
+            self._receivers.append(enqueue)
+            signal.connect(enqueue, sender=sender, weak=False)
+            return receiver
+        return decorator
+
+    @property
+    def running(self):
+        """True if jobs are being run by workers."""
+        self._check_fork()
+        return bool(self._threads)
+
+    def start(self, workers):
+        """Start workers to run jobs."""
+        self._check_fork()
+        for dummy_index in range(workers):
+            thread = threading.Thread(target=self._work, daemon=True,
+                                      name='event-bus')
+            self._threads.append(thread)
+            thread.start()
+
+    def stop(self):
+        """Run the queued jobs, then stop the workers."""
+        self.join()
+        threads, self._threads = self._threads, []
+        with self._cond:
+            for dummy_thread in threads:
+                self._ready.append(None)
+            self._cond.notify_all()
+        for thread in threads:
+            thread.join()
+
+    def submit(self, job, key=None):
+        """Queue job, or run it now if no workers are running."""
+        if not self.running:
+            self._run(job, inline=True)
+            return
+        from_worker = threading.current_thread() in self._threads
+        with self._cond:
+            while self.depth >= self.maxsize and not from_worker:
+                self._cond.wait()
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+            if key is None:
+                self._ready.append((key, job))
+            elif key in self._keys:
+                self._keys[key].append(job)
+            else:
+                self._keys[key] = deque()
+                self._ready.append((key, job))
+            self._cond.notify_all()
+
+    def join(self):
+        """Wait until no jobs are queued or running."""
+        with self._cond:
+            while self.depth:
+                self._cond.wait()
+
+    def _work(self):
+        """Run jobs until stopped."""
+        while True:
+            with self._cond:
+                while not self._ready:
+                    self._cond.wait()
+                item = self._ready.popleft()
+            if item is None:
+                return
+            key, job = item
+            self._run(job)
+            with self._cond:
+                self.depth -= 1
+                if key is not None:
+                    if self._keys[key]:
+                        self._ready.append((key, self._keys[key].popleft()))
+                    else:
+                        del self._keys[key]
+                self._cond.notify_all()
+
+    def _run(self, job, inline=False):
+        """Run a job, recording its stats."""
+        name, receiver, sent_by, kwargs = job
+        start = time.monotonic()
+        failed = True
+        try:
+            if inline:
+                receiver(sent_by, **kwargs)
+            else:
+                with self.app.test_request_context('/'):
+                    self.app.preprocess_request()
+                    receiver(sent_by, **kwargs)
+            failed = False
+        except Exception: # pylint: disable=broad-except
+            if inline:
+                raise
+            self.app.logger.exception("Event handler %s failed", name)
+        finally:
+            with self._cond:
+                self.stats[name].record(time.monotonic() - start, failed)
+
+    def get_stats(self):
+        """Return queue depth and per-handler stats."""
+        return {'depth': self.depth, 'max_depth': self.max_depth,
+                'handlers': {name: stats.as_dict()
+                             for name, stats in self.stats.items()}}
+
+BUS = EventBus(app)
+
+class LockRegistry(object):
+    """Named locks, shared by threads and processes using the same directory.
+
+    Each name has a lock file in the directory, locked with flock while
+    held. Within a process, threads take a lock per name first, so a thread
+    may take a lock it already holds. Locks are not inherited across fork.
+    """
+
+    def __init__(self):
+        self._lock, self._locks = None, {}
+        self._check_fork = after_fork(self._reset)
+        self._check_fork()
+
+    def _reset(self):
+        """Forget locks opened by a parent process."""
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    def _get(self, directory, name):
+        """Return [thread lock, lock file, depth] for name."""
+        self._check_fork()
+        path = os.path.join(
+            directory,
+            hashlib.sha256(name.encode('utf8')).hexdigest()[:32] + '.lock')
+        with self._lock:
+            entry = self._locks.get(path)
+            if entry is None:
+                os.makedirs(directory, exist_ok=True)
+                lock_file = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+                entry = self._locks[path] = [threading.RLock(), lock_file, 0]
+            return entry
+
+    @contextmanager
+    def hold(self, directory, name):
+        """Hold the lock on name for the duration of the with block."""
+        entry = self._get(directory, name)
+        with entry[0]:
+            if entry[2] == 0:
+                fcntl.flock(entry[1], fcntl.LOCK_EX)
+            entry[2] += 1
+            try:
+                yield
+            finally:
+                entry[2] -= 1
+                if entry[2] == 0:
+                    fcntl.flock(entry[1], fcntl.LOCK_UN)
+
+LOCKS = LockRegistry()
+
+class GenerationCounters(object):
+    """Counters in a file mapped into every process which opens it.
+
+    Names are hashed onto a fixed number of slots, each holding a counter.
+    Bump a name's counter after changing the thing it names; a copy made
+    when the counter had another value may be stale. Names sharing a slot
+    only cause extra reloads.
+    """
+
+    SLOT = struct.Struct('<Q')
+
+    def __init__(self, path, slots=4096):
+        self.slots = slots
+        self._lock = None
+        self._check_fork = after_fork(self._reset)
+        self._check_fork()
+        self._file = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = slots * self.SLOT.size
+        if os.fstat(self._file).st_size < size:
+            os.ftruncate(self._file, size)
+        self._map = mmap.mmap(self._file, size)
+
+    def _reset(self):
+        """Replace a lock which a parent process's thread may have held."""
+        self._lock = threading.Lock()
+
+    def _offset(self, name):
+        """Return the offset of name's slot."""
+        digest = hashlib.sha256(name.encode('utf8')).digest()
+        return int.from_bytes(digest[:8], 'little') % self.slots * self.SLOT.size
+
+    def get(self, name):
+        """Return the counter for name."""
+        return self.SLOT.unpack_from(self._map, self._offset(name))[0]
+
+    def bump(self, name):
+        """Increment the counter for name, and return its new value."""
+        offset = self._offset(name)
+        self._check_fork()
+        # Record locks exclude other processes, but not our own threads
+        with self._lock:
+            fcntl.lockf(self._file, fcntl.LOCK_EX, self.SLOT.size, offset)
+            try:
+                value = self.SLOT.unpack_from(self._map, offset)[0] + 1
+                self.SLOT.pack_into(self._map, offset, value)
+            finally:
+                fcntl.lockf(self._file, fcntl.LOCK_UN, self.SLOT.size, offset)
+        return value
+
 # Copied from http://flask.pocoo.org/snippets/8/
 def check_auth(username, password):
     """This function is called to check if a username /
@@ -69,45 +471,129 @@ def authenticate_before_request():
     """before_request callback to perform authentication."""
     return requires_auth(lambda: None)()
 
+# Functions bringing a blueprint's old database file up to date, by name
+LEGACY_UPGRADES = {}
+
+def upgrades_legacy(name):
+    """Decorator registering a function which upgrades blueprint name's old
+    database file, given an engine for it, before it is imported."""
+    def decorator(upgrade):
+        """Register upgrade."""
+        LEGACY_UPGRADES[name] = upgrade
+        return upgrade
+    return decorator
+
+def import_legacy(engine, name, tables, path):
+    """Copy blueprint name's tables from its old database file at path.
+
+    Blueprints used to keep their tables in files of their own, by the
+    names their tables now have without the blueprint's prefix. Columns
+    the file lacks are left to their defaults, and rows already imported
+    are skipped, so an import interrupted before the file is renamed is
+    simply repeated.
+    """
+    upgrade = LEGACY_UPGRADES.get(name)
+    if upgrade is not None:
+        legacy = create_engine('sqlite:///' + path, poolclass=NullPool)
+        upgrade(legacy)
+        legacy.dispose()
+    connection = engine.connect()
+    try:
+        # Attaching can't be done inside a transaction
+        connection.execute('ATTACH DATABASE ? AS legacy', path)
+        try:
+            existing = {row[0] for row in connection.execute(
+                "SELECT name FROM legacy.sqlite_master WHERE type = 'table'")}
+            with connection.begin():
+                for table in tables:
+                    old_name = table.name[len(name) + 1:]
+                    if old_name not in existing:
+                        continue
+                    old_columns = {row[1] for row in connection.execute(
+                        'PRAGMA legacy.table_info(%s)' % old_name)}
+                    columns = ', '.join(column.name for column in table.columns
+                                        if column.name in old_columns)
+                    connection.execute(
+                        'INSERT OR IGNORE INTO main.%s (%s) SELECT %s '
+                        'FROM legacy.%s' % (table.name, columns, columns,
+                                            old_name))
+        finally:
+            connection.execute('DETACH DATABASE legacy')
+    finally:
+        connection.close()
+    os.replace(path, path + '.imported')
+
 def api_factory(name):
     """Construct a Blueprint and a REMOTE decorator to set up an API.
 
     RPC calls are availiable at the url /name/
+
+    Every blueprint's tables are in one database, datadir/DATABASE_FILE,
+    so a change to several blueprints' tables commits atomically. Each
+    table name is prefixed with the blueprint's name and an underscore.
     """
     api = Blueprint(name, __name__, url_prefix='/'+name)
+    models = []
 
     # set up the database
-    def setup_bind(state):
-        """Add the database to the config."""
-        database_path = os.path.join(state.app.config['datadir'], name + '.dat')
-        state.app.config['SQLALCHEMY_BINDS'][name] = 'sqlite:///' + database_path
-    api.record_once(setup_bind)
+    def setup_database(state):
+        """Point the app at the node's database."""
+        database_path = os.path.join(state.app.config['datadir'],
+                                     DATABASE_FILE)
+        state.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + \
+                                                      database_path
+    api.record_once(setup_database)
     def initialize_database():
-        """Create the database."""
-        database.create_all(name)
+        """Create the blueprint's tables, importing them from an old file."""
+        datadir = current_app.config['datadir']
+        engine = database.get_engine(current_app)
+        tables = [model.__table__ for model in models]
+        # Every worker does this when it starts
+        with LOCKS.hold(os.path.join(datadir, 'locks'), 'database'):
+            database.Model.metadata.create_all(engine, tables=tables)
+            path = os.path.join(datadir, name + '.dat')
+            if os.path.exists(path):
+                import_legacy(engine, name, tables, path)
     api.before_app_first_request(initialize_database)
 
     # create a base class for models
-    class BoundMeta(type(database.Model)):
-        """Metaclass for Model which allows __abstract__ base classes."""
+    class NamespacedMeta(type(database.Model)):
+        """Metaclass for Model which prefixes table names with name."""
         def __init__(self, cls_name, bases, attrs):
-            assert '__bind_key__' not in attrs
-            if not attrs.get('__abstract__', False):
-                attrs['__bind_key__'] = name
-            super(BoundMeta, self).__init__(cls_name, bases, attrs)
-    class BoundModel(database.Model, metaclass=BoundMeta):
-        """Base class for models which have __bind_key__ set automatically."""
+            abstract = attrs.get('__abstract__', False)
+            if not abstract:
+                self.__tablename__ = name + '_' + attrs['__tablename__']
+            super(NamespacedMeta, self).__init__(cls_name, bases, attrs)
+            if not abstract:
+                models.append(self)
+    class NamespacedModel(database.Model, metaclass=NamespacedMeta):
+        """Base class for models whose tables are in name's namespace."""
         __abstract__ = True
         query = object.__getattribute__(database.Model, 'query')
         def __init__(self, *args, **kwargs):
-            super(BoundModel, self).__init__(*args, **kwargs)
+            super(NamespacedModel, self).__init__(*args, **kwargs)
 
-    # create a JSON-RPC API endpoint
+    # create a JSON-RPC API endpoint, which also accepts binary framing
     rpc_api = JSONRPCAPI(SmartDispatcher())
     assert type(rpc_api.dispatcher == SmartDispatcher)
-    api.add_url_rule('/', 'rpc', rpc_api.as_view(), methods=['POST'])
-
-    return api, rpc_api.dispatcher.add_method, BoundModel
+    json_view = rpc_api.as_view()
+    def rpc():
+        """Answer an RPC request in the framing it was sent in."""
+        if request.mimetype == BINARY_CONTENT_TYPE:
+            return Response(handle_binary(rpc_api.dispatcher,
+                                          request.get_data()),
+                            content_type=BINARY_CONTENT_TYPE)
+        data = request.get_data()
+        if data.lstrip().startswith(b'['):
+            # JSONRPCAPI's view assumes a single request, so answer batches
+            response = JSONRPCResponseManager.handle(
+                data.decode('utf8', 'replace'), rpc_api.dispatcher)
+            return Response(response.json if response is not None else '',
+                            content_type='application/json')
+        return json_view()
+    api.add_url_rule('/', 'rpc', rpc, methods=['POST'])
+
+    return api, rpc_api.dispatcher.add_method, NamespacedModel
 
 class ImmutableSerializableType(TypeDecorator):
     """Converts bitcoin-lib ImmutableSerializable instances for the DB."""
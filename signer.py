@@ -0,0 +1,156 @@
+"""Sign and verify with the node key, off the request threads.
+
+Signer -- signs sighashes with the node key and verifies signatures and
+          scripts, returning futures. With workers, the work is done on a
+          pool of processes, each of which loads the node key once, so
+          requests signing for many channels at once use every core.
+          Without workers, the work is done when it is submitted, and the
+          futures returned are already done.
+
+Signatures are returned as DER, without a hashtype byte.
+
+Transactions are passed to the pool serialized, since python-bitcoinlib's
+immutable types can't be pickled.
+"""
+
+import threading
+import multiprocessing
+from concurrent.futures import Future
+from bitcoin.core import CTransaction
+from bitcoin.core.key import CPubKey
+from bitcoin.core.script import CScript
+from bitcoin.core.scripteval import VerifyScript, SCRIPT_VERIFY_P2SH
+from bitcoin.wallet import CBitcoinSecret
+
+# The node key, in a pool process
+_KEY = None
+
+def _load_key(secret):
+    """Load the node key in a new pool process."""
+    global _KEY # pylint: disable=global-statement
+    _KEY = CBitcoinSecret.from_secret_bytes(secret)
+
+def _sign_in_pool(sighashes):
+    """Sign each sighash with the node key, in a pool process."""
+    return [_KEY.sign(sighash) for sighash in sighashes]
+
+def _verify(pubkey, sighash, sig):
+    """Return True if sig is pubkey's signature of sighash."""
+    return bool(CPubKey(pubkey).verify(sighash, sig))
+
+def _verify_script(script_sig, script_pubkey, transaction, index):
+    """Verify a serialized transaction's input index. Raise on failure."""
+    VerifyScript(CScript(script_sig), CScript(script_pubkey),
+                 CTransaction.deserialize(transaction), index,
+                 (SCRIPT_VERIFY_P2SH,))
+
+def _done(function, *args):
+    """Run function now, returning a Future of its outcome."""
+    future = Future()
+    try:
+        future.set_result(function(*args))
+    except Exception as err: # pylint: disable=broad-except
+        future.set_exception(err)
+    return future
+
+class Signer(object):
+    """Sign and verify for a node, optionally on a pool of processes.
+
+    identity -- the node's serverutil.NodeIdentity
+    workers -- processes in the pool, or 0 to work on the calling thread
+    batch -- the most sighashes sign_many sends to a process at once
+
+    The pool is started on first use in each process, since a process pool
+    does not survive fork.
+    """
+
+    def __init__(self, identity, workers=0, batch=16):
+        self.identity = identity
+        self.workers = workers
+        self.batch = batch
+        # Pool processes import this module, but needn't load the server
+        from serverutil import after_fork
+        self._lock, self._pool = None, None
+        self._check_fork = after_fork(self._reset)
+        self._check_fork()
+
+    def _reset(self):
+        """Forget the pool started by a parent process."""
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def _submit(self, function, *args):
+        """Run function on this process's pool, returning a Future.
+
+        The pool is started if needed.
+        """
+        self._check_fork()
+        with self._lock:
+            if self._pool is None:
+                # forkserver, since our threads don't survive fork either.
+                # A multiprocessing pool, since ProcessPoolExecutor only
+                # takes a context and an initializer from Python 3.7.
+                self._pool = multiprocessing.get_context('forkserver').Pool(
+                    self.workers, initializer=_load_key,
+                    initargs=(self.identity.secret,))
+            future = Future()
+            self._pool.apply_async(function, args,
+                                   callback=future.set_result,
+                                   error_callback=future.set_exception)
+            return future
+
+    def sign_many(self, sighashes):
+        """Sign each sighash. Return a Future of the signature for each."""
+        sighashes = list(sighashes)
+        if not self.workers:
+            seckey = self.identity.seckey
+            return [_done(seckey.sign, sighash) for sighash in sighashes]
+        futures = [Future() for sighash in sighashes]
+        for start in range(0, len(sighashes), self.batch):
+            chunk = futures[start:start + self.batch]
+            job = self._submit(_sign_in_pool,
+                               sighashes[start:start + self.batch])
+            job.add_done_callback(
+                lambda job, chunk=chunk: self._deliver(job, chunk))
+        return futures
+
+    @staticmethod
+    def _deliver(job, futures):
+        """Pass the outcome of a batch on to the future for each item."""
+        if job.exception() is not None:
+            for future in futures:
+                future.set_exception(job.exception())
+        else:
+            for future, result in zip(futures, job.result()):
+                future.set_result(result)
+
+    def sign(self, sighash):
+        """Sign sighash. Return a Future of the signature."""
+        return self.sign_many([sighash])[0]
+
+    def verify(self, pubkey, sighash, sig):
+        """Return a Future of whether sig is pubkey's signature of sighash."""
+        if not self.workers:
+            return _done(_verify, pubkey, sighash, sig)
+        return self._submit(_verify, bytes(pubkey), sighash, sig)
+
+    def verify_script(self, script_sig, script_pubkey, transaction, index=0):
+        """Verify input index of transaction.
+
+        Return a Future which raises if verification fails.
+        """
+        if not self.workers:
+            return _done(VerifyScript, script_sig, script_pubkey,
+                         transaction, index, (SCRIPT_VERIFY_P2SH,))
+        return self._submit(
+            _verify_script, bytes(script_sig), bytes(script_pubkey),
+            transaction.serialize(), index)
+
+    def shutdown(self):
+        """Stop this process's pool, if it has one."""
+        self._check_fork()
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+            self._pool = None
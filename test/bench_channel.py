@@ -0,0 +1,119 @@
+#! /usr/bin/env python3
+
+"""Benchmarks for channel.py.
+
+Compare signing a commitment by building the transaction and computing
+SignatureHash (as before commitment templates) with signing from the
+channel's cached template, and the sighash alone for each.
+
+Compare signing from many threads at once on the request threads with
+signing on a signer.Signer's pool of processes.
+
+Run as python -m test.bench_channel
+"""
+
+import os
+import time
+import timeit
+import hashlib
+import threading
+import bitcoin
+from flask import g
+from bitcoin.core import COutPoint
+from bitcoin.core.script import SignatureHash, SIGHASH_ALL
+from bitcoin.wallet import P2PKHBitcoinAddress
+from serverutil import app, NodeIdentity
+from signer import Signer
+from channelstore import Channel
+from transactions import anchor_script
+bitcoin.SelectParams('regtest')
+
+ALICE = NodeIdentity(b'alice', 9001)
+BOB = NodeIdentity(b'bob', 9002)
+
+def make_channel():
+    """A channel from Alice to Bob, not in any database."""
+    return Channel(
+        address=BOB.url, anchor_point=COutPoint(b'\x01' * 32, 0),
+        anchor_index=1, their_sig=b'',
+        anchor_redeem=anchor_script(BOB.pubkey, ALICE.pubkey),
+        our_balance=1000000,
+        our_script=P2PKHBitcoinAddress.from_bytes(
+            b'\x02' * 20).to_scriptPubKey(),
+        their_balance=1000000,
+        their_script=P2PKHBitcoinAddress.from_bytes(
+            b'\x03' * 20).to_scriptPubKey())
+
+def built_sighash(chan):
+    """Build the commitment and compute its sighash, as before templates."""
+    return SignatureHash(chan.anchor_redeem, chan.commitment(), 0, SIGHASH_ALL)
+
+def template_sighash(chan):
+    """Compute the commitment's sighash from its template."""
+    outputs = chan.commitment_outputs()
+    return chan.template(outputs).sighash(outputs[0][0], outputs[1][0])
+
+def built_signature(chan):
+    """Sign the commitment, as before templates."""
+    return chan.signature(chan.commitment())
+
+def template_signature(chan):
+    """Sign the commitment from its template."""
+    return chan.commitment_signature()
+
+def rate(function, chan, number):
+    """Return calls per second, moving a satoshi between calls."""
+    def call():
+        chan.our_balance -= 1
+        chan.their_balance += 1
+        function(chan)
+    return number / min(timeit.repeat(call, number=number, repeat=3))
+
+def parallel_rate(workers, threads=8, per_thread=500, batch=16):
+    """Return signatures per second, signing from threads at once."""
+    signer = Signer(ALICE, workers=workers, batch=batch)
+    sighashes = [hashlib.sha256(bytes([i % 256, i // 256])).digest()
+                 for i in range(per_thread)]
+    signer.sign(sighashes[0]).result()  # start the pool
+    def work():
+        """Sign per_thread sighashes, a batch at a time."""
+        for start in range(0, per_thread, batch):
+            for future in signer.sign_many(sighashes[start:start + batch]):
+                future.result()
+    workers_threads = [threading.Thread(target=work) for _ in range(threads)]
+    start = time.monotonic()
+    for thread in workers_threads:
+        thread.start()
+    for thread in workers_threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+    signer.shutdown()
+    return threads * per_thread / elapsed
+
+def parallel():
+    """Print signing throughput from many threads, inline and pooled."""
+    print("%-12s %12s" % ('signers', 'signatures/s'))
+    for workers in sorted({0, 1, 2, os.cpu_count() or 1}):
+        print("%-12d %12.0f" % (workers, parallel_rate(workers)))
+
+def main(number=2000):
+    """Print a comparison table."""
+    chan = make_channel()
+    with app.test_request_context('/'):
+        g.seckey = ALICE.seckey
+        g.signer = Signer(ALICE)
+        assert built_sighash(chan) == template_sighash(chan)
+        print("%-12s %12s %12s %8s" % ('operation', 'built/s', 'template/s',
+                                       'speedup'))
+        for name, built, template in [
+                ('sighash', built_sighash, template_sighash),
+                ('signature', built_signature, template_signature)]:
+            before = rate(built, chan, number)
+            after = rate(template, chan, number)
+            print("%-12s %12.0f %12.0f %7.1fx" % (name, before, after,
+                                                  after / before))
+    print()
+    parallel()
+
+if __name__ == '__main__':
+    main()
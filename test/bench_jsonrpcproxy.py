@@ -0,0 +1,169 @@
+#! /usr/bin/env python3
+
+"""Benchmarks for jsonrpcproxy.py.
+
+Compare the size and encode/decode time of the JSON translation and the
+binary framing on realistic channel messages.
+
+Compare the type-dispatched to_json/from_json with the previous linear
+isinstance chains (kept here as linear_to_json/linear_from_json) on
+listunspent-sized lists of coins, as passed to open_channel.
+
+Run as python -m test.bench_jsonrpcproxy
+"""
+
+import json
+import timeit
+import bitcoin
+from bitcoin.core import CMutableTransaction, CMutableTxIn, CMutableTxOut
+from bitcoin.core import COutPoint
+from bitcoin.core.script import CScript, OP_CHECKMULTISIG
+from bitcoin.wallet import P2PKHBitcoinAddress
+from jsonrpcproxy import to_json, from_json, to_binary, from_binary
+from jsonrpcproxy import HOOKS, ConversionError
+bitcoin.SelectParams('regtest')
+
+PUBKEY = b'\x02' + b'\x11' * 32
+ADDRESS = P2PKHBitcoinAddress.from_bytes(b'\x22' * 20)
+REDEEM = CScript([2, PUBKEY, b'\x03' + b'\x33' * 32, 2, OP_CHECKMULTISIG])
+SIGNATURE = b'\x30\x45' + b'\x44' * 69 + b'\x01'
+
+def coin(index):
+    """A signed input spending a P2PKH output."""
+    return CMutableTxIn(COutPoint(bytes([index]) * 32, index),
+                        CScript([SIGNATURE, PUBKEY]))
+
+def output(value):
+    """A P2PKH output."""
+    return CMutableTxOut(value, ADDRESS.to_scriptPubKey())
+
+MESSAGES = [
+    ('open_channel request', {
+        'jsonrpc': '2.0', 'id': 0, 'method': 'open_channel',
+        'params': ['http://localhost:9333/', 25000000, 50000000, 10000,
+                   [coin(1), coin(2)], output(1234567), PUBKEY, ADDRESS]}),
+    ('open_channel response', {
+        'jsonrpc': '2.0', 'id': 0,
+        'result': [CMutableTransaction(
+            [coin(i) for i in range(4)],
+            [CMutableTxOut(75020000, REDEEM.to_p2sh_scriptPubKey()),
+             output(1234567), output(7654321)]),
+                   REDEEM, ADDRESS]}),
+    ('propose_update response', {
+        'jsonrpc': '2.0', 'id': 0, 'result': SIGNATURE}),
+    ('update batch (50 routes)', [
+        {'jsonrpc': '2.0', 'id': i, 'method': 'update',
+         'params': ['http://localhost:9333/',
+                    'http://localhost:%d/' % (10000 + i), 10000 * i]}
+        for i in range(50)]),
+]
+
+def encode_json(message):
+    """Translate and serialize as JSON."""
+    return json.dumps(to_json(message)).encode('utf8')
+
+def decode_json(data):
+    """Parse and translate JSON."""
+    return from_json(json.loads(data.decode('utf8')))
+
+def measure(function, argument, number):
+    """Return microseconds per call."""
+    return min(timeit.repeat(lambda: function(argument),
+                             number=number, repeat=3)) / number * 1e6
+
+def linear_to_json(message):
+    """to_json as it was before type dispatch."""
+    if isinstance(message, list) or isinstance(message, tuple):
+        return [linear_to_json(sub) for sub in message]
+    elif isinstance(message, dict):
+        assert '__class__' not in message
+        return {linear_to_json(key):linear_to_json(message[key])
+                for key in message}
+    elif isinstance(message, int) or isinstance(message, str):
+        return message
+    elif message is None:
+        return {'__class__':'None'}
+    else:
+        for cls, codes in HOOKS:
+            if isinstance(message, cls):
+                out = codes[0](message)
+                assert '__class__' not in out
+                out['__class__'] = cls.__name__
+                return out
+        raise ConversionError("Unable to convert", message)
+
+def linear_from_json(message):
+    """from_json as it was before type dispatch."""
+    if isinstance(message, list) or isinstance(message, tuple):
+        return [linear_from_json(sub) for sub in message]
+    elif isinstance(message, int) or isinstance(message, str):
+        return message
+    elif isinstance(message, dict):
+        if '__class__' not in message:
+            return {linear_from_json(key):linear_from_json(message[key])
+                    for key in message}
+        elif message['__class__'] == 'None':
+            return None
+        else:
+            for cls, codes in HOOKS:
+                if message['__class__'] == cls.__name__:
+                    return codes[1](message)
+    raise ConversionError("Unable to convert", message)
+
+def unspent(count):
+    """A listunspent-like structure with count coins."""
+    return [{'outpoint': COutPoint(bytes([i % 256]) * 32, i),
+             'address': ADDRESS,
+             'scriptPubKey': ADDRESS.to_scriptPubKey(),
+             'amount': 100000 * i,
+             'confirmations': i,
+             'spendable': True,
+             'account': None}
+            for i in range(count)]
+
+def coins(count):
+    """An open_channel their_coins list with count inputs."""
+    return [coin(i % 256) for i in range(count)]
+
+def dispatch(number=20):
+    """Print per-element translation cost for growing structures."""
+    print("%-26s %6s %11s %11s %11s %11s" % (
+        'structure', 'count', 'linear enc', 'table enc',
+        'linear dec', 'table dec'))
+    for name, build in [('their_coins', coins), ('listunspent', unspent)]:
+        for count in [10, 100, 1000]:
+            message = build(count)
+            if name == 'listunspent':
+                # COutPoint has no hook, so pass the outpoints as bytes
+                for sub in message:
+                    sub['outpoint'] = sub['outpoint'].serialize()
+            encoded = to_json(message)
+            assert linear_to_json(message) == encoded
+            assert linear_from_json(encoded) == from_json(encoded)
+            print("%-26s %6d %9.2fus %9.2fus %9.2fus %9.2fus" % (
+                name, count,
+                measure(linear_to_json, message, number) / count,
+                measure(to_json, message, number) / count,
+                measure(linear_from_json, encoded, number) / count,
+                measure(from_json, encoded, number) / count))
+
+def main(number=2000):
+    """Print comparison tables."""
+    print("%-26s %6s %6s %9s %9s %9s %9s" % (
+        'message', 'json B', 'bin B', 'json enc', 'bin enc',
+        'json dec', 'bin dec'))
+    for name, message in MESSAGES:
+        json_data, binary_data = encode_json(message), to_binary(message)
+        assert decode_json(json_data) is not None
+        assert from_binary(binary_data) == from_binary(binary_data)
+        print("%-26s %6d %6d %7.1fus %7.1fus %7.1fus %7.1fus" % (
+            name, len(json_data), len(binary_data),
+            measure(encode_json, message, number),
+            measure(to_binary, message, number),
+            measure(decode_json, json_data, number),
+            measure(from_binary, binary_data, number)))
+    print()
+    dispatch()
+
+if __name__ == '__main__':
+    main()
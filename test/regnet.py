@@ -16,14 +16,13 @@ import requests.exceptions
 import bitcoin
 import bitcoin.rpc
 import jsonrpcproxy
+import notify
 bitcoin.SelectParams('regtest')
 
 BITCOIND = os.path.abspath('bitcoind')
 assert os.path.isfile(BITCOIND)
 LIGHTNINGD = os.path.abspath('lightningd.py')
 assert os.path.isfile(LIGHTNINGD)
-NOTIFY = os.path.abspath('notify.py')
-assert os.path.isfile(NOTIFY)
 
 PORT = itertools.count(18000)
 
@@ -191,7 +190,8 @@ class LightningNode(object):
 
         self.port = get_port()
 
-        self.bitcoind.add_notify('%s $1 $2 %d' % (NOTIFY, self.port))
+        self.bitcoind.add_notify(notify.shell_command(
+            os.path.join(self.datadir, 'notify')))
 
         with open(os.path.join(self.datadir, 'lightning.conf'), 'w') as conf:
             conf.write("regtest=1\n")
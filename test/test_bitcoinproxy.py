@@ -0,0 +1,159 @@
+"""Tests for bitcoinproxy.py."""
+
+import unittest
+import unittest.mock
+import threading
+import bitcoin.rpc
+from bitcoin.core import COutPoint, CBlock
+import bitcoinproxy
+from bitcoinproxy import BitcoinPool
+
+class FakeBitcoind(object):
+    """Stand-in for bitcoind, counting the calls made to it."""
+    def __init__(self):
+        self.calls = []
+        self.connections = 0
+        self.blocks = 100
+        self.unspent = [{'amount': 1}]
+        self.release = threading.Event()
+        self.release.set()
+        self.lock = threading.Lock()
+
+    def connect(self, dummy_url):
+        """Make a connection (the pool's factory)."""
+        with self.lock:
+            self.connections += 1
+        return FakeProxy(self)
+
+class FakeProxy(object):
+    """Stand-in for bitcoin.rpc.Proxy."""
+    def __init__(self, bitcoind):
+        self.bitcoind = bitcoind
+
+    def _record(self, name):
+        self.bitcoind.release.wait()
+        with self.bitcoind.lock:
+            self.bitcoind.calls.append(name)
+
+    def getblockcount(self):
+        self._record('getblockcount')
+        return self.bitcoind.blocks
+
+    def listunspent(self):
+        self._record('listunspent')
+        return self.bitcoind.unspent
+
+    def getblock(self, dummy_block_hash):
+        self._record('getblock')
+        return CBlock(nVersion=2)
+
+    def generate(self, count):
+        self._record('generate')
+        self.bitcoind.blocks += count
+
+    def fail(self):
+        self._record('fail')
+        raise bitcoin.rpc.JSONRPCError({'code': -1, 'message': 'fail'})
+
+class TestBitcoinPool(unittest.TestCase):
+    def setUp(self):
+        self.bitcoind = FakeBitcoind()
+        self.pool = BitcoinPool('http://localhost:18332', size=2, ttl=60,
+                                factory=self.bitcoind.connect)
+
+    def test_chain_tip_cached(self):
+        self.assertEqual(self.pool.getblockcount(), 100)
+        self.assertEqual(self.pool.getblockcount(), 100)
+        self.assertEqual(self.bitcoind.calls, ['getblockcount'])
+
+    def test_invalidate(self):
+        self.pool.getblockcount()
+        self.bitcoind.blocks = 101
+        self.pool.invalidate()
+        self.assertEqual(self.pool.getblockcount(), 101)
+
+    def test_mutation_invalidates(self):
+        self.pool.getblockcount()
+        self.pool.generate(1)
+        self.assertEqual(self.pool.getblockcount(), 101)
+
+    def test_no_ttl(self):
+        self.pool.ttl = 0
+        self.pool.getblockcount()
+        self.pool.getblockcount()
+        self.assertEqual(len(self.bitcoind.calls), 2)
+
+    def test_unspent_not_cached(self):
+        self.pool.listunspent()
+        self.pool.listunspent()
+        self.assertEqual(len(self.bitcoind.calls), 2)
+
+    def test_copies(self):
+        first = self.pool.listunspent()
+        first[0]['amount'] = 2
+        self.assertEqual(self.pool.listunspent(), [{'amount': 1}])
+
+    def test_immutable_shared(self):
+        outpoint = COutPoint(b'\x01' * 32, 0)
+        self.bitcoind.unspent = [{'outpoint': outpoint, 'amount': 1}]
+        self.bitcoind.release.clear()
+        results = []
+        def call():
+            results.append(self.pool.listunspent())
+        threads = [threading.Thread(target=call) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        while not self.pool._flights:
+            pass
+        self.bitcoind.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 2)
+        for result in results:
+            self.assertIs(result[0]['outpoint'], outpoint)
+        self.assertEqual(self.pool.getblock(b'\x00' * 32).nVersion, 2)
+
+    def test_coalesce(self):
+        self.bitcoind.release.clear()
+        results = []
+        def call():
+            results.append(self.pool.listunspent())
+        threads = [threading.Thread(target=call) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        while not self.pool._flights:
+            pass
+        self.bitcoind.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [[{'amount': 1}]] * 5)
+        self.assertLess(len(self.bitcoind.calls), 5)
+
+    def test_connections_reused(self):
+        for _ in range(5):
+            self.pool.generate(1)
+        self.assertEqual(self.bitcoind.connections, 1)
+
+    def test_error(self):
+        with self.assertRaises(bitcoin.rpc.JSONRPCError):
+            self.pool.fail()
+        self.assertEqual(self.bitcoind.connections, 1)
+        self.pool.getblockcount()
+        self.assertEqual(self.bitcoind.connections, 1)
+
+    def test_fork_resets(self):
+        self.pool.getblockcount()
+        # As if in a forked child
+        with unittest.mock.patch('os.getpid', return_value=-1):
+            self.pool.getblockcount()
+        self.assertEqual(self.bitcoind.connections, 2)
+
+class TestGetPool(unittest.TestCase):
+    def test_parameters(self):
+        url = 'http://localhost:18444'
+        pool = bitcoinproxy.get_pool(url, size=2, ttl=1.0)
+        self.assertIs(bitcoinproxy.get_pool(url, size=2, ttl=1.0), pool)
+        uncached = bitcoinproxy.get_pool(url, size=2, ttl=0)
+        self.assertIsNot(uncached, pool)
+        self.assertEqual(uncached.ttl, 0)
+        self.assertEqual(bitcoinproxy.get_pool(url, size=8).size, 8)
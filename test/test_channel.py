@@ -0,0 +1,1168 @@
+"""Tests for channel.py.
+
+Two nodes run in one process, each with its own Flask app, datadir and
+database. RPCs between them are made on a new thread, in a request context
+of the other node's app, as a real server would.
+"""
+
+import unittest
+import unittest.mock
+import time
+import random
+import shutil
+import tempfile
+import threading
+import os.path
+import bitcoin
+import bitcoin.rpc
+import requests
+import sqlalchemy
+from flask import Flask, g
+from bitcoin.core import COutPoint, b2lx, CBlock
+from bitcoin.core import CTransaction, CTxIn, CTxOut
+from bitcoin.core import CMutableTransaction, CMutableTxIn, CMutableTxOut
+from bitcoin.core.script import CScript, SignatureHash, SIGHASH_ALL
+from bitcoin.wallet import P2PKHBitcoinAddress
+from serverutil import app, database, NodeIdentity
+from signer import Signer
+from jsonrpcproxy import to_binary, from_binary
+import anchors
+import channel
+import channelstore
+import coins
+import transactions
+import watcher
+from channelstore import Channel, PendingUpdate, ChannelCache
+from coins import Coin
+from watcher import Block
+import history
+import serverutil
+bitcoin.SelectParams('regtest')
+
+ALICE = NodeIdentity(b'alice', 9001)
+BOB = NodeIdentity(b'bob', 9002)
+CAROL = NodeIdentity(b'carol', 9003)
+NODES = {node.url: node for node in [ALICE, BOB, CAROL]}
+APPS = {ALICE: app, BOB: Flask('bob'), CAROL: Flask('carol')}
+SIGNERS = {node: Signer(node) for node in NODES.values()}
+WALLETS = {}
+DATADIRS = []
+
+def setUpModule():
+    database.init_app(APPS[BOB])
+    database.init_app(APPS[CAROL])
+    for node_app in APPS.values():
+        DATADIRS.append(tempfile.mkdtemp())
+        node_app.config['datadir'] = DATADIRS[-1]
+        node_app.config['durability'] = 'group'
+        node_app.config['dbconnections'] = 4
+        node_app.config['journalsize'] = 1048576
+        node_app.register_blueprint(channelstore.API)
+        with node_app.app_context():
+            database.create_all()
+
+def tearDownModule():
+    for datadir in DATADIRS:
+        shutil.rmtree(datadir)
+
+def as_node(identity):
+    """Return a request context set up as the node with identity."""
+    node_app = APPS[identity]
+    context = node_app.test_request_context('/')
+    context.push()
+    g.config = node_app.config
+    g.identity = identity
+    g.seckey = identity.seckey
+    g.signer = SIGNERS[identity]
+    g.bit = WALLETS.get(identity)
+    g.addr = identity.url
+    return context
+
+class LoopbackPeer(object):
+    """Proxy to another node's channel API, answered on a new thread."""
+    def __init__(self, identity):
+        self.identity = identity
+
+    def __getattr__(self, name):
+        # The channel API's methods are defined in channel and anchors
+        method = getattr(channel, name, None) or getattr(anchors, name)
+        def call(*args):
+            outcome = []
+            def run():
+                context = as_node(self.identity)
+                try:
+                    outcome.append((True, method(*args)))
+                except Exception as err: # pylint: disable=broad-except
+                    outcome.append((False, err))
+                finally:
+                    database.session.remove()
+                    context.pop()
+            thread = threading.Thread(target=run)
+            thread.start()
+            thread.join()
+            succeeded, result = outcome[0]
+            if not succeeded:
+                raise result
+            return result
+        return call
+
+class AsyncLoopbackPeer(object):
+    """AsyncProxy to another node's channel API, as LoopbackPeer."""
+    def __init__(self, identity):
+        self.peer = LoopbackPeer(identity)
+
+    def __getattr__(self, name):
+        async def call(*args):
+            # Translate as a real request would be
+            args = from_binary(to_binary(list(args)))
+            return from_binary(to_binary(getattr(self.peer, name)(*args)))
+        return call
+
+def peer(url):
+    return LoopbackPeer(NODES[url])
+
+def async_peer(url):
+    return AsyncLoopbackPeer(NODES[url])
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        self.original_peer, channel.peer = channel.peer, peer
+        for node_app in APPS.values():
+            node_app.config['updatewindow'] = 4
+            node_app.config['updatetimeout'] = 10
+            node_app.config['coalescems'] = 0
+            node_app.config['coalescesize'] = 32
+            node_app.config['verifysigs'] = 'always'
+            node_app.config['verifysample'] = 100
+            node_app.config['historykeep'] = 1000
+        self.add_channel(COutPoint(b'\x01' * 32, 0), 1000000, 1000000)
+
+    def add_channel(self, anchor, alice_balance, bob_balance):
+        """Open a channel between Alice and Bob anchored at anchor."""
+        redeem = transactions.anchor_script(BOB.pubkey, ALICE.pubkey)
+        address = P2PKHBitcoinAddress.from_bytes(b'\x02' * 20)
+        for me, them, index, mine, theirs in [
+                (ALICE, BOB, 1, alice_balance, bob_balance),
+                (BOB, ALICE, 0, bob_balance, alice_balance)]:
+            context = as_node(me)
+            row = Channel(
+                address=them.url, anchor_point=anchor, anchor_index=index,
+                their_sig=b'', anchor_redeem=redeem,
+                our_balance=mine, our_script=address.to_scriptPubKey(),
+                their_balance=theirs, their_script=address.to_scriptPubKey())
+            database.session.add(row)
+            channelstore.cache().commit(row)
+            context.pop()
+        # Exchange initial signatures
+        context = as_node(ALICE)
+        alice = Channel.query.filter(Channel.anchor_point == anchor).one()
+        alice.their_sig = peer(BOB.url).update_anchor(
+            ALICE.url, anchor.serialize(), anchor.hash,
+            alice.signature(alice.commitment()))
+        channelstore.cache().commit(alice)
+        channelstore.record(alice)
+        context.pop()
+
+    def tearDown(self):
+        channel.peer = self.original_peer
+        for node in [ALICE, BOB]:
+            context = as_node(node)
+            for row in Channel.query.all():
+                channelstore.cache().forget(row)
+                history.remove_log(channelstore.history_path(row.id))
+            Channel.query.delete()
+            PendingUpdate.query.delete()
+            database.session.commit()
+            context.pop()
+
+    def send(self, sender, receiver, amount):
+        context = as_node(sender)
+        try:
+            channel.send(receiver.url, amount)
+        finally:
+            database.session.remove()
+            context.pop()
+
+    def check(self, alice_balance, total=2000000):
+        for me, them, balance in [(ALICE, BOB, alice_balance),
+                                  (BOB, ALICE, total - alice_balance)]:
+            context = as_node(me)
+            self.assertEqual(channel.getbalance(them.url), balance)
+            # Signs, and checks the signatures verify
+            channel.getcommitmenttransactions(them.url)
+            self.assertEqual(PendingUpdate.query.count(), 0)
+            context.pop()
+
+    def test_sequential(self):
+        self.send(ALICE, BOB, 1000)
+        self.send(BOB, ALICE, 300)
+        self.send(ALICE, BOB, 50)
+        self.check(1000000 - 750)
+
+    def test_concurrent(self):
+        payments = [(ALICE, BOB, random.randint(1, 1000)) for _ in range(8)]
+        payments += [(BOB, ALICE, random.randint(1, 1000)) for _ in range(8)]
+        random.shuffle(payments)
+        threads = [threading.Thread(target=self.send, args=payment)
+                   for payment in payments]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.check(1000000 + sum(amount if receiver is ALICE else -amount
+                                 for _, receiver, amount in payments))
+
+    def test_overdraw(self):
+        # Both sends choose the channel before either has started
+        chosen = threading.Barrier(2)
+        split = channel.split
+        def split_together(*args):
+            parts = split(*args)
+            chosen.wait()
+            return parts
+        failures = []
+        def send():
+            try:
+                self.send(ALICE, BOB, 600000)
+            except Exception as err: # pylint: disable=broad-except
+                failures.append(err)
+        with unittest.mock.patch.object(channel, 'split', split_together):
+            threads = [threading.Thread(target=send) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(failures), 1)
+        self.check(400000)
+
+    def test_propose_overdraw(self):
+        context = as_node(BOB)
+        try:
+            anchor = channel.channels(ALICE.url)[0].anchor_point.serialize()
+            channel.propose_update(ALICE.url, anchor, 600000, 1)
+            with self.assertRaises(Exception):
+                channel.propose_update(ALICE.url, anchor, 600000, 2)
+            self.assertEqual(PendingUpdate.query.count(), 1)
+            PendingUpdate.query.delete()
+            database.session.commit()
+        finally:
+            database.session.remove()
+            context.pop()
+
+    def test_window_of_one(self):
+        APPS[BOB].config['updatewindow'] = 1
+        threads = [threading.Thread(target=self.send, args=(BOB, ALICE, 10))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.check(1000040)
+
+    def test_propose_fails(self):
+        # Alice numbers the update, and Bob never sees it
+        with unittest.mock.patch.object(channel, 'propose_update',
+                                        side_effect=Exception("Lost")):
+            with self.assertRaises(Exception):
+                self.send(ALICE, BOB, 1000)
+        self.send(ALICE, BOB, 500)
+        self.send(BOB, ALICE, 200)
+        self.check(1000000 - 300)
+
+    def test_reply_lost(self):
+        # Alice numbers Bob's update, and Bob never learns the number
+        propose_update = channel.propose_update
+        def lossy(*args):
+            propose_update(*args)
+            raise Exception("Reply lost")
+        with unittest.mock.patch.object(channel, 'propose_update', lossy):
+            with self.assertRaises(Exception):
+                self.send(BOB, ALICE, 1000)
+        self.send(BOB, ALICE, 300)
+        self.send(ALICE, BOB, 100)
+        self.check(1000000 + 200)
+
+    def test_recieve_fails(self):
+        # Alice applies her update, and her signature doesn't reach Bob
+        recieve = channel.recieve
+        failures = []
+        def lossy(*args):
+            if not failures:
+                failures.append(args)
+                raise requests.exceptions.ConnectionError("Lost")
+            return recieve(*args)
+        with unittest.mock.patch.object(channel, 'recieve', lossy):
+            self.send(ALICE, BOB, 1000)
+        self.assertEqual(len(failures), 1)
+        self.send(BOB, ALICE, 300)
+        self.send(ALICE, BOB, 50)
+        self.check(1000000 - 750)
+
+    def test_recieve_refused(self):
+        # Bob raises, so sending again would fail the same way
+        calls = []
+        def refuse(*args):
+            calls.append(args)
+            raise Exception("Refused")
+        with unittest.mock.patch.object(channel, 'recieve', refuse):
+            with self.assertRaises(Exception):
+                self.send(ALICE, BOB, 1000)
+        self.assertEqual(len(calls), 1)
+
+    def test_bad_signature_refused(self):
+        recieve = channel.recieve
+        sent = []
+        def corrupt(address, anchor, amount, sig, number):
+            sent.append((address, anchor, amount, sig, number))
+            bad = sig[:10] + bytes([sig[10] ^ 1]) + sig[11:]
+            return recieve(address, anchor, amount, bad, number)
+        with unittest.mock.patch.object(channel, 'recieve', corrupt):
+            with self.assertRaises(Exception):
+                self.send(ALICE, BOB, 1000)
+        context = as_node(BOB)
+        try:
+            # Bob didn't keep it, and still takes the good signature
+            self.assertIsNone(PendingUpdate.query.one().their_sig)
+            channel.recieve(*sent[0])
+        finally:
+            context.pop()
+        self.send(BOB, ALICE, 300)
+        self.check(1000000 - 700)
+
+    def test_recieve_unreachable(self):
+        APPS[ALICE].config['updatetimeout'] = 0.2
+        with unittest.mock.patch.object(
+                channel, 'recieve',
+                side_effect=requests.exceptions.ConnectionError("Lost")):
+            start = time.monotonic()
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                self.send(ALICE, BOB, 1000)
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_history(self):
+        self.send(ALICE, BOB, 1000)
+        self.send(BOB, ALICE, 300)
+        for me, them, balances in [
+                (ALICE, BOB, [1000000, 999000, 999300]),
+                (BOB, ALICE, [1000000, 1001000, 1000700])]:
+            context = as_node(me)
+            try:
+                row = channel.channels(them.url)[0]
+                log = channelstore.channel_history(row.id)
+                self.assertEqual([log.get(number).our_balance
+                                  for number in range(3)], balances)
+                self.assertEqual(log.get(2).sig, row.their_sig)
+            finally:
+                context.pop()
+
+    def test_send_many(self):
+        context = as_node(ALICE)
+        try:
+            receipts = channel.send_many(BOB.url, [10, 20, 30])
+            self.assertEqual(channel.send_many(BOB.url, []), [])
+            self.assertEqual(channel.channels(BOB.url)[0].commitment_number,
+                             1)
+        finally:
+            database.session.remove()
+            context.pop()
+        self.assertEqual([receipt['amount'] for receipt in receipts],
+                         [10, 20, 30])
+        self.assertEqual({receipt['commitment'] for receipt in receipts}, {1})
+        self.assertEqual({receipt['anchor'] for receipt in receipts},
+                         {b2lx(b'\x01' * 32) + ':0'})
+        self.check(1000000 - 60)
+
+    def balances(self, node, other):
+        context = as_node(node)
+        try:
+            return [row.our_balance for row in channel.channels(other.url)]
+        finally:
+            context.pop()
+
+    def test_steer(self):
+        self.add_channel(COutPoint(b'\x02' * 32, 0), 3000000, 1000000)
+        self.send(ALICE, BOB, 2500000)
+        self.assertEqual(self.balances(ALICE, BOB), [1000000, 500000])
+        self.assertEqual(self.balances(BOB, ALICE), [1000000, 3500000])
+        # Now the first channel has the most
+        self.send(ALICE, BOB, 100)
+        self.assertEqual(self.balances(ALICE, BOB), [999900, 500000])
+
+    def test_split(self):
+        self.add_channel(COutPoint(b'\x02' * 32, 0), 500000, 1000000)
+        self.send(ALICE, BOB, 1200000)
+        self.assertEqual(self.balances(ALICE, BOB), [0, 300000])
+        self.check(300000, 3500000)
+        with self.assertRaises(Exception):
+            self.send(ALICE, BOB, 300001)
+        self.send(ALICE, BOB, 300000)
+        self.check(0, 3500000)
+
+    def test_send_many_spread(self):
+        self.add_channel(COutPoint(b'\x02' * 32, 0), 1000000, 1000000)
+        context = as_node(ALICE)
+        try:
+            receipts = channel.send_many(BOB.url, [600000, 700000, 300000])
+            with self.assertRaises(Exception):
+                channel.send_many(BOB.url, [300001])
+        finally:
+            database.session.remove()
+            context.pop()
+        self.assertEqual(len({receipt['anchor'] for receipt in receipts}), 2)
+        self.assertEqual(receipts[0]['anchor'], receipts[2]['anchor'])
+        self.assertEqual(sorted(self.balances(ALICE, BOB)), [100000, 300000])
+        self.check(400000, 4000000)
+
+    def test_close(self):
+        self.add_channel(COutPoint(b'\x02' * 32, 0), 500000, 1000000)
+        WALLETS[BOB] = FakeWallet([], 1)
+        context = as_node(ALICE)
+        try:
+            channel.close(BOB.url)
+            self.assertEqual(channel.getbalance(BOB.url), 0)
+        finally:
+            database.session.remove()
+            context.pop()
+            del WALLETS[BOB]
+        self.assertEqual(self.balances(BOB, ALICE), [])
+
+    def test_signed_together(self):
+        self.add_channel(COutPoint(b'\x02' * 32, 0), 500000, 1000000)
+        context = as_node(ALICE)
+        try:
+            with unittest.mock.patch.object(
+                    g.signer, 'sign_many', wraps=g.signer.sign_many) as sign:
+                transactions = channel.getcommitmenttransactions(BOB.url)
+            self.assertEqual(len(transactions), 2)
+            self.assertEqual(sign.call_count, 1)
+        finally:
+            context.pop()
+
+    def test_coalesce(self):
+        APPS[ALICE].config['coalescems'] = 200
+        APPS[ALICE].config['coalescesize'] = 4
+        threads = [threading.Thread(target=self.send, args=(ALICE, BOB, 10))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        context = as_node(ALICE)
+        self.assertEqual(channel.channels(BOB.url)[0].commitment_number, 1)
+        context.pop()
+        self.check(1000000 - 40)
+
+    def test_cached(self):
+        context = as_node(ALICE)
+        try:
+            self.assertEqual(channel.getbalance(BOB.url), 1000000)
+            original_load, channel.load = channel.load, None
+            try:
+                self.assertEqual(channel.getbalance(BOB.url), 1000000)
+                channel.getcommitmenttransactions(BOB.url)
+            finally:
+                channel.load = original_load
+        finally:
+            context.pop()
+
+    def test_cache_coherent(self):
+        context = as_node(ALICE)
+        try:
+            self.assertEqual(channel.getbalance(BOB.url), 1000000)
+            # Another worker, with its own cache, changes the channel
+            other = ChannelCache(APPS[ALICE].config['datadir'])
+            row = channel.load(channel.channels(BOB.url)[0].id)
+            row.our_balance = 5
+            other.commit(row)
+            self.assertEqual(channel.getbalance(BOB.url), 5)
+        finally:
+            context.pop()
+
+    def test_verify_policy(self):
+        context = as_node(ALICE)
+        try:
+            alice = channel.channels(BOB.url)[0]
+            APPS[ALICE].config['verifysigs'] = 'broadcast'
+            before = transactions.VERIFIER.get_stats()
+            # Commitments handed out may be broadcast, so are verified
+            channel.getcommitmenttransactions(BOB.url)
+            handed_out = transactions.VERIFIER.get_stats()
+            alice.sign(alice.commitment(ours=True))
+            after = transactions.VERIFIER.get_stats()
+        finally:
+            APPS[ALICE].config['verifysigs'] = 'always'
+            context.pop()
+        self.assertEqual(handed_out['skipped'], before['skipped'])
+        self.assertEqual(handed_out['script']['count'] -
+                         before['script']['count'], 1)
+        self.assertEqual(after['skipped'] - handed_out['skipped'], 1)
+        self.assertEqual(after['script']['count'],
+                         handed_out['script']['count'])
+
+    def test_bad_signature(self):
+        context = as_node(ALICE)
+        try:
+            alice = channel.channels(BOB.url)[0]
+            failures = transactions.VERIFIER.get_stats()['peer']['failures']
+            with self.assertRaises(Exception):
+                alice.check_commitment_sig(alice.commitment_signature())
+            self.assertEqual(transactions.VERIFIER.get_stats()['peer']['failures'],
+                             failures + 1)
+            # Checked once
+            checks = transactions.VERIFIER.get_stats()['peer']['count']
+            alice.check_commitment_sig(alice.their_sig)
+            alice.check_commitment_sig(alice.their_sig)
+            self.assertLessEqual(
+                transactions.VERIFIER.get_stats()['peer']['count'], checks + 1)
+        finally:
+            context.pop()
+
+class FakeWallet(object):
+    """Stand-in for bitcoind's wallet RPCs used to open channels."""
+    def __init__(self, amounts, tag=0):
+        self.tag = tag
+        self.unspent = [{'outpoint': COutPoint(bytes([tag, index + 1]) * 16, 0),
+                         'amount': amount, 'spendable': True}
+                        for index, amount in enumerate(amounts)]
+        self.scans = 0
+        self.change_addresses = 0
+        self.addresses = []
+        self.sent = []
+
+    def listunspent(self):
+        self.scans += 1
+        return list(self.unspent)
+
+    def getnewaddress(self):
+        self.addresses.append(P2PKHBitcoinAddress.from_bytes(
+            bytes([self.tag, len(self.addresses)]) * 10))
+        return self.addresses[-1]
+
+    def getrawchangeaddress(self):
+        self.change_addresses += 1
+        return self.getnewaddress()
+
+    def validateaddress(self, address):
+        return {'ismine': address in self.addresses}
+
+    def signrawtransaction(self, transaction):
+        transaction = CMutableTransaction.from_tx(transaction)
+        mine = [coin['outpoint'] for coin in self.unspent]
+        for txin in transaction.vin:
+            if txin.prevout in mine:
+                txin.scriptSig = CScript([bytes([self.tag])])
+        return {'tx': transaction,
+                'complete': all(txin.scriptSig for txin in transaction.vin)}
+
+    def sendrawtransaction(self, transaction):
+        spent = [txin.prevout for txin in transaction.vin]
+        self.unspent = [coin for coin in self.unspent
+                        if coin['outpoint'] not in spent]
+        self.sent.append(transaction)
+
+class TestCoins(unittest.TestCase):
+    def setUp(self):
+        WALLETS[ALICE] = FakeWallet([100000, 250000, 40000, 60000])
+        self.context = as_node(ALICE)
+        g.config['changecost'] = 1000
+        g.config['coinreserve'] = 600
+
+    def tearDown(self):
+        Coin.query.delete()
+        database.session.commit()
+        coins.COIN_CACHES.clear()
+        self.context.pop()
+
+    def test_scans_once(self):
+        for _ in range(3):
+            coins.select_coins(10000)
+        self.assertEqual(g.bit.scans, 1)
+        coins.on_block('server', block='00')
+        coins.select_coins(10000)
+        self.assertEqual(g.bit.scans, 2)
+
+    def test_reserved(self):
+        chosen = [txin.prevout for amount in [100000, 100000, 100000]
+                  for txin in coins.select_coins(amount)[0]]
+        self.assertEqual(len(chosen), len(set(chosen)))
+        with self.assertRaises(Exception):
+            coins.select_coins(100000)
+
+    def test_release(self):
+        selected, _ = coins.select_coins(400000)
+        coins.release_coins(selected)
+        coins.select_coins(400000)
+
+    def test_no_change(self):
+        selected, change = coins.select_coins(99500)
+        self.assertEqual([txin.prevout for txin in selected],
+                         [g.bit.unspent[0]['outpoint']])
+        self.assertIsNone(change)
+        self.assertEqual(g.bit.change_addresses, 0)
+        selected, change = coins.select_coins(200000)
+        self.assertEqual(change.nValue, 50000)
+        self.assertEqual(change.scriptPubKey,
+                         g.bit.addresses[0].to_scriptPubKey())
+
+    def test_own_spend(self):
+        selected, change = coins.select_coins(10000)
+        transaction = CMutableTransaction(selected, [change])
+        coins.spend_coins(selected, transaction)
+        coins.on_wallet_transaction(
+            'server', tx=b2lx(transaction.GetHash()))
+        coins.select_coins(10000)
+        self.assertEqual(g.bit.scans, 1)
+        coins.on_wallet_transaction('server', tx='00' * 32)
+        coins.select_coins(10000)
+        self.assertEqual(g.bit.scans, 2)
+
+class TestCreateMany(unittest.TestCase):
+    def setUp(self):
+        self.original_peer, channel.peer = channel.peer, peer
+        self.original_async_peer, anchors.async_peer = \
+            anchors.async_peer, async_peer
+        for tag, node in enumerate([ALICE, BOB, CAROL]):
+            WALLETS[node] = FakeWallet([500000, 300000, 200000], tag)
+            APPS[node].config['changecost'] = 1000
+            APPS[node].config['coinreserve'] = 600
+            APPS[node].config['verifysigs'] = 'always'
+            APPS[node].config['historykeep'] = 1000
+
+    def tearDown(self):
+        channel.peer = self.original_peer
+        anchors.async_peer = self.original_async_peer
+        for node in NODES.values():
+            context = as_node(node)
+            for row in Channel.query.all():
+                channelstore.cache().forget(row)
+                history.remove_log(channelstore.history_path(row.id))
+            Channel.query.delete()
+            Coin.query.delete()
+            database.session.commit()
+            context.pop()
+        coins.COIN_CACHES.clear()
+        WALLETS.clear()
+
+    def create_many(self, channels, batch):
+        context = as_node(ALICE)
+        try:
+            return anchors.create_many(channels, fees=1000, batch=batch)
+        finally:
+            database.session.remove()
+            context.pop()
+
+    def check(self, node, other, balance):
+        """Check node has a working channel with other."""
+        context = as_node(node)
+        try:
+            self.assertEqual(channel.getbalance(other.url), balance)
+            # Signs, and checks the signatures verify
+            channel.getcommitmenttransactions(other.url)
+            return [row.anchor_point for row in channel.channels(other.url)]
+        finally:
+            context.pop()
+
+    def test_separately(self):
+        receipts = self.create_many([(BOB.url, 100000, 50000),
+                                     (CAROL.url, 200000, 80000)], False)
+        self.assertEqual([receipt['error'] for receipt in receipts],
+                         [None, None])
+        self.assertEqual(len(WALLETS[ALICE].sent), 2)
+        for other, mine, theirs in [(BOB, 100000, 50000),
+                                    (CAROL, 200000, 80000)]:
+            self.assertEqual(self.check(ALICE, other, mine),
+                             self.check(other, ALICE, theirs))
+
+    def test_same_node(self):
+        # Bob spends coins for each channel
+        WALLETS[BOB] = FakeWallet([50000] * 4, 1)
+        for batch in [False, True]:
+            receipts = self.create_many([(BOB.url, 10000, 5000),
+                                         (BOB.url, 20000, 8000)], batch)
+            self.assertEqual([receipt['error'] for receipt in receipts],
+                             [None, None])
+        anchors = self.check(ALICE, BOB, 60000)
+        self.assertEqual(len(anchors), 4)
+        self.assertEqual(self.check(BOB, ALICE, 26000), anchors)
+
+    def test_failure_isolated(self):
+        WALLETS[CAROL].unspent = []
+        receipts = self.create_many([(BOB.url, 100000, 50000),
+                                     (CAROL.url, 200000, 80000)], False)
+        self.assertIsNone(receipts[0]['error'])
+        self.assertIsNotNone(receipts[1]['error'])
+        self.check(ALICE, BOB, 100000)
+        # Alice's coins for Carol were released
+        context = as_node(ALICE)
+        try:
+            coins.select_coins(700000)
+        finally:
+            context.pop()
+
+    def test_batch(self):
+        receipts = self.create_many([(BOB.url, 100000, 50000),
+                                     (CAROL.url, 200000, 80000)], True)
+        self.assertEqual([receipt['error'] for receipt in receipts],
+                         [None, None])
+        transaction, = WALLETS[ALICE].sent
+        self.assertEqual({receipt['anchor'] for receipt in receipts},
+                         {b2lx(transaction.GetHash())})
+        for index, (other, mine, theirs) in enumerate(
+                [(BOB, 100000, 50000), (CAROL, 200000, 80000)]):
+            anchor = self.check(ALICE, other, mine)
+            self.assertEqual(anchor, [COutPoint(transaction.GetHash(), index)])
+            self.assertEqual(self.check(other, ALICE, theirs), anchor)
+
+    def test_batch_fails_together(self):
+        WALLETS[CAROL].unspent = []
+        receipts = self.create_many([(BOB.url, 100000, 50000),
+                                     (CAROL.url, 200000, 80000)], True)
+        self.assertTrue(all(receipt['error'] for receipt in receipts))
+        self.assertEqual(WALLETS[ALICE].sent, [])
+        context = as_node(BOB)
+        try:
+            self.assertEqual(Channel.query.count(), 0)
+            # Bob's coins for the channel were released
+            coins.select_coins(1000000)
+        finally:
+            context.pop()
+
+    def test_cancel_only_prepared(self):
+        # Bob is preparing a channel with Alice for another batch
+        context = as_node(BOB)
+        try:
+            other = anchors.prepare_anchor(ALICE.url, 10000, 5000, 1000,
+                                           ALICE.pubkey,
+                                           WALLETS[ALICE].getnewaddress())
+        finally:
+            database.session.remove()
+            context.pop()
+        WALLETS[CAROL].unspent = []
+        receipts = self.create_many([(BOB.url, 100000, 50000),
+                                     (CAROL.url, 200000, 80000)], True)
+        self.assertTrue(all(receipt['error'] for receipt in receipts))
+        context = as_node(BOB)
+        try:
+            row, = Channel.query.all()
+            self.assertEqual(row.our_script, other[3].to_scriptPubKey())
+        finally:
+            context.pop()
+
+class FakeChain(object):
+    """Stand-in for bitcoind's block RPCs."""
+    def __init__(self):
+        self.blocks = {}
+        self.best = []
+        self.fetched = []
+
+    def mine(self, transactions=(), height=None):
+        """Add a block at height (by default the tip), and return its hash."""
+        if height is None:
+            height = len(self.best)
+        block = CBlock(
+            hashPrevBlock=self.best[height - 1] if height else b'\x00' * 32,
+            nNonce=len(self.blocks), vtx=list(transactions))
+        self.blocks[block.GetHash()] = (block, height)
+        self.best = self.best[:height] + [block.GetHash()]
+        return b2lx(block.GetHash())
+
+    def getblockcount(self):
+        return len(self.best) - 1
+
+    def getblockhash(self, height):
+        if not 0 <= height < len(self.best):
+            raise bitcoin.rpc.JSONRPCError(
+                {'code': -8, 'message': 'Block height out of range'})
+        return self.best[height]
+
+    def getblock(self, block_hash):
+        self.fetched.append(block_hash)
+        return self.blocks[block_hash][0]
+
+class TestWatch(unittest.TestCase):
+    def setUp(self):
+        WALLETS[ALICE] = FakeChain()
+        self.context = as_node(ALICE)
+        g.config['watchdepth'] = 10
+        g.config['historykeep'] = 1000
+        redeem = transactions.anchor_script(BOB.pubkey, ALICE.pubkey)
+        self.channels = []
+        for index in range(3):
+            row = Channel(
+                address=BOB.url, anchor_point=COutPoint(b'\x01' * 32, index),
+                anchor_index=1, their_sig=b'', anchor_redeem=redeem,
+                our_balance=1000, our_script=P2PKHBitcoinAddress.from_bytes(
+                    b'\x02' * 20).to_scriptPubKey(),
+                their_balance=2000, their_script=P2PKHBitcoinAddress.from_bytes(
+                    b'\x03' * 20).to_scriptPubKey())
+            database.session.add(row)
+            channelstore.cache().commit(row)
+            self.channels.append(channelstore.cached(row.id))
+        self.watch(g.bit.mine())
+
+    def tearDown(self):
+        for row in Channel.query.all():
+            channelstore.cache().forget(row)
+            history.remove_log(channelstore.history_path(row.id))
+        Channel.query.delete()
+        Block.query.delete()
+        database.session.commit()
+        self.context.pop()
+        WALLETS.clear()
+
+    def watch(self, block):
+        return [(signal.name, arguments)
+                for signal, arguments in watcher.watch(block)]
+
+    def spend(self, row, balance=None):
+        """A transaction spending row's anchor, paying us balance."""
+        row = Channel(**ChannelCache._snapshot(row))
+        if balance is not None:
+            row.their_balance += row.our_balance - balance
+            row.our_balance = balance
+        return CTransaction.from_tx(row.commitment(ours=True))
+
+    def test_spent(self):
+        spend = self.spend(self.channels[1])
+        events = self.watch(g.bit.mine([spend]))
+        self.assertEqual(events, [('ANCHOR_SPENT', {
+            'address': BOB.url, 'channel': self.channels[1].id,
+            'anchor': b2lx(b'\x01' * 32) + ':1',
+            'txid': b2lx(spend.GetHash()), 'kind': 'current', 'number': 0})])
+        self.assertEqual(channel.getbalance(BOB.url), 2000)
+        self.assertEqual(channelstore.cached(self.channels[1].id).spent_by,
+                         b2lx(spend.GetHash()))
+
+    def test_kinds(self):
+        spends = [self.spend(self.channels[0], 900),
+                  CTransaction([CTxIn(self.channels[2].anchor_point)],
+                               [CTxOut(3000, CScript([b'\x04']))])]
+        events = self.watch(g.bit.mine(spends))
+        self.assertEqual([(arguments['kind'], arguments['number'])
+                          for _, arguments in events],
+                         [('revoked', None), ('unknown', None)])
+
+    def test_revoked_number(self):
+        log = channelstore.channel_history(self.channels[0].id)
+        log.append(6, 900, 2100, b'sig')
+        log.append(7, 1000, 2000, b'sig')
+        events = self.watch(g.bit.mine([self.spend(self.channels[0], 900)]))
+        self.assertEqual([(arguments['kind'], arguments['number'])
+                          for _, arguments in events], [('revoked', 6)])
+
+    def test_once(self):
+        fetched = len(g.bit.fetched)
+        first = g.bit.mine()
+        second = g.bit.mine([self.spend(self.channels[0])])
+        self.assertEqual(len(self.watch(second)), 1)
+        # A late notification, or one for another process
+        self.assertEqual(self.watch(first), [])
+        self.assertEqual(self.watch(second), [])
+        self.assertEqual(len(g.bit.fetched), fetched + 2)
+
+    def test_reorg(self):
+        spend = self.spend(self.channels[0])
+        g.bit.mine()
+        replaced = g.bit.mine([spend])
+        self.watch(replaced)
+        height = len(g.bit.best) - 1
+        g.bit.mine(height=height)
+        events = self.watch(g.bit.mine())
+        self.assertEqual(events, [('ANCHOR_UNSPENT', {
+            'address': BOB.url, 'channel': self.channels[0].id,
+            'anchor': b2lx(b'\x01' * 32) + ':0',
+            'txid': b2lx(spend.GetHash())})])
+        self.assertEqual(channel.getbalance(BOB.url), 3000)
+        self.assertEqual(self.watch(replaced), [])
+        # The spend is mined again
+        events = self.watch(g.bit.mine([spend]))
+        self.assertEqual([name for name, _ in events], ['ANCHOR_SPENT'])
+        self.assertEqual(channel.getbalance(BOB.url), 2000)
+
+    def test_reorg_shorter(self):
+        spend = self.spend(self.channels[0])
+        fork = len(g.bit.best)
+        g.bit.mine([spend])
+        g.bit.mine()
+        self.watch(g.bit.mine())
+        # The new chain's tip is lower than the blocks matched before
+        events = self.watch(g.bit.mine(height=fork))
+        self.assertEqual([name for name, _ in events], ['ANCHOR_UNSPENT'])
+        self.assertEqual(channel.getbalance(BOB.url), 3000)
+
+    def test_too_far_behind(self):
+        for _ in range(12):
+            g.bit.mine()
+        fetched = len(g.bit.fetched)
+        self.assertEqual(self.watch(g.bit.mine([self.spend(
+            self.channels[0])])), [('ANCHOR_SPENT', unittest.mock.ANY)])
+        self.assertEqual(len(g.bit.fetched), fetched + 1)
+        self.assertEqual(Block.query.count(), 1)
+
+class TestRecovery(unittest.TestCase):
+    def setUp(self):
+        self.context = as_node(ALICE)
+        self.remove_journal()
+        self.log = channelstore.channel_journal()
+        self.engine = database.get_engine(APPS[ALICE])
+        row = Channel(
+            address=BOB.url, anchor_point=COutPoint(b'\x04' * 32, 0),
+            anchor_index=1, their_sig=b'sig', anchor_redeem=b'',
+            our_balance=1000, our_script=b'', their_balance=2000,
+            their_script=b'')
+        database.session.add(row)
+        channelstore.cache().commit(row)
+        self.channel_id = row.id
+
+    def tearDown(self):
+        for row in Channel.query.all():
+            channelstore.cache().forget(row)
+        Channel.query.delete()
+        PendingUpdate.query.delete()
+        database.session.commit()
+        self.remove_journal()
+        g.config['durability'] = 'group'
+        self.context.pop()
+
+    def remove_journal(self):
+        path = os.path.join(g.config['datadir'], 'channel.journal')
+        if os.path.exists(path):
+            os.remove(path)
+
+    def test_lost_update(self):
+        row = channelstore.load(self.channel_id)
+        row.our_balance, row.their_balance = 900, 2100
+        row.commitment_number = 1
+        channelstore.cache().commit(row)
+        # The database loses the commit, and not the pending update
+        self.engine.execute(
+            'UPDATE channel_channels SET our_balance = 1000, '
+            'their_balance = 2000, commitment_number = 0')
+        database.session.add(PendingUpdate(channel_id=self.channel_id,
+                                           number=1, amount=-100, ours=True))
+        database.session.commit()
+        # As after a restart
+        database.session.remove()
+        self.assertEqual(channelstore.recover(), [self.channel_id])
+        row = channelstore.load(self.channel_id)
+        self.assertEqual((row.our_balance, row.commitment_number), (900, 1))
+        self.assertEqual(PendingUpdate.query.count(), 0)
+        # The database has the change now, so its record is dropped
+        self.assertEqual(self.log.records(), [])
+        self.assertEqual(channelstore.recover(), [])
+
+    def test_lost_channel(self):
+        self.engine.execute('DELETE FROM channel_channels')
+        database.session.remove()
+        self.assertEqual(channelstore.recover(), [self.channel_id])
+        row = channelstore.cached(self.channel_id)
+        self.assertEqual(row.anchor_point, COutPoint(b'\x04' * 32, 0))
+        self.assertEqual(row.their_sig, b'sig')
+
+    def test_adding(self):
+        # Another process is adding the channel: journaled, not committed
+        self.engine.execute('UPDATE channel_channels SET id = id + 1000')
+        database.session.remove()
+        locks = os.path.join(g.config['datadir'], 'locks')
+        held = threading.Event()
+        def add():
+            with serverutil.LOCKS.hold(locks, 'new channels'):
+                held.set()
+                time.sleep(0.1)
+                self.engine.execute(
+                    'UPDATE channel_channels SET id = id - 1000')
+        adder = threading.Thread(target=add)
+        adder.start()
+        held.wait()
+        self.assertEqual(channelstore.recover(), [])
+        adder.join()
+        self.assertEqual(channelstore.load(self.channel_id).their_sig, b'sig')
+
+    def test_failed_commit(self):
+        row = channelstore.load(self.channel_id)
+        row.our_balance, row.their_balance = 900, 2100
+        with unittest.mock.patch.object(
+                database.session, 'commit',
+                side_effect=sqlalchemy.exc.OperationalError(
+                    'COMMIT', {}, 'database is locked')):
+            with self.assertRaises(sqlalchemy.exc.OperationalError):
+                channelstore.cache().commit(row)
+        database.session.remove()
+        self.assertEqual(channelstore.recover(), [])
+        self.assertEqual(channelstore.load(self.channel_id).our_balance, 1000)
+
+    def test_lost_delete(self):
+        self.log.append(channelstore.journal_record(self.channel_id, None))
+        self.assertEqual(channelstore.recover(), [self.channel_id])
+        self.assertIsNone(channelstore.load(self.channel_id))
+
+    def test_nothing_lost(self):
+        self.assertEqual(channelstore.recover(), [])
+        # Nothing was restored, and the journal is small, so it is kept
+        self.assertEqual(len(self.log.records()), 1)
+
+    def test_checkpoint(self):
+        self.assertEqual(len(self.log.records()), 1)
+        self.assertTrue(channelstore.checkpoint(self.log))
+        self.assertEqual(self.log.records(), [])
+
+    def test_full(self):
+        g.config['durability'] = 'full'
+        self.assertIsNone(channelstore.channel_journal())
+        row = channelstore.load(self.channel_id)
+        row.our_balance = 1
+        channelstore.cache().commit(row)
+        self.assertEqual(len(self.log.records()), 1)
+
+class TestTemplate(unittest.TestCase):
+    def setUp(self):
+        redeem = transactions.anchor_script(BOB.pubkey, ALICE.pubkey)
+        self.channel = Channel(
+            address=BOB.url, anchor_point=COutPoint(b'\x01' * 32, 3),
+            anchor_index=0, their_sig=b'', anchor_redeem=redeem,
+            our_balance=1234567,
+            our_script=P2PKHBitcoinAddress.from_bytes(
+                b'\x02' * 20).to_scriptPubKey(),
+            their_balance=7654321,
+            their_script=P2PKHBitcoinAddress.from_bytes(
+                b'\x03' * 20).to_scriptPubKey())
+
+    def check(self, outputs, transaction):
+        expected = CMutableTransaction(
+            [CMutableTxIn(self.channel.anchor_point)],
+            [CMutableTxOut(value, CScript(script)) for value, script in outputs])
+        self.assertEqual(transaction, expected)
+        template = self.channel.template(outputs)
+        self.assertEqual(template.sighash(outputs[0][0], outputs[1][0]),
+                         SignatureHash(self.channel.anchor_redeem,
+                                       transaction, 0, SIGHASH_ALL))
+
+    def test_sighash(self):
+        for ours in [False, True]:
+            self.check(self.channel.commitment_outputs(ours),
+                       self.channel.commitment(ours))
+        for index in [0, 1]:
+            self.channel.anchor_index = index
+            self.check(self.channel.settlement_outputs(),
+                       self.channel.settlement())
+
+    def test_reused(self):
+        outputs = self.channel.commitment_outputs()
+        self.channel.our_balance -= 100
+        self.channel.their_balance += 100
+        self.assertIs(self.channel.template(outputs),
+                      self.channel.template(self.channel.commitment_outputs()))
+
+    def test_signature(self):
+        context = as_node(ALICE)
+        try:
+            sighash = SignatureHash(self.channel.anchor_redeem,
+                                    self.channel.commitment(), 0, SIGHASH_ALL)
+            self.assertTrue(ALICE.seckey.pub.verify(
+                sighash, self.channel.commitment_signature()[:-1]))
+        finally:
+            context.pop()
+
+class TestMigration(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = sqlalchemy.create_engine(
+            'sqlite:///' + os.path.join(self.directory, 'channel.dat'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_base58_addresses(self):
+        ours = P2PKHBitcoinAddress.from_bytes(b'\x01' * 20)
+        theirs = P2PKHBitcoinAddress.from_bytes(b'\x02' * 20)
+        self.engine.execute(
+            'CREATE TABLE channels (address VARCHAR PRIMARY KEY, '
+            'anchor_point BLOB, anchor_index INTEGER, their_sig BLOB, '
+            'anchor_redeem BLOB, our_balance INTEGER, our_addr TEXT, '
+            'their_balance INTEGER, their_addr TEXT)')
+        self.engine.execute(
+            'INSERT INTO channels VALUES (?, ?, 0, ?, ?, 1, ?, 2, ?)',
+            'http://localhost:9002/', COutPoint().serialize(), b'', b'',
+            str(ours), str(theirs))
+        channelstore.migrate_database(self.engine)
+        channelstore.migrate_database(self.engine)
+        row = self.engine.execute(
+            'SELECT our_script, their_script, commitment_number '
+            'FROM channels').fetchone()
+        self.assertEqual(row[0], ours.to_scriptPubKey())
+        self.assertEqual(row[1], theirs.to_scriptPubKey())
+        self.assertEqual(row[2], 0)
+
+    def test_keyed_by_address(self):
+        self.engine.execute(
+            'CREATE TABLE channels (address VARCHAR PRIMARY KEY, '
+            'anchor_point BLOB, anchor_index INTEGER, their_sig BLOB, '
+            'anchor_redeem BLOB, our_balance INTEGER, our_script BLOB, '
+            'their_balance INTEGER, their_script BLOB, '
+            'commitment_number INTEGER)')
+        self.engine.execute('CREATE UNIQUE INDEX ix_channels_anchor_point '
+                            'ON channels (anchor_point)')
+        self.engine.execute(
+            'CREATE TABLE pending_updates (id INTEGER PRIMARY KEY, '
+            'address VARCHAR, number INTEGER, amount INTEGER, '
+            'ours BOOLEAN, their_sig BLOB)')
+        for port in [9002, 9003]:
+            self.engine.execute(
+                'INSERT INTO channels VALUES (?, ?, 0, ?, ?, 1, ?, 2, ?, 4)',
+                'http://localhost:%d/' % port,
+                COutPoint(bytes([port % 256]) * 32, 0).serialize(),
+                b'', b'', b'', b'')
+        self.engine.execute(
+            'INSERT INTO pending_updates VALUES (1, ?, 5, 7, 1, NULL)',
+            'http://localhost:9003/')
+        channelstore.migrate_database(self.engine)
+        channelstore.migrate_database(self.engine)
+        self.assertEqual(self.engine.execute(
+            'SELECT id, address, commitment_number FROM channels '
+            'ORDER BY id').fetchall(),
+                         [(1, 'http://localhost:9002/', 4),
+                          (2, 'http://localhost:9003/', 4)])
+        self.assertEqual(self.engine.execute(
+            'SELECT channel_id FROM pending_updates').fetchall(), [(2,)])
+        # Two channels with one node
+        self.engine.execute(
+            'INSERT INTO channels (address, anchor_point) VALUES (?, ?)',
+            'http://localhost:9002/', COutPoint().serialize())
+
+    def test_import(self):
+        self.engine.execute(
+            'CREATE TABLE channels (address VARCHAR PRIMARY KEY, '
+            'anchor_point BLOB, anchor_index INTEGER, their_sig BLOB, '
+            'anchor_redeem BLOB, our_balance INTEGER, our_script BLOB, '
+            'their_balance INTEGER, their_script BLOB, '
+            'commitment_number INTEGER)')
+        self.engine.execute(
+            'INSERT INTO channels VALUES (?, ?, 0, ?, ?, 1, ?, 2, ?, 4)',
+            'http://localhost:9002/', COutPoint().serialize(),
+            b'', b'', b'', b'')
+        path = os.path.join(self.directory, 'channel.dat')
+        node = sqlalchemy.create_engine(
+            'sqlite:///' + os.path.join(self.directory, 'node.dat'))
+        tables = [Channel.__table__, PendingUpdate.__table__]
+        database.Model.metadata.create_all(node, tables=tables)
+        serverutil.import_legacy(node, 'channel', tables, path)
+        self.assertEqual(node.execute(
+            'SELECT id, address, commitment_number, spent_by '
+            'FROM channel_channels').fetchall(),
+                         [(1, 'http://localhost:9002/', 4, None)])
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.exists(path + '.imported'))
+
+    def test_spent_columns(self):
+        self.engine.execute(
+            'CREATE TABLE channels (id INTEGER PRIMARY KEY, address VARCHAR, '
+            'anchor_point BLOB, anchor_index INTEGER, their_sig BLOB, '
+            'anchor_redeem BLOB, our_balance INTEGER, our_script BLOB, '
+            'their_balance INTEGER, their_script BLOB, '
+            'commitment_number INTEGER)')
+        channelstore.migrate_database(self.engine)
+        channelstore.migrate_database(self.engine)
+        columns = [row[1] for row in
+                   self.engine.execute('PRAGMA table_info(channels)')]
+        self.assertIn('spent_by', columns)
+        self.assertIn('spent_in', columns)
@@ -0,0 +1,66 @@
+"""Tests for coinselect.py."""
+
+import unittest
+import random
+import itertools
+import coinselect
+
+class TestBranchAndBound(unittest.TestCase):
+    def test_exact(self):
+        values = [5, 9, 3, 7, 20]
+        chosen = coinselect.branch_and_bound(values, 15, 0)
+        self.assertEqual(sum(values[index] for index in chosen), 15)
+
+    def test_window(self):
+        self.assertEqual(coinselect.branch_and_bound([10, 30], 12, 0), None)
+        self.assertEqual(coinselect.branch_and_bound([10, 30], 28, 2), [1])
+
+    def test_least_excess(self):
+        values = [13, 11, 50]
+        chosen = coinselect.branch_and_bound(values, 10, 5)
+        self.assertEqual(chosen, [1])
+
+    def test_not_enough(self):
+        self.assertEqual(coinselect.branch_and_bound([1, 2], 4, 10), None)
+        self.assertEqual(coinselect.branch_and_bound([], 1, 10), None)
+
+    def test_matches_search(self):
+        rng = random.Random(1)
+        for _ in range(50):
+            values = [rng.randint(1, 100) for _ in range(8)]
+            target, window = rng.randint(1, 300), rng.randint(0, 5)
+            chosen = coinselect.branch_and_bound(values, target, window)
+            excesses = [sum(subset) - target
+                        for size in range(1, 9)
+                        for subset in itertools.combinations(values, size)
+                        if target <= sum(subset) <= target + window]
+            if chosen is None:
+                self.assertEqual(excesses, [])
+            else:
+                self.assertEqual(len(set(chosen)), len(chosen))
+                self.assertEqual(sum(values[index] for index in chosen) -
+                                 target, min(excesses))
+
+class TestFewestInputs(unittest.TestCase):
+    def test_single(self):
+        self.assertEqual(coinselect.fewest_inputs([50, 200, 120], 100), [2])
+
+    def test_largest_first(self):
+        self.assertEqual(coinselect.fewest_inputs([10, 40, 30, 20], 65),
+                         [1, 2])
+
+    def test_not_enough(self):
+        self.assertEqual(coinselect.fewest_inputs([10, 20], 31), None)
+
+class TestSelect(unittest.TestCase):
+    def test_no_change(self):
+        coins = [(60, 'a'), (45, 'b'), (55, 'c')]
+        keys, change = coinselect.select(coins, 100, 5)
+        self.assertEqual((sorted(keys), change), (['b', 'c'], None))
+
+    def test_change(self):
+        coins = [(60, 'a'), (500, 'b'), (55, 'c')]
+        self.assertEqual(coinselect.select(coins, 200, 5), (['b'], 300))
+
+    def test_not_enough(self):
+        self.assertEqual(coinselect.select([(1, 'a')], 2, 5), (None, None))
@@ -0,0 +1,128 @@
+"""Tests for history.py."""
+
+import os
+import shutil
+import tempfile
+import unittest
+import history
+from history import HistoryLog, State
+
+class TestHistoryLog(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'channel-1.log')
+        self.log = HistoryLog(self.path)
+
+    def tearDown(self):
+        self.log.close()
+        shutil.rmtree(self.directory)
+
+    def fill(self, numbers):
+        for number in numbers:
+            self.log.append(number, 1000 - number, number, b'sig%d' % number)
+
+    def test_get(self):
+        self.assertIsNone(self.log.get(0))
+        self.fill(range(3000))
+        self.assertEqual(len(self.log), 3000)
+        self.assertEqual(os.path.getsize(self.path),
+                         3000 * history.RECORD.size)
+        for number in [0, 1, 1023, 1024, 2999]:
+            self.assertEqual(self.log.get(number),
+                             State(number, 1000 - number, number,
+                                   b'sig%d' % number))
+        self.assertIsNone(self.log.get(3000))
+
+    def test_gaps(self):
+        self.fill(range(5, 5000, 3))
+        self.assertEqual(self.log.get(2999).sig, b'sig2999')
+        self.assertIsNone(self.log.get(3000))
+        self.assertIsNone(self.log.get(4))
+
+    def test_already_logged(self):
+        self.fill([1, 2])
+        self.log.append(2, 5, 5, b'again')
+        self.assertEqual(len(self.log), 2)
+        self.assertEqual(self.log.get(2).sig, b'sig2')
+
+    def test_find(self):
+        self.log.append(1, 10, 20, b'a')
+        self.log.append(2, 15, 15, b'b')
+        self.log.append(3, 10, 20, b'c')
+        self.assertEqual(self.log.find(10, 20).number, 3)
+        self.assertIsNone(self.log.find(20, 10))
+
+    def test_find_indexed(self):
+        self.fill(range(3000))
+        self.assertEqual(self.log.find(1000, 0).number, 0)
+        # A lookup reads only the record it finds
+        reads = []
+        state = self.log._state
+        self.log._state = lambda position: reads.append(position) or \
+            state(position)
+        self.assertEqual(self.log.find(1000 - 2999, 2999).number, 2999)
+        self.assertIsNone(self.log.find(1, 1))
+        self.assertEqual(reads, [2999])
+
+    def test_find_after_compact(self):
+        reader = HistoryLog(self.path)
+        try:
+            for number in range(100):
+                self.log.append(number, number % 10, 10 - number % 10, b'')
+            self.assertEqual(reader.find(3, 7).number, 93)
+            self.log.compact(4)
+            self.assertEqual(reader.find(7, 3).number, 97)
+            self.assertIsNone(reader.find(3, 7))
+            self.log.append(100, 3, 7, b'')
+            self.assertEqual(reader.find(3, 7).number, 100)
+        finally:
+            reader.close()
+
+    def test_compact(self):
+        for number in range(100):
+            # Balances repeat every ten updates
+            self.log.append(number, number % 10, 10 - number % 10, b'')
+        self.log.compact(1000)
+        self.assertEqual(len(self.log), 10)
+        self.assertEqual(self.log.get(95).our_balance, 5)
+        self.assertIsNone(self.log.get(85))
+        self.log.compact(4)
+        self.assertEqual([self.log.get(number) is not None
+                          for number in range(95, 100)],
+                         [False, True, True, True, True])
+
+    def test_readers(self):
+        reader = HistoryLog(self.path)
+        try:
+            self.fill(range(10))
+            self.assertEqual(reader.get(9).sig, b'sig9')
+            self.fill(range(10, 20))
+            self.assertEqual(reader.get(19).sig, b'sig19')
+            # Another process compacts the log
+            self.log.compact(5)
+            self.assertIsNone(reader.get(9))
+            self.assertEqual(len(reader), 5)
+        finally:
+            reader.close()
+
+class TestOpenLog(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_shared(self):
+        path = os.path.join(self.directory, 'a.log')
+        self.assertIs(history.open_log(path), history.open_log(path))
+        history.remove_log(path)
+        self.assertFalse(os.path.exists(path))
+
+    def test_closes_least_recent(self):
+        paths = [os.path.join(self.directory, '%d.log' % index)
+                 for index in range(3)]
+        logs = [history.open_log(path, size=2) for path in paths]
+        logs[0].append(1, 1, 1, b'')
+        self.assertEqual(len(logs[0]), 1)
+        for path in paths:
+            history.remove_log(path)
@@ -0,0 +1,162 @@
+"""Tests for journal.py."""
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import unittest.mock
+import journal
+from journal import Journal
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'channel.journal')
+        self.journal = Journal(self.path)
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.directory)
+
+    def test_records(self):
+        self.assertEqual(self.journal.records(), [])
+        sequences = [self.journal.append(payload)
+                     for payload in [b'a', b'', b'c' * 1000]]
+        self.assertEqual(sequences, [1, 2, 3])
+        self.journal.commit(3)
+        self.assertEqual(self.journal.records(), [b'a', b'', b'c' * 1000])
+
+    def test_torn(self):
+        self.journal.append(b'first')
+        self.journal.append(b'second')
+        with open(self.path, 'ab') as journal_file:
+            # A record cut off by a crash
+            journal_file.write(journal.FRAME.pack(100, 0) + b'short')
+        self.assertEqual(self.journal.records(), [b'first', b'second'])
+        self.journal.repair()
+        self.journal.append(b'third')
+        self.assertEqual(self.journal.records(),
+                         [b'first', b'second', b'third'])
+
+    def test_corrupt(self):
+        self.journal.append(b'first')
+        self.journal.append(b'second')
+        with open(self.path, 'r+b') as journal_file:
+            journal_file.seek(-1, os.SEEK_END)
+            journal_file.write(b'X')
+        self.assertEqual(self.journal.records(), [b'first'])
+
+    def test_group_commit(self):
+        syncs = []
+        def slow_sync(descriptor):
+            syncs.append(descriptor)
+            time.sleep(0.05)
+        def write(payload):
+            self.journal.commit(self.journal.append(payload))
+        with unittest.mock.patch('journal.os.fdatasync', slow_sync):
+            write(b'first')
+            threads = [threading.Thread(target=write, args=(b'%d' % index,))
+                       for index in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(self.journal.records()), 9)
+        # One for the first, and at most two for the rest
+        self.assertLessEqual(len(syncs), 3)
+
+    def test_no_sync(self):
+        unsynced = Journal(self.path, sync=False)
+        try:
+            with unittest.mock.patch('journal.os.fdatasync') as fdatasync:
+                unsynced.commit(unsynced.append(b'a'))
+            self.assertFalse(fdatasync.called)
+            self.assertEqual(self.journal.records(), [b'a'])
+        finally:
+            unsynced.close()
+
+    def test_rewrite(self):
+        # Another process's journal
+        other = Journal(self.path)
+        try:
+            other.append(b'old')
+            self.journal.append(b'kept')
+            with self.journal.exclusive():
+                self.journal.rewrite([b'kept'])
+            other.append(b'new')
+            self.journal.append(b'newer')
+            self.assertEqual(other.records(), [b'kept', b'new', b'newer'])
+        finally:
+            other.close()
+
+class TestOpenJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_shared(self):
+        path = os.path.join(self.directory, 'a.journal')
+        self.assertIs(journal.open_journal(path), journal.open_journal(path))
+        self.assertFalse(journal.open_journal(path, sync=False).sync)
+
+class TestRecover(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log = Journal(os.path.join(self.directory, 'rows.journal'))
+        self.rows = {}
+
+    def tearDown(self):
+        self.log.close()
+        shutil.rmtree(self.directory)
+
+    def write(self, key, values):
+        """Journal a change to a row, as a database would before it."""
+        self.log.commit(self.log.append(journal.record(key, values)))
+
+    def restore(self, key, values, present):
+        """Restore a row from its record."""
+        self.assertEqual(present, key in self.rows)
+        if values is None:
+            del self.rows[key]
+        else:
+            self.rows[key] = values
+        return True
+
+    def test_recover(self):
+        self.write(1, [10])
+        self.write(2, [20])
+        self.write(2, [21])
+        self.write(3, [30])
+        self.write(3, None)
+        self.rows = {1: [10], 2: [20], 3: [30]}
+        self.assertEqual(
+            journal.recover(self.log, self.rows.copy, self.restore), [2, 3])
+        self.assertEqual(self.rows, {1: [10], 2: [21]})
+        self.assertEqual(
+            journal.recover(self.log, self.rows.copy, self.restore), [])
+
+    def test_checkpoint(self):
+        self.write(1, [10])
+        self.write(2, [20])
+        self.rows = {1: [10]}
+        self.assertFalse(journal.checkpoint(
+            self.log, self.rows.copy, lambda: False))
+        self.assertTrue(journal.checkpoint(
+            self.log, self.rows.copy, lambda: True))
+        # Only the change the database lost is kept
+        self.assertEqual(self.log.records(), [journal.record(2, [20])])
+
+    def test_maybe_checkpoint(self):
+        checkpoints = []
+        self.write(1, [10])
+        journal.maybe_checkpoint(self.log, 1000, lambda: checkpoints.append(1))
+        self.assertEqual(checkpoints, [])
+        journal.maybe_checkpoint(self.log, 1, lambda: checkpoints.append(1))
+        self.assertEqual(checkpoints, [1])
+        # Not again until the journal grows
+        journal.maybe_checkpoint(self.log, 1, lambda: checkpoints.append(1))
+        self.assertEqual(checkpoints, [1])
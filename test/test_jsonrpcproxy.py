@@ -1,6 +1,10 @@
 """Tests for jsonrpcproxy.py."""
 
 import unittest
+import json
+import time
+import socket
+import asyncio
 import bitcoin
 from bitcoin.core.script import CScript
 from bitcoin.base58 import CBase58Data
@@ -8,37 +12,43 @@ from bitcoin.wallet import P2SHBitcoinAddress, P2PKHBitcoinAddress
 from bitcoin.core import CMutableTransaction, CMutableTxIn, CMutableTxOut
 from bitcoin.core import COutPoint
 from jsonrpcproxy import to_json, from_json, SmartDispatcher, Proxy
+from jsonrpcproxy import SessionRegistry, JSONResponseException
+from jsonrpcproxy import to_binary, from_binary, handle_binary
+from jsonrpcproxy import BINARY_CONTENT_TYPE, SESSIONS, ConversionError
+from jsonrpcproxy import AsyncProxy, run, JSONRPCError
+from jsonrpc import JSONRPCResponseManager
 bitcoin.SelectParams('regtest')
 
+ROUNDTRIP_VALUES = [
+    42, 0, -42, 2100000000000000, -2100000000000000,
+    "basic string", "\u1111Unicode", "\U00010000Wide Unicode",
+    "\x00\n\t\r\nEscape codes", "\"'\"Quotes", "",
+    None,
+    b"\x00\x01\xFFBinary data", b"",
+    CBase58Data.from_bytes(b'\x00\x01\xFF', 42),
+    P2SHBitcoinAddress.from_bytes(b'\x00\x01\xFF'),
+    P2PKHBitcoinAddress.from_bytes(b'\x00\x01\xFF'),
+    CMutableTxIn(COutPoint(b'\x00'*16+b'\xFF'*16, 42),
+                 CScript(b'\x00\x01\xFF'),
+                 42),
+    CMutableTxOut(42, CScript(b'\x00\x01\xFF')),
+    CMutableTransaction([CMutableTxIn(COutPoint(b'\x00'*32, 42),
+                                      CScript(b'\x00\x01\xFF'),
+                                      42),
+                         CMutableTxIn(COutPoint(b'\xFF'*32, 42),
+                                      CScript(b'\xFF\x01\x00'),
+                                      43)],
+                        [CMutableTxOut(42, CScript(b'\x00\x01\xFF')),
+                         CMutableTxOut(43, CScript(b'\xFF\x01\x00'))],
+                        42, 3),
+    [1, b'\x00\x01\xFF', "List Test",],
+    {'a':1, 'key':b'\xFF\x01\x00', 1:'Dictionary Test'},
+    [{3: [0, 1, 2,],}, [[b'\xFFRecursion Test',],],],
+]
+
 class TestTranslation(unittest.TestCase):
     def test_json_roundtrip(self):
-        VALUES = [
-            42, 0, -42, 2100000000000000, -2100000000000000,
-            "basic string", "\u1111Unicode", "\U00010000Wide Unicode",
-            "\x00\n\t\r\nEscape codes", "\"'\"Quotes", "",
-            None,
-            b"\x00\x01\xFFBinary data", b"",
-            CBase58Data.from_bytes(b'\x00\x01\xFF', 42),
-            P2SHBitcoinAddress.from_bytes(b'\x00\x01\xFF'),
-            P2PKHBitcoinAddress.from_bytes(b'\x00\x01\xFF'),
-            CMutableTxIn(COutPoint(b'\x00'*16+b'\xFF'*16, 42),
-                         CScript(b'\x00\x01\xFF'),
-                         42),
-            CMutableTxOut(42, CScript(b'\x00\x01\xFF')),
-            CMutableTransaction([CMutableTxIn(COutPoint(b'\x00'*32, 42),
-                                              CScript(b'\x00\x01\xFF'),
-                                              42),
-                                 CMutableTxIn(COutPoint(b'\xFF'*32, 42),
-                                              CScript(b'\xFF\x01\x00'),
-                                              43)],
-                                [CMutableTxOut(42, CScript(b'\x00\x01\xFF')),
-                                 CMutableTxOut(43, CScript(b'\xFF\x01\x00'))],
-                                42, 3),
-            [1, b'\x00\x01\xFF', "List Test",],
-            {'a':1, 'key':b'\xFF\x01\x00', 1:'Dictionary Test'},
-            [{3: [0, 1, 2,],}, [[b'\xFFRecursion Test',],],],
-        ]
-        for value in VALUES:
+        for value in ROUNDTRIP_VALUES:
             self.assertEqual(from_json(to_json(value)), value)
 
     def test_None_hiding(self):
@@ -55,6 +65,30 @@ class TestTranslation(unittest.TestCase):
         value = (1, 'a', b'b',)
         self.assertEqual(from_json(to_json(value)), list(value))
 
+    def test_subclasses(self):
+        class Coins(list):
+            pass
+        class Amount(int):
+            pass
+        class Script(bytes):
+            pass
+        for _ in range(2):
+            self.assertEqual(from_json(to_json(Coins([Amount(1)]))), [1])
+            self.assertEqual(from_json(to_json(Script(b'\xFF'))), b'\xFF')
+
+    def test_address_subclass(self):
+        for value in [P2SHBitcoinAddress.from_bytes(b'\x00\x01\xFF'),
+                      P2PKHBitcoinAddress.from_bytes(b'\x00\x01\xFF')]:
+            self.assertEqual(to_json(value)['subclass'], 'CBitcoinAddress')
+            self.assertIs(type(from_json(to_json(value))), type(value))
+
+    def test_unknown(self):
+        for _ in range(2):
+            self.assertRaises(ConversionError, to_json, object())
+            self.assertRaises(ConversionError, from_json, 1.5)
+            self.assertRaises(ConversionError, from_json,
+                              {'__class__': 'Unknown'})
+
 class TestDispatcher(unittest.TestCase):
     def setUp(self):
         self.dispatcher = SmartDispatcher()
@@ -100,3 +134,275 @@ class TestDispatcher(unittest.TestCase):
         def nested_error():
             raise TestException('nested', TestException('2nd layer'))
         self.assertRaises(TestException, self.dispatcher['nested_error'])
+
+class TestSessions(unittest.TestCase):
+    def setUp(self):
+        self.sessions = SessionRegistry(maxsize=2)
+
+    def tearDown(self):
+        self.sessions.clear()
+
+    def test_shared_per_host(self):
+        first = self.sessions.get('http://localhost:9333/channel/')
+        second = self.sessions.get('http://localhost:9333/lightning/')
+        self.assertIs(first, second)
+
+    def test_distinct_hosts(self):
+        first = self.sessions.get('http://localhost:9333/channel/')
+        second = self.sessions.get('http://localhost:9334/channel/')
+        self.assertIsNot(first, second)
+
+    def test_connection_limit(self):
+        session = self.sessions.get('http://localhost:9333/')
+        adapter = session.get_adapter('http://localhost:9333/')
+        self.assertEqual(adapter._pool_maxsize, 2)
+        self.assertFalse(adapter._pool_block)
+
+    def test_fork_resets(self):
+        first = self.sessions.get('http://localhost:9333/')
+        self.sessions._pid = -1
+        self.assertIsNot(self.sessions.get('http://localhost:9333/'), first)
+
+class LoopbackProxy(Proxy):
+    """Proxy which hands requests straight to a dispatcher."""
+    def __init__(self, dispatcher, binary=False, json_only=False,
+                 url='http://localhost:9333/'):
+        Proxy.__init__(self, url, binary=binary)
+        self.dispatcher = dispatcher
+        self.json_only = json_only
+        self.requests = 0
+
+    def _post(self, data, content_type):
+        self.requests += 1
+        if content_type == BINARY_CONTENT_TYPE and not self.json_only:
+            return 200, content_type, handle_binary(self.dispatcher, data)
+        if isinstance(data, bytes):
+            data = data.decode('utf8', 'replace')
+        response = JSONRPCResponseManager.handle(data, self.dispatcher)
+        return 200, 'application/json', response.json.encode('utf8')
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.dispatcher = SmartDispatcher()
+        self.dispatcher.add_method(lambda x:x, 'echo')
+        @self.dispatcher.add_method
+        def fail(message):
+            raise ValueError(message)
+        self.proxy = LoopbackProxy(self.dispatcher)
+
+    def test_single(self):
+        self.assertEqual(self.proxy.echo(b'\x00\xFF'), b'\x00\xFF')
+
+    def test_batch(self):
+        VALUES = [42, "str", b"\x00\x01\xFFbytes", None,
+                  {'key': b"dict",}, [1, "list", b"bytes",],]
+        with self.proxy.batch() as batch:
+            calls = [batch.echo(value) for value in VALUES]
+        self.assertEqual(self.proxy.requests, 1)
+        self.assertEqual([call.result() for call in calls], VALUES)
+
+    def test_errors(self):
+        with self.proxy.batch() as batch:
+            good = batch.echo(1)
+            bad = batch.fail(b'\xFF')
+            missing = batch.missing()
+        self.assertEqual(good.result(), 1)
+        self.assertRaises(JSONResponseException, bad.result)
+        self.assertRaises(JSONResponseException, missing.result)
+
+    def test_empty(self):
+        with self.proxy.batch():
+            pass
+        self.assertEqual(self.proxy.requests, 0)
+
+    def test_unsent(self):
+        batch = self.proxy.batch()
+        call = batch.echo(1)
+        self.assertRaises(Exception, call.result)
+        batch.send()
+        self.assertEqual(call.result(), 1)
+
+class TestBinary(unittest.TestCase):
+    def test_roundtrip(self):
+        for value in ROUNDTRIP_VALUES + [True, False, {1: [None, True]}]:
+            self.assertEqual(from_binary(to_binary(value)), value)
+
+    def test_types(self):
+        for value in ROUNDTRIP_VALUES:
+            self.assertIs(type(from_binary(to_binary(value))), type(value))
+
+    def test_CBase58Data_version(self):
+        self.assertEqual(from_binary(to_binary(
+            CBase58Data.from_bytes(b'\x00\x01\xFF', 42))).nVersion,
+            42)
+
+    def test_compact(self):
+        value = [b'\x00' * 33, CMutableTxOut(42, CScript(b'\x00' * 23))]
+        self.assertLess(len(to_binary(value)),
+                        len(json.dumps(to_json(value))))
+
+    def test_corrupt(self):
+        data = to_binary([b'\x00\x01\xFF', 'str'])
+        self.assertRaises(ConversionError, from_binary, data[:-1])
+        self.assertRaises(ConversionError, from_binary, data + b'N')
+        self.assertRaises(ConversionError, from_binary, b'?')
+
+    def test_corrupt_object(self):
+        transaction = CMutableTransaction(
+            [], [CMutableTxOut(42, CScript(b'\x00' * 23))])
+        data = to_binary(transaction)
+        # The transaction's serialization claims more outputs than it has
+        index = data.index(transaction.serialize()) + 5
+        corrupt = data[:index] + b'\x05' + data[index + 1:]
+        self.assertRaises(ConversionError, from_binary, corrupt)
+        response = from_binary(handle_binary(SmartDispatcher(), corrupt))
+        self.assertEqual(response['error']['code'], -32700)
+
+    def test_unknown(self):
+        self.assertRaises(ConversionError, to_binary, object())
+
+class TestBinaryProxy(unittest.TestCase):
+    def setUp(self):
+        self.dispatcher = SmartDispatcher()
+        self.dispatcher.add_method(lambda x:[x, str(type(x))], 'echo')
+        @self.dispatcher.add_method
+        def fail(message):
+            raise ValueError(message, object())
+
+    def tearDown(self):
+        SESSIONS.clear()
+
+    def test_call(self):
+        proxy = LoopbackProxy(self.dispatcher, binary=True)
+        for value in ROUNDTRIP_VALUES:
+            self.assertEqual(proxy.echo(value), [value, str(type(value))])
+
+    def test_batch(self):
+        proxy = LoopbackProxy(self.dispatcher, binary=True)
+        with proxy.batch() as batch:
+            calls = [batch.echo(value) for value in ROUNDTRIP_VALUES]
+            bad = batch.fail(b'\xFF')
+        self.assertEqual(proxy.requests, 1)
+        self.assertEqual([call.result()[0] for call in calls],
+                         ROUNDTRIP_VALUES)
+        with self.assertRaises(JSONResponseException) as context:
+            bad.result()
+        self.assertEqual(context.exception.args[0]['data']['args'][0],
+                         b'\xFF')
+
+    def test_json_fallback(self):
+        url = 'http://localhost:9444/'
+        proxy = LoopbackProxy(self.dispatcher, binary=True, json_only=True,
+                              url=url)
+        self.assertEqual(proxy.echo(b'\xFF')[0], b'\xFF')
+        self.assertEqual(proxy.requests, 2)
+        self.assertFalse(SESSIONS.speaks_binary(url))
+        self.assertEqual(proxy.echo(b'\xFF')[0], b'\xFF')
+        self.assertEqual(proxy.requests, 3)
+
+    def test_unsupported_media_type(self):
+        url = 'http://localhost:9445/'
+        proxy = LoopbackProxy(self.dispatcher, binary=True, url=url)
+        def post(data, content_type):
+            if content_type == BINARY_CONTENT_TYPE:
+                proxy.requests += 1
+                return 415, 'text/html', b'Unsupported Media Type'
+            return LoopbackProxy._post(proxy, data, content_type)
+        proxy._post = post
+        self.assertEqual(proxy.echo(b'\xFF')[0], b'\xFF')
+        self.assertEqual(proxy.requests, 2)
+        self.assertFalse(SESSIONS.speaks_binary(url))
+
+    def test_no_resend(self):
+        # Anything but a parse error may follow a dispatched call
+        url = 'http://localhost:9446/'
+        proxy = LoopbackProxy(self.dispatcher, binary=True, url=url)
+        def post(data, content_type):
+            proxy.requests += 1
+            return 500, 'text/html', b'Internal Server Error'
+        proxy._post = post
+        with self.assertRaises(JSONRPCError):
+            proxy.echo(b'\xFF')
+        self.assertEqual(proxy.requests, 1)
+        self.assertTrue(SESSIONS.speaks_binary(url))
+
+class LoopbackAsyncProxy(AsyncProxy):
+    """AsyncProxy which hands requests straight to a dispatcher."""
+    def __init__(self, dispatcher, **kwargs):
+        AsyncProxy.__init__(self, 'http://localhost:9333/', **kwargs)
+        self.dispatcher = dispatcher
+
+    def _make_proxy(self, timeout):
+        return LoopbackProxy(self.dispatcher, binary=self.binary)
+
+class TestAsyncProxy(unittest.TestCase):
+    def setUp(self):
+        self.dispatcher = SmartDispatcher()
+        self.dispatcher.add_method(lambda x:x, 'echo')
+        @self.dispatcher.add_method
+        def sleep(milliseconds):
+            time.sleep(milliseconds / 1000)
+            return milliseconds
+        @self.dispatcher.add_method
+        def fail(message):
+            raise ValueError(message)
+
+    def tearDown(self):
+        SESSIONS.clear()
+
+    def test_call(self):
+        proxy = LoopbackAsyncProxy(self.dispatcher, binary=True)
+        self.assertEqual(run(proxy.echo(b'\xFF')), [b'\xFF'])
+
+    def test_concurrent(self):
+        proxy = LoopbackAsyncProxy(self.dispatcher)
+        start = time.time()
+        self.assertEqual(run(*[proxy.sleep(200) for _ in range(5)]),
+                         [200] * 5)
+        self.assertLess(time.time() - start, 0.8)
+
+    def test_timeout(self):
+        proxy = LoopbackAsyncProxy(self.dispatcher, timeout=0.05)
+        self.assertRaises(asyncio.TimeoutError, run, proxy.sleep(500))
+        self.assertEqual(run(proxy.call('sleep', 100, timeout=1)), [100])
+
+    def test_hung_peer(self):
+        # A peer which accepts connections and never answers
+        hung = socket.socket()
+        hung.bind(('localhost', 0))
+        hung.listen(8)
+        try:
+            url = 'http://localhost:%d/' % hung.getsockname()[1]
+            proxy = LoopbackAsyncProxy(self.dispatcher)
+            start = time.time()
+            results = run(AsyncProxy(url, timeout=0.2).echo(1),
+                          proxy.echo(2), return_exceptions=True)
+            self.assertLess(time.time() - start, 1)
+            # Timed out by asyncio, or by requests
+            self.assertIsInstance(results[0], Exception)
+            self.assertEqual(results[1], 2)
+            # The timed out request's thread is free again
+            SESSIONS.clear()
+            SESSIONS.workers = 1
+            self.assertRaises(Exception, run,
+                              AsyncProxy(url, timeout=0.2).echo(1))
+            self.assertEqual(run(proxy.call('echo', 3, timeout=1)), [3])
+        finally:
+            SESSIONS.workers = 16
+            hung.close()
+
+    def test_errors(self):
+        proxy = LoopbackAsyncProxy(self.dispatcher)
+        self.assertRaises(JSONResponseException, run,
+                          proxy.echo(1), proxy.fail('bad'))
+        results = run(proxy.echo(1), proxy.fail('bad'),
+                      return_exceptions=True)
+        self.assertEqual(results[0], 1)
+        self.assertIsInstance(results[1], JSONResponseException)
+
+    def test_batch(self):
+        proxy = LoopbackAsyncProxy(self.dispatcher, binary=True)
+        first, second = run(proxy.batch([('echo', (1,)), ('echo', (2,))]),
+                            proxy.batch([('echo', (b'\xFF',))]))
+        self.assertEqual([call.result() for call in first], [1, 2])
+        self.assertEqual([call.result() for call in second], [b'\xFF'])
@@ -0,0 +1,162 @@
+"""Tests for lightningd.py."""
+
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+import time
+import socket
+import traceback
+import sqlite3
+import subprocess
+import sys
+import textwrap
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import config
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def in_child(function):
+    """Run function in a forked child, and return True if it succeeded.
+
+    lightningd installs every API on the shared app, so it is only
+    imported in a child.
+    """
+    pid = os.fork()
+    if pid == 0:
+        try:
+            function()
+        except Exception: # pylint: disable=broad-except
+            traceback.print_exc()
+            os._exit(1)
+        os._exit(0)
+    return os.waitpid(pid, 0)[1] == 0
+
+class TestGunicorn(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def options_accepted(self, threads):
+        """Return True if the installed gunicorn takes every option."""
+        def check():
+            """Set every option."""
+            from gunicorn.config import Config
+            import lightningd
+            conf = config.lightning_config(
+                args={'threads': str(threads)}, datadir=self.directory)
+            settings = Config()
+            for key, value in lightningd.gunicorn_options(conf).items():
+                settings.set(key, value)
+            settings.worker_class # pylint: disable=pointless-statement
+        return in_child(check)
+
+    def test_options(self):
+        self.assertTrue(self.options_accepted(1))
+        self.assertTrue(self.options_accepted(4))
+
+class TestForward(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.requests = []
+        requests = self.requests
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self): # pylint: disable=invalid-name
+                requests.append((self.path, self.headers['Authorization']))
+                self.send_response(200)
+                self.end_headers()
+            def log_message(self, *args): # pylint: disable=arguments-differ
+                pass
+        self.server = HTTPServer(('localhost', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def test_forward(self):
+        def forward():
+            """Forward a batch of notifications."""
+            import lightningd
+            conf = config.lightning_config(args={
+                'port': str(self.server.server_port), 'rpcuser': 'user',
+                'rpcpassword': 'pass'}, datadir=self.directory)
+            lightningd.forward_notifications(conf)([('block', 'aa'),
+                                                    ('wallet', 'bb')])
+        self.assertTrue(in_child(forward))
+        self.assertEqual(self.requests, [
+            ('/block-notify?block=aa', 'Basic dXNlcjpwYXNz'),
+            ('/wallet-notify?tx=bb', 'Basic dXNlcjpwYXNz')])
+
+    def test_stuck(self):
+        # Connections are queued, but never answered
+        stuck = socket.socket()
+        stuck.bind(('localhost', 0))
+        stuck.listen(1)
+        def forward():
+            """Forward a notification to the stuck server, then another."""
+            import lightningd
+            import notify
+            notify.HTTP_TIMEOUT = 0.2
+            conf = config.lightning_config(args={
+                'port': str(stuck.getsockname()[1]), 'rpcuser': 'user',
+                'rpcpassword': 'pass'}, datadir=self.directory)
+            lightningd.forward_notifications(conf)([('block', 'aa'),
+                                                    ('wallet', 'bb')])
+        try:
+            start = time.monotonic()
+            self.assertTrue(in_child(forward))
+            self.assertLess(time.monotonic() - start, 5)
+        finally:
+            stuck.close()
+
+class TestStartup(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def start(self):
+        """Return True if a new node prepares to serve from its datadir.
+
+        The node runs in a new interpreter, since other tests have set up
+        the shared app already.
+        """
+        script = textwrap.dedent("""\
+            import config, lightningd
+            from serverutil import database
+            conf = config.lightning_config(args={
+                'datadir': %r, 'regtest': '1', 'bituser': 'user',
+                'bitpass': 'pass', 'bitport': '1'}, datadir=%r)
+            lightningd.configure(conf)
+            lightningd.prepare()
+            with lightningd.app.app_context():
+                database.engine.execute('SELECT * FROM channel_channels')
+            """) % (self.directory, self.directory)
+        return subprocess.call([sys.executable, '-c', script],
+                               cwd=ROOT) == 0
+
+    def test_empty(self):
+        self.assertTrue(self.start())
+        self.assertTrue(self.start())
+
+    def test_legacy(self):
+        path = os.path.join(self.directory, 'channel.dat')
+        legacy = sqlite3.connect(path)
+        legacy.execute(
+            'CREATE TABLE channels (id INTEGER PRIMARY KEY, address VARCHAR, '
+            'anchor_point BLOB, anchor_index INTEGER, their_sig BLOB, '
+            'anchor_redeem BLOB, our_balance INTEGER, our_script BLOB, '
+            'their_balance INTEGER, their_script BLOB, '
+            'commitment_number INTEGER)')
+        legacy.commit()
+        legacy.close()
+        self.assertTrue(self.start())
+        self.assertTrue(os.path.exists(path + '.imported'))
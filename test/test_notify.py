@@ -0,0 +1,104 @@
+"""Tests for notify.py."""
+
+import unittest
+import os.path
+import queue
+import shutil
+import tempfile
+import subprocess
+import socket
+import time
+import unittest.mock
+import notify
+
+class TestReplay(unittest.TestCase):
+    def test_dedupe(self):
+        batches = []
+        notify.replay([[('block', 'a'), ('wallet', 'b'), ('block', 'a')],
+                       [],
+                       [('block', 'a')]],
+                      batches.append)
+        self.assertEqual(batches, [[('block', 'a'), ('wallet', 'b')],
+                                   [('block', 'a')]])
+
+    def test_parse(self):
+        self.assertEqual(
+            notify.parse(b'block a\n\nbogus b\nwallet b extra\nwallet c\n'),
+            [('block', 'a'), ('wallet', 'c')])
+
+class TestListener(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        notify.prepare(self.directory)
+        self.batches = queue.Queue()
+        self.listener = notify.NotificationListener(
+            self.directory, self.batches.put, window=0.2)
+        self.listener.start()
+
+    def tearDown(self):
+        self.listener.stop()
+        shutil.rmtree(self.directory)
+
+    def test_batch(self):
+        notify.write(self.directory, 'block', 'a')
+        notify.write(self.directory, 'wallet', 'b')
+        notify.write(self.directory, 'block', 'a')
+        self.assertEqual(self.batches.get(timeout=5),
+                         [('block', 'a'), ('wallet', 'b')])
+        notify.write(self.directory, 'block', 'a')
+        self.assertEqual(self.batches.get(timeout=5), [('block', 'a')])
+
+    def test_shell(self):
+        subprocess.check_call(['sh', '-c', notify.shell_command(self.directory),
+                               'notify', 'wallet', 'abc'])
+        self.assertEqual(self.batches.get(timeout=5), [('wallet', 'abc')])
+
+    def test_prepare(self):
+        directory = os.path.join(self.directory, 'other')
+        notify.prepare(directory)
+        stale = os.path.join(directory, '1.fifo')
+        os.mkfifo(stale)
+        notify.prepare(directory)
+        self.assertFalse(os.path.exists(stale))
+
+    def test_no_listener(self):
+        # The shell command must not block when nothing is listening
+        self.listener.stop()
+        subprocess.check_call(['sh', '-c', notify.shell_command(self.directory),
+                               'notify', 'wallet', 'abc'], timeout=5)
+
+    def test_dead_listener(self):
+        # A FIFO left full by a worker which was killed
+        dead = subprocess.Popen(['true'])
+        dead.wait()
+        path = notify.fifo_path(self.directory, dead.pid)
+        os.mkfifo(path)
+        fifo = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+        try:
+            with self.assertRaises(BlockingIOError):
+                while True:
+                    os.write(fifo, b'x' * 4096)
+            subprocess.check_call(
+                ['sh', '-c', notify.shell_command(self.directory),
+                 'notify', 'wallet', 'abc'], timeout=5)
+        finally:
+            os.close(fifo)
+        self.assertEqual(self.batches.get(timeout=5), [('wallet', 'abc')])
+        notify.remove(self.directory, dead.pid)
+        self.assertFalse(os.path.exists(path))
+
+class TestMain(unittest.TestCase):
+    def test_stuck_server(self):
+        # Connections are queued, but never answered
+        server = socket.socket()
+        server.bind(('localhost', 0))
+        server.listen(1)
+        try:
+            port = str(server.getsockname()[1])
+            start = time.monotonic()
+            with unittest.mock.patch.object(notify, 'HTTP_TIMEOUT', 0.2):
+                with self.assertLogs(notify.LOGGER):
+                    notify.main(['notify.py', 'block', 'aa', port])
+            self.assertLess(time.monotonic() - start, 5)
+        finally:
+            server.close()
@@ -0,0 +1,296 @@
+"""Tests for serverutil.py."""
+
+import unittest
+import threading
+import time
+import os
+import shutil
+import tempfile
+import json
+from flask import Flask, g
+from blinker import Namespace
+from serverutil import EventBus, LockRegistry, GenerationCounters
+from serverutil import NodeDatabase, DATABASE_FILE, after_fork
+from serverutil import api_factory, database
+
+class TestAfterFork(unittest.TestCase):
+    def test_once_per_process(self):
+        resets = []
+        check = after_fork(lambda: resets.append(os.getpid()))
+        check()
+        check()
+        self.assertEqual(resets, [os.getpid()])
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            check()
+            check()
+            os.write(write_end, bytes([len(resets)]))
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(os.read(read_end, 1), bytes([2]))
+        self.assertEqual(resets, [os.getpid()])
+
+class TestEventBus(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        @self.app.before_request
+        def before_request():
+            g.ready = True
+        self.bus = EventBus(self.app, maxsize=4)
+        self.signal = Namespace().signal('TEST')
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        self.bus.stop()
+
+    def connect(self, key=None, delay=0):
+        @self.bus.connect(self.signal, key=key)
+        def receiver(dummy_sender, address, value):
+            time.sleep(delay)
+            with self.lock:
+                self.calls.append((address, value, g.get('ready')))
+        return receiver
+
+    def test_inline(self):
+        self.connect()
+        with self.app.app_context():
+            self.signal.send('test', address='a', value=1)
+        self.assertEqual(self.calls, [('a', 1, None)])
+
+    def test_inline_raises(self):
+        @self.bus.connect(self.signal)
+        def receiver(dummy_sender, **dummy_kwargs):
+            raise ValueError()
+        with self.assertRaises(ValueError):
+            self.signal.send('test')
+        stats = self.bus.get_stats()['handlers']
+        self.assertEqual(stats[__name__ + '.receiver']['failures'], 1)
+
+    def test_async_context(self):
+        self.connect()
+        self.bus.start(2)
+        self.signal.send('test', address='a', value=1)
+        self.bus.join()
+        self.assertEqual(self.calls, [('a', 1, True)])
+
+    def test_ordered_per_key(self):
+        self.connect(key='address', delay=0.001)
+        self.bus.start(4)
+        for value in range(20):
+            for address in 'ab':
+                self.signal.send('test', address=address, value=value)
+        self.bus.join()
+        for address in 'ab':
+            self.assertEqual([value for sent_to, value, _ in self.calls
+                              if sent_to == address], list(range(20)))
+
+    def test_backpressure(self):
+        release = threading.Event()
+        @self.bus.connect(self.signal)
+        def receiver(dummy_sender, **dummy_kwargs):
+            release.wait()
+        self.bus.start(1)
+        sender = threading.Thread(
+            target=lambda: [self.signal.send('test') for _ in range(10)])
+        sender.start()
+        time.sleep(0.1)
+        self.assertTrue(sender.is_alive())
+        self.assertLessEqual(self.bus.depth, 4)
+        release.set()
+        sender.join()
+        self.bus.join()
+        stats = self.bus.get_stats()
+        self.assertEqual(stats['max_depth'], 4)
+        self.assertEqual(stats['handlers'][__name__ + '.receiver']['count'], 10)
+
+    def test_nested(self):
+        self.bus.maxsize = 2
+        inner = Namespace().signal('INNER')
+        @self.bus.connect(inner)
+        def inner_receiver(dummy_sender, value):
+            with self.lock:
+                self.calls.append(value)
+        @self.bus.connect(self.signal)
+        def receiver(dummy_sender, value):
+            # Sent from a worker, with the queue full
+            for index in range(3):
+                inner.send('test', value=(value, index))
+        self.bus.start(2)
+        for value in range(4):
+            self.signal.send('test', value=value)
+        done = threading.Thread(target=self.bus.join, daemon=True)
+        done.start()
+        done.join(5)
+        self.assertFalse(done.is_alive())
+        self.assertEqual(len(self.calls), 12)
+
+    def test_failure_logged(self):
+        @self.bus.connect(self.signal)
+        def receiver(dummy_sender, **dummy_kwargs):
+            raise ValueError()
+        self.bus.start(1)
+        with self.assertLogs(self.app.logger):
+            self.signal.send('test')
+            self.bus.join()
+        stats = self.bus.get_stats()['handlers'][__name__ + '.receiver']
+        self.assertEqual((stats['count'], stats['failures']), (1, 1))
+
+class TestLocks(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.locks = LockRegistry()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_reentrant(self):
+        with self.locks.hold(self.directory, 'a'):
+            with self.locks.hold(self.directory, 'a'):
+                pass
+
+    def test_threads(self):
+        held = []
+        def worker():
+            with self.locks.hold(self.directory, 'a'):
+                held.append(len(held))
+                time.sleep(0.01)
+                held.append(len(held))
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Nobody else took the lock between each worker's two appends
+        self.assertEqual(held, list(range(8)))
+
+    def test_independent_names(self):
+        with self.locks.hold(self.directory, 'a'):
+            thread = threading.Thread(
+                target=lambda: self.locks.hold(self.directory, 'b').__enter__())
+            thread.start()
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+
+    def test_processes(self):
+        read_end, write_end = os.pipe()
+        with self.locks.hold(self.directory, 'a'):
+            pid = os.fork()
+            if pid == 0:
+                start = time.monotonic()
+                with self.locks.hold(self.directory, 'a'):
+                    waited = time.monotonic() - start
+                os.write(write_end, b'1' if waited > 0.1 else b'0')
+                os._exit(0)
+            time.sleep(0.2)
+        os.waitpid(pid, 0)
+        self.assertEqual(os.read(read_end, 1), b'1')
+
+class TestGenerationCounters(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.gen')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_bump(self):
+        counters = GenerationCounters(self.path, slots=16)
+        self.assertEqual(counters.get('a'), 0)
+        self.assertEqual(counters.bump('a'), 1)
+        self.assertEqual(counters.get('a'), 1)
+
+    def test_shared(self):
+        first = GenerationCounters(self.path)
+        first.bump('a')
+        pid = os.fork()
+        if pid == 0:
+            for _ in range(100):
+                GenerationCounters(self.path).bump('a')
+            os._exit(0)
+        for _ in range(100):
+            first.bump('a')
+        os.waitpid(pid, 0)
+        self.assertEqual(first.get('a'), 201)
+
+class TestNodeDatabase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + \
+            os.path.join(self.directory, DATABASE_FILE)
+        self.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        self.app.config['durability'] = 'group'
+        self.app.config['dbconnections'] = 2
+        self.database = NodeDatabase(self.app)
+        self.engine = self.database.get_engine(self.app)
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def test_wal(self):
+        self.assertEqual(self.engine.execute('PRAGMA journal_mode').scalar(),
+                         'wal')
+        self.assertEqual(self.engine.execute('PRAGMA synchronous').scalar(),
+                         1)
+
+    def test_pooled(self):
+        connection = self.engine.connect()
+        first = connection.connection.connection
+        connection.close()
+        connection = self.engine.connect()
+        self.assertIs(connection.connection.connection, first)
+        connection.close()
+
+    def test_fork(self):
+        connection = self.engine.connect()
+        inherited = connection.connection.connection
+        connection.close()
+        pid = os.fork()
+        if pid == 0:
+            # The parent's connection is replaced, not shared
+            connection = self.engine.connect()
+            connection.execute('SELECT 1')
+            os._exit(0 if connection.connection.connection is not inherited
+                     else 1)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertEqual(self.engine.execute('SELECT 1').scalar(), 1)
+
+class TestRPC(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config['datadir'] = self.directory
+        self.app.config['durability'] = 'group'
+        self.app.config['dbconnections'] = 2
+        database.init_app(self.app)
+        api, remote, dummy_model = api_factory('rpctest')
+        remote(lambda value: value, 'echo')
+        self.app.register_blueprint(api)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def post(self, payload):
+        """POST payload to the API, and return the decoded response."""
+        response = self.client.post('/rpctest/', data=json.dumps(payload),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.get_data(as_text=True))
+
+    def test_single(self):
+        self.assertEqual(self.post({'jsonrpc': '2.0', 'method': 'echo',
+                                    'params': [1], 'id': 1})['result'], 1)
+
+    def test_batch(self):
+        replies = self.post([
+            {'jsonrpc': '2.0', 'method': 'echo', 'params': [1], 'id': 1},
+            {'jsonrpc': '2.0', 'method': 'echo', 'params': ['two'], 'id': 2},
+            {'jsonrpc': '2.0', 'method': 'missing', 'id': 3}])
+        replies = {reply['id']: reply for reply in replies}
+        self.assertEqual(replies[1]['result'], 1)
+        self.assertEqual(replies[2]['result'], 'two')
+        self.assertEqual(replies[3]['error']['code'], -32601)
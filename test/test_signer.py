@@ -0,0 +1,61 @@
+"""Tests for signer.py."""
+
+import unittest
+import hashlib
+from bitcoin.core import COutPoint, CMutableTransaction, CMutableTxIn
+from bitcoin.core import CMutableTxOut
+from bitcoin.core.script import CScript, OP_TRUE, OP_FALSE
+from bitcoin.core.scripteval import VerifyScriptError
+from serverutil import NodeIdentity
+from signer import Signer
+
+IDENTITY = NodeIdentity(b'alice', 9001)
+SIGHASHES = [hashlib.sha256(bytes([i])).digest() for i in range(40)]
+
+def spend(script_sig):
+    """A transaction spending an output with script_sig."""
+    return CMutableTransaction(
+        [CMutableTxIn(COutPoint(b'\x01' * 32, 0), CScript(script_sig))],
+        [CMutableTxOut(1000, CScript([OP_TRUE]))])
+
+class SignerTests(object):
+    """Tests run with and without a pool."""
+    workers = 0
+
+    def setUp(self):
+        self.signer = Signer(IDENTITY, workers=self.workers, batch=16)
+
+    def tearDown(self):
+        self.signer.shutdown()
+
+    def test_sign_many(self):
+        futures = self.signer.sign_many(SIGHASHES)
+        self.assertEqual(len(futures), len(SIGHASHES))
+        for sighash, future in zip(SIGHASHES, futures):
+            self.assertTrue(IDENTITY.seckey.pub.verify(sighash,
+                                                       future.result()))
+
+    def test_verify(self):
+        sig = self.signer.sign(SIGHASHES[0]).result()
+        self.assertTrue(self.signer.verify(
+            IDENTITY.pubkey, SIGHASHES[0], sig).result())
+        self.assertFalse(self.signer.verify(
+            IDENTITY.pubkey, SIGHASHES[1], sig).result())
+
+    def test_verify_script(self):
+        self.signer.verify_script(CScript([OP_TRUE]), CScript([]),
+                                  spend([OP_TRUE])).result()
+        with self.assertRaises(VerifyScriptError):
+            self.signer.verify_script(CScript([OP_FALSE]), CScript([]),
+                                      spend([OP_FALSE])).result()
+
+class TestInline(SignerTests, unittest.TestCase):
+    workers = 0
+
+class TestPool(SignerTests, unittest.TestCase):
+    workers = 2
+
+    def test_restart(self):
+        self.signer.sign(SIGHASHES[0]).result()
+        self.signer.shutdown()
+        self.assertTrue(self.signer.sign(SIGHASHES[0]).result())
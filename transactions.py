@@ -0,0 +1,193 @@
+"""The scripts and signatures of the transactions a channel signs.
+
+AnchorScriptSig -- the scriptSig spending an anchor, with a placeholder
+                   for our signature
+anchor_script -- the 2 of 2 multisig redeem script of an anchor
+CommitmentTemplate -- a transaction spending the anchor to two fixed
+                      scriptPubKeys, whose sighash is cheap to recompute
+commitment_template -- return the shared CommitmentTemplate for outputs
+VERIFIER -- the Verifier, which chooses which signed transactions to verify
+signature_valid -- check a counterparty's signature, once per process
+hash_signatures -- sign sighashes together
+
+Commitment and settlement transactions only change in their output values
+from one update to the next, so they are signed from a CommitmentTemplate
+which keeps the rest of the serialized sighash preimage.
+
+Signatures from the counterparty are checked once, when they are received
+(see signature_valid). Whether the transactions we sign are also run
+through the script interpreter is chosen by the verifysigs config option
+(see Verifier).
+"""
+
+import time
+import random
+import struct
+import functools
+import threading
+from flask import g
+from bitcoin.core import CMutableTxOut, CMutableTxIn, CMutableTransaction, Hash
+from bitcoin.core.script import CScript, SIGHASH_ALL
+from bitcoin.core.script import OP_CHECKMULTISIG, OP_PUBKEY
+from serverutil import Stats
+
+class AnchorScriptSig(object):
+    """Class representing a scriptSig satisfying the anchor output.
+
+    Uses OP_PUBKEY to hold the place of your signature.
+    """
+
+    def __init__(self, my_index=0, sig=b'', redeem=b''):
+        if my_index == b'':
+            my_index = 0
+        if my_index not in [0, 1]:
+            raise Exception("Unknown index", my_index)
+        self.my_index = my_index
+        self.sig = sig
+        self.redeem = CScript(redeem)
+
+    @classmethod
+    def from_script(cls, script):
+        """Construct an AnchorScriptSig from a CScript."""
+        script = list(script)
+        assert len(script) == 4
+        if script[1] == OP_PUBKEY:
+            return cls(0, script[2], script[3])
+        elif script[2] == OP_PUBKEY:
+            return cls(1, script[1], script[3])
+        else:
+            raise Exception("Could not find OP_PUBKEY")
+
+    def to_script(self, sig=OP_PUBKEY):
+        """Construct a CScript from an AnchorScriptSig."""
+        if self.my_index == 0:
+            sig1, sig2 = sig, self.sig
+        elif self.my_index == 1:
+            sig1, sig2 = self.sig, sig
+        else:
+            raise Exception("Unknown index", self.my_index)
+        return CScript([0, sig1, sig2, self.redeem])
+
+class CommitmentTemplate(object):
+    """A transaction spending the anchor to two fixed scriptPubKeys.
+
+    Commitment and settlement transactions only differ between updates in
+    their two output values. The SIGHASH_ALL preimage of such a transaction
+    is serialized once, split around the values, so a sighash only packs
+    two integers and hashes.
+    """
+
+    VALUE = struct.Struct('<q')
+
+    def __init__(self, anchor_point, redeem, first, second):
+        self.anchor_point = anchor_point
+        self.first = CScript(first)
+        self.second = CScript(second)
+        # The signed input's scriptSig is the redeem script while hashing
+        preimage = CMutableTransaction(
+            [CMutableTxIn(anchor_point, CScript(redeem))],
+            [CMutableTxOut(0, self.first), CMutableTxOut(0, self.second)]
+        ).serialize()
+        first_out = CMutableTxOut(0, self.first).serialize()
+        second_out = CMutableTxOut(0, self.second).serialize()
+        # preimage is prefix, two outputs, then nLockTime
+        prefix_end = len(preimage) - len(first_out) - len(second_out) - 4
+        self.prefix = preimage[:prefix_end]
+        self.first_script = first_out[self.VALUE.size:]
+        self.second_script = second_out[self.VALUE.size:]
+        self.suffix = preimage[-4:] + struct.pack('<i', SIGHASH_ALL)
+
+    def sighash(self, first_value, second_value):
+        """Return the SIGHASH_ALL sighash of the anchor input."""
+        return Hash(self.prefix +
+                    self.VALUE.pack(first_value) + self.first_script +
+                    self.VALUE.pack(second_value) + self.second_script +
+                    self.suffix)
+
+    def transaction(self, first_value, second_value):
+        """Return the unsigned transaction."""
+        return CMutableTransaction(
+            [CMutableTxIn(self.anchor_point)],
+            [CMutableTxOut(first_value, self.first),
+             CMutableTxOut(second_value, self.second)])
+
+@functools.lru_cache(maxsize=1024)
+def commitment_template(anchor_point, redeem, first, second):
+    """Return the (shared) CommitmentTemplate for a channel's outputs."""
+    return CommitmentTemplate(anchor_point, redeem, first, second)
+
+class Verifier(object):
+    """Decide when to verify signed transactions, and time verification.
+
+    The verifysigs config option chooses the policy for signed transactions:
+    always -- run the script interpreter over every transaction we sign
+    sampled -- only one in verifysample, and every transaction broadcast
+    broadcast -- only transactions we broadcast
+    Peer signatures are always checked once, when they are received.
+    """
+
+    POLICIES = ('always', 'sampled', 'broadcast')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = {'script': Stats(), 'peer': Stats()}
+        self.skipped = 0
+
+    def wanted(self, broadcast):
+        """Return True if a transaction should have its scripts verified."""
+        policy = g.config['verifysigs']
+        if policy not in self.POLICIES:
+            raise Exception("Unknown verifysigs policy", policy)
+        if policy == 'always' or broadcast:
+            return True
+        if policy == 'sampled':
+            return random.randrange(int(g.config['verifysample'])) == 0
+        return False
+
+    def skip(self):
+        """Record a transaction which was not verified."""
+        with self._lock:
+            self.skipped += 1
+
+    def run(self, kind, check):
+        """Run check, timing it as kind. check raises or returns False."""
+        start = time.monotonic()
+        failed = True
+        try:
+            result = check()
+            failed = result is False
+            return result
+        finally:
+            with self._lock:
+                self.stats[kind].record(time.monotonic() - start, failed)
+
+    def get_stats(self):
+        """Return verification counts and timings (in microseconds)."""
+        with self._lock:
+            out = {kind: stats.as_dict() for kind, stats in self.stats.items()}
+            out['skipped'] = self.skipped
+        return out
+
+VERIFIER = Verifier()
+
+@functools.lru_cache(maxsize=4096)
+def signature_valid(pubkey, sighash, sig):
+    """Return True if sig is pubkey's SIGHASH_ALL signature of sighash.
+
+    Results are cached, so a signature is only checked once per process.
+    """
+    def check():
+        """Verify the signature."""
+        return (sig[-1:] == bytes([SIGHASH_ALL]) and
+                g.signer.verify(pubkey, sighash, sig[:-1]).result())
+    return VERIFIER.run('peer', check)
+
+def hash_signatures(sighashes):
+    """Signatures for SIGHASH_ALL sighashes, signed together (see Signer)."""
+    return [future.result() + bytes([SIGHASH_ALL])
+            for future in g.signer.sign_many(sighashes)]
+
+def anchor_script(my_pubkey, their_pubkey):
+    """Generate the output script for the anchor transaction."""
+    script = CScript([2, my_pubkey, their_pubkey, 2, OP_CHECKMULTISIG])
+    return script
@@ -0,0 +1,219 @@
+"""Watch the chain for spends of channel anchors.
+
+Interface:
+ANCHOR_SPENT -- a blinker signal sent when a block spends a channel's anchor.
+Arguments:
+- address -- the url of the counterparty
+- channel -- the channel's id
+- anchor -- the anchor, as txid:n
+- txid -- the spending transaction
+- kind -- 'current', 'revoked' or 'unknown' (see spend_kind)
+- number -- the commitment number of the state it pays, or None
+
+ANCHOR_UNSPENT -- a blinker signal sent when a block which spent a channel's
+anchor leaves the chain. Arguments are as ANCHOR_SPENT, without kind or
+number.
+
+watch(block)
+- Match spends in the chain up to a new block (see below). Every process
+  does this on BLOCK_NOTIFY.
+
+Each new block is fetched once, and each of its inputs looked up in an
+index of every anchor, so the work for a block doesn't grow with the
+number of channels. The blocks matched are kept in table BLOCKS (one of
+the channel blueprint's), so a reorg undoes the spends found in the blocks
+it removes. A spent channel is no longer paid in.
+"""
+
+import os
+from sqlalchemy import Column, Integer, String
+from flask import g, current_app
+from blinker import Namespace
+from bitcoin.core import b2lx, lx
+from serverutil import database, LOCKS, BUS, BLOCK_NOTIFY
+from channelstore import Model, Channel, PendingUpdate
+from channelstore import cache, load, channel_lock, channel_history
+
+SIGNALS = Namespace()
+ANCHOR_SPENT = SIGNALS.signal('ANCHOR_SPENT')
+ANCHOR_UNSPENT = SIGNALS.signal('ANCHOR_UNSPENT')
+
+class Block(Model):
+    """Model of a block whose spends have been matched (see watch)."""
+
+    __tablename__ = 'blocks'
+
+    hash = Column(String, primary_key=True)
+    height = Column(Integer, index=True)
+
+def chain_lock():
+    """Return a context manager holding the lock on the blocks table."""
+    return LOCKS.hold(os.path.join(g.config['datadir'], 'locks'), 'chain')
+
+def spend_kind(channel, transaction):
+    """Return what transaction, which spends channel's anchor, pays.
+
+    'current' if it pays the current balances (a settlement, or either
+    side's current commitment), 'revoked' if it pays a commitment's
+    scripts other balances, so is an earlier commitment, else 'unknown'.
+    """
+    outputs = [(output.nValue, bytes(output.scriptPubKey))
+               for output in transaction.vout]
+    expected = [[(value, bytes(script)) for value, script in candidate]
+                for candidate in [channel.settlement_outputs(),
+                                  channel.commitment_outputs(ours=True),
+                                  channel.commitment_outputs(ours=False)]]
+    if outputs in expected:
+        return 'current'
+    scripts = [script for _, script in outputs]
+    if scripts in [[script for _, script in candidate]
+                   for candidate in expected[1:]]:
+        return 'revoked'
+    return 'unknown'
+
+def spent_number(channel, transaction):
+    """Return the commitment number of the state transaction pays, or None.
+
+    Past states are found in the channel's history log.
+    """
+    outputs = [(output.nValue, bytes(output.scriptPubKey))
+               for output in transaction.vout]
+    if len(outputs) != 2:
+        return None
+    scripts = (bytes(channel.our_script), bytes(channel.their_script))
+    for ours, theirs in [outputs, outputs[::-1]]:
+        if (ours[1], theirs[1]) == scripts:
+            if (ours[0], theirs[0]) == (channel.our_balance,
+                                        channel.their_balance):
+                return channel.commitment_number
+            state = channel_history(channel.id).find(ours[0], theirs[0])
+            if state is not None:
+                return state.number
+    return None
+
+def _describe(channel):
+    """Return the arguments of ANCHOR_SPENT and ANCHOR_UNSPENT for channel."""
+    return {'address': channel.address, 'channel': channel.id,
+            'anchor': '%s:%d' % (b2lx(channel.anchor_point.hash),
+                                 channel.anchor_point.n)}
+
+def _connect(block_hash, height):
+    """Match the spends of anchors in a block. Return the signals to send."""
+    block = g.bit.getblock(block_hash)
+    index = cache().anchor_index()
+    spends = [(index[txin.prevout.serialize()], transaction)
+              for transaction in block.vtx for txin in transaction.vin
+              if txin.prevout.serialize() in index]
+    events = []
+    for channel_id, transaction in spends:
+        with channel_lock(channel_id):
+            channel = load(channel_id)
+            channel.spent_by = b2lx(transaction.GetHash())
+            channel.spent_in = b2lx(block_hash)
+            cache().commit(channel)
+        events.append((ANCHOR_SPENT, dict(
+            _describe(channel), txid=channel.spent_by,
+            kind=spend_kind(channel, transaction),
+            number=spent_number(channel, transaction))))
+    database.session.add(Block(hash=b2lx(block_hash), height=height))
+    database.session.commit()
+    return events
+
+def _disconnect(block):
+    """Undo the spends matched in a block which has left the chain."""
+    events = []
+    for channel_id, in database.session.query(Channel.id).filter(
+            Channel.spent_in == block.hash).all():
+        with channel_lock(channel_id):
+            channel = load(channel_id)
+            txid = channel.spent_by
+            channel.spent_by = channel.spent_in = None
+            cache().commit(channel)
+        events.append((ANCHOR_UNSPENT, dict(_describe(channel), txid=txid)))
+    database.session.delete(block)
+    database.session.commit()
+    return events
+
+def _height(block_hash, count, depth):
+    """Return the height of block_hash, if it is one of the last depth
+    blocks of a chain of count blocks after the genesis block, else None."""
+    for height in range(count, max(count - depth, -1), -1):
+        if g.bit.getblockhash(height) == block_hash:
+            return height
+    return None
+
+def watch(block):
+    """Match spends of channel anchors in the chain ending at block.
+
+    Each block after the last one matched, up to block (a hex hash), is
+    fetched once and its inputs looked up in the anchor index. Blocks
+    matched before which have left the chain are undone first, newest
+    first. At most watchdepth blocks are caught up with; beyond that, or
+    on the first block seen, matching starts afresh at block. Return
+    (signal, arguments) for each spend found or undone.
+
+    Heights come from getblockcount and getblockhash, which every
+    supported bitcoind has, so only the blocks matched are fetched.
+
+    Every process is notified of each block, but only the first to take
+    the chain lock does any work.
+    """
+    depth = int(g.config['watchdepth'])
+    events = []
+    with chain_lock():
+        if Block.query.get(block) is not None:
+            return events
+        count = g.bit.getblockcount()
+        height = _height(lx(block), count, depth)
+        if height is None:
+            # A late notification, for a block which has left the chain
+            return events
+        # The newest block matched which is still in the chain
+        fork = None
+        # Blocks above the tip left the chain in a reorg to a shorter chain
+        for matched in Block.query.filter(Block.height <= count).order_by(
+                Block.height.desc()).all():
+            if b2lx(g.bit.getblockhash(matched.height)) == matched.hash:
+                fork = matched
+                break
+        if fork is not None and fork.height >= height:
+            return events
+        if fork is None or height - fork.height > depth:
+            if Block.query.first() is not None:
+                current_app.logger.warning(
+                    "More than %d blocks behind; spends may be missed", depth)
+            start = height
+            Block.query.delete()
+        else:
+            start = fork.height + 1
+            for stale in Block.query.filter(Block.height > fork.height).order_by(
+                    Block.height.desc()).all():
+                events.extend(_disconnect(stale))
+        for number in range(start, height):
+            events.extend(_connect(g.bit.getblockhash(number), number))
+        events.extend(_connect(lx(block), height))
+        Block.query.filter(Block.height <= height - depth).delete()
+        database.session.commit()
+    return events
+
+@BUS.connect(BLOCK_NOTIFY, sender='server')
+def on_block_watch(dummy_sender, block, **dummy_kwargs):
+    """Look for anchors spent in a new block."""
+    for signal, arguments in watch(block):
+        signal.send('channel', **arguments)
+
+@BUS.connect(ANCHOR_SPENT, sender='channel', key='address')
+def on_anchor_spent(dummy_sender, channel, anchor, txid, kind, number=None, # pylint: disable=too-many-arguments
+                    **dummy_kwargs):
+    """Stop updating a channel whose anchor has been spent.
+
+    Commitments are not yet revocable, so a revoked commitment can't be
+    answered with a penalty; it is only logged, with its number if the
+    channel's history has it.
+    """
+    with channel_lock(channel):
+        PendingUpdate.query.filter(PendingUpdate.channel_id == channel).delete()
+        database.session.commit()
+    if kind != 'current':
+        current_app.logger.error("Anchor %s spent by %s commitment %s (%s)",
+                                 anchor, kind, txid, number)